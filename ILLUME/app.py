@@ -3,7 +3,7 @@ import os
 import traceback
 import logging
 from functools import partial
-from threading import Thread
+from threading import Lock, Thread
 
 from PIL import Image
 
@@ -15,12 +15,14 @@ from transformers import LogitsProcessorList, TextIteratorStreamer
 
 from illume.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
 from illume.conversation import conv_templates, default_conversation  # Import Conversation class
-from illume.mm_utils import process_images, tokenizer_image_token
-from illume.data.data_utils import unpad_and_resize_back
+from illume.mm_utils import process_images, tokenizer_image_token_batch
+from illume.data.data_utils import unpad_and_resize_back, calculate_image_token_num
 
 from generation_eval.models.builder import build_eval_model
 from generation_eval.models.inference_utils import CFGLogits, DualVQImageTokenProcessor, DynamicSamplingProcessor, \
-    InterleavedLogitsProcessor, parse_interleaved_text_image, calculate_image_token_num, check_image_token_num
+    InterleavedLogitsProcessor, parse_interleaved_text_image, check_image_token_num
+from generation_eval.models.image_streamer import ImagePreviewStreamer, decode_image_preview
+from generation_eval.models.continuous_batching import ImageGenerationRequest
 
 # --- End ILLUME Imports ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -37,7 +39,9 @@ import gradio as gr
 # --- Global Variables and Model Loading ---
 eval_model = None  # Global variable to hold the loaded ILLUME model
 args = None  # Global variable to hold command line args
-streamer = None  # Global variable to hold command line args
+engine = None  # ContinuousBatchingEngine shared by all sessions, enabled with --continuous_batching
+# every forward of the models runs under this lock: the engine steps, the `generate` calls and the image decoding
+model_lock = Lock()
 
 # Define common resolutions
 DEFAULT_RESOLUTIONS = [
@@ -177,11 +181,18 @@ def add_text(state, text, image, mode):
 
 
 def stream_response(model, inputs, streamer, prompt, gen_kwargs):
-    thread = Thread(target=model.generate, kwargs=dict(
-        streamer=streamer,
-        **inputs,
-        **gen_kwargs
-    ))
+    generation_result = {}
+
+    def run_generate():
+        # the generation thread holds the lock, the text is streamed to the session without it
+        try:
+            with model_lock:
+                model.generate(streamer=streamer, **inputs, **gen_kwargs)
+        except BaseException as e:
+            generation_result["error"] = e
+            streamer.end()
+
+    thread = Thread(target=run_generate)
     thread.start()
 
     generated_text = prompt
@@ -189,11 +200,14 @@ def stream_response(model, inputs, streamer, prompt, gen_kwargs):
     for new_text in streamer:
         generated_text += new_text
         yield generated_text
+    thread.join()
+    if "error" in generation_result:
+        raise generation_result["error"]
 
 
 # @spaces.GPU
 def http_chat_bot(state, temperature, top_k, top_p, max_new_tokens):
-    global eval_model, args, streamer  # Use global model and args
+    global eval_model, args  # Use global model and args
     logging.info("http_chat_bot.")
 
     if state.skip_next:
@@ -237,8 +251,9 @@ def http_chat_bot(state, temperature, top_k, top_p, max_new_tokens):
         image_sizes = None
 
     # Tokenize the prompt
-    # Use tokenizer_image_token for potential image placeholder
-    input_ids_list = [tokenizer_image_token(prompt, eval_model.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt")]
+    # Use tokenizer_image_token_batch for potential image placeholder, with the cached template chunks
+    input_ids_list = tokenizer_image_token_batch([prompt], eval_model.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt",
+                                                 chunk_cache=eval_model.prompt_chunk_cache)
     pad_token_ids = eval_model.tokenizer.pad_token_id if eval_model.tokenizer.pad_token_id is not None else eval_model.tokenizer.eos_token_id
     input_ids = pad_sequence(eval_model.tokenizer, input_ids_list, batch_first=True, padding_value=pad_token_ids).to(
         eval_model.device)
@@ -299,7 +314,9 @@ def http_chat_bot(state, temperature, top_k, top_p, max_new_tokens):
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 2
 
-    # Stream output
+    # Stream output, with a streamer per request as the sessions run concurrently. It waits without timeout, the
+    # generation may wait for the model lock and ends the streamer on errors.
+    streamer = TextIteratorStreamer(eval_model.tokenizer, skip_prompt=True, skip_special_tokens=True)
     try:
         for generated_text in stream_response(eval_model.mllm_model, inputs, streamer, prompt, gen_kwargs):
             output = generated_text[len(prompt):].strip()
@@ -404,8 +421,9 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
     logging.info(f"Raw Prompt: {prompt}")
 
     # Tokenize the prompt
-    # Use tokenizer_image_token for potential image placeholder
-    input_ids_list = [tokenizer_image_token(prompt, eval_model.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt")]
+    # Use tokenizer_image_token_batch for potential image placeholder, with the cached template chunks
+    input_ids_list = tokenizer_image_token_batch([prompt], eval_model.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt",
+                                                 chunk_cache=eval_model.prompt_chunk_cache)
     pad_token_ids = eval_model.tokenizer.pad_token_id if eval_model.tokenizer.pad_token_id is not None else eval_model.tokenizer.eos_token_id
     input_ids = pad_sequence(eval_model.tokenizer, input_ids_list, batch_first=True, padding_value=pad_token_ids).to(
         eval_model.device)
@@ -416,6 +434,7 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
     logits_processor_list = []
 
     # 1. CFG Logits Processor
+    unconditional_input_ids = None
     if llm_cfg_scale > 1.0:
         # Prepare unconditional prompt
         # Use a fixed unconditional prompt or get from dataset/config if available
@@ -427,9 +446,10 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
         conv_uncond.append_message(conv_uncond.roles[1], None)
         unconditional_prompt_str = conv_uncond.get_prompt() + ratio_tag  # Add ratio tag
         print("unconditional_prompt_str", unconditional_prompt_str)
-        unconditional_input_ids = tokenizer_image_token(unconditional_prompt_str,
-                                                        eval_model.tokenizer,
-                                                        IMAGE_TOKEN_INDEX, return_tensors="pt")
+        unconditional_input_ids, = tokenizer_image_token_batch([unconditional_prompt_str],
+                                                               eval_model.tokenizer,
+                                                               IMAGE_TOKEN_INDEX, return_tensors="pt",
+                                                               chunk_cache=eval_model.prompt_chunk_cache)
         unconditional_input_ids = unconditional_input_ids.repeat(input_ids.shape[0], 1)
 
         # Pad unconditional prompt if needed to match batch size (1 in this case)
@@ -447,6 +467,7 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
 
     # 2. Strict Image Token Processor (DualVQImageTokenProcessor)
     token_nums, max_new_tokens, h1, w1, h2, w2 = calculate_image_token_num(h_out, w_out)
+    max_new_tokens += 50  # buffer
 
     global special_tokens_dict
     special_tokens_dict['start_of_vision_answer'] = eval_model.tokenizer.encode('<answer>')
@@ -483,22 +504,61 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
     generated_image = None
     generated_text = ""
     try:
-        with torch.inference_mode():  # Ensure no gradients are calculated
-            output_ids = eval_model.mllm_model.generate(
-                input_ids,
-                attention_mask=attention_masks,
-                images=images_tensor,  # Pass the processed input image tensor
-                image_sizes=image_sizes,  # Pass image sizes
-                pad_token_id=pad_token_ids,
-                do_sample=True if temperature > 0 else False,  # Controlled by dynamic sampler now, but keep flag
-                temperature=1.0,  # Set to 1.0 as dynamic sampler handles it
-                top_k=0,  # Set to 0 as dynamic sampler handles it
-                top_p=1.0,  # Set to 1.0 as dynamic sampler handles it
-                max_new_tokens=max_new_tokens,
-                logits_processor=final_logits_processor,  # Use the combined processor
-                use_cache=True,
-                eos_token_id=eval_model.tokenizer.eos_token_id  # Ensure EOS token is set
+        if engine is not None:
+            # The request joins the decode batch of the engine next to the requests of the other sessions.
+            # The engine returns the image tokens once they are all generated, so there are no previews.
+            request = ImageGenerationRequest(
+                input_ids=input_ids_list[0],
+                image_token_layout=(h1, w1, h2, w2),
+                uncond_input_ids=None if unconditional_input_ids is None else unconditional_input_ids[0],
+                guidance_scale=llm_cfg_scale,
+                images=images_tensor,
+                image_sizes=image_sizes,
+                do_sample=temperature > 0,
+                level0_temp=temperature, level0_top_k=top_k, level0_top_p=top_p,
+                level1_temp=temperature, level1_top_k=top_k * 3, level1_top_p=top_p,
             )
+            output_ids = torch.tensor([engine.submit(request).result()])
+        else:
+            # Stream previews of the image: one after the semantic grid, then one per generated pixel row.
+            preview_streamer = ImagePreviewStreamer(
+                lambda *preview_args: Image.fromarray(decode_image_preview(eval_model.vq_model, *preview_args)),
+                special_tokens_dict, level0_range, level1_range, (h1, w1, h2, w2))
+            generation_result = {}
+
+            def run_generate():
+                # the generation thread holds the lock, the previews are yielded to the session without it
+                try:
+                    with model_lock, torch.inference_mode():  # Ensure no gradients are calculated
+                        generation_result["output_ids"] = eval_model.mllm_model.generate(
+                            input_ids,
+                            attention_mask=attention_masks,
+                            images=images_tensor,  # Pass the processed input image tensor
+                            image_sizes=image_sizes,  # Pass image sizes
+                            pad_token_id=pad_token_ids,
+                            do_sample=True if temperature > 0 else False,  # Controlled by dynamic sampler now, but keep flag
+                            temperature=1.0,  # Set to 1.0 as dynamic sampler handles it
+                            top_k=0,  # Set to 0 as dynamic sampler handles it
+                            top_p=1.0,  # Set to 1.0 as dynamic sampler handles it
+                            max_new_tokens=max_new_tokens,
+                            logits_processor=final_logits_processor,  # Use the combined processor
+                            use_cache=True,
+                            eos_token_id=eval_model.tokenizer.eos_token_id,  # Ensure EOS token is set
+                            streamer=preview_streamer,
+                        )
+                except BaseException as e:
+                    generation_result["error"] = e
+                    preview_streamer.end()
+
+            generation_thread = Thread(target=run_generate)
+            generation_thread.start()
+            for preview_image in preview_streamer:
+                state.messages[-1][-1] = ('<image>', [preview_image], None)
+                yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 2
+            generation_thread.join()
+            if "error" in generation_result:
+                raise generation_result["error"]
+            output_ids = generation_result["output_ids"]
 
         logging.info(f"Generated output IDs shape: {output_ids.shape}")
 
@@ -539,7 +599,8 @@ def http_gen_edit_bot(state, temperature, top_k, top_p, max_output_tokens,
             semantic_code_list = [checked_embed_inds[0]]  # Batch size 1
             texture_code_list = [checked_embed_inds[1]]  # Batch size 1
 
-            with torch.inference_mode() and torch.cuda.amp.autocast(dtype=eval_model.torch_dtype):
+            # the decoders are shared by the sessions, the diffusion pipeline is not thread safe
+            with model_lock, torch.inference_mode() and torch.cuda.amp.autocast(dtype=eval_model.torch_dtype):
                 semantic_code = torch.as_tensor(semantic_code_list).to(eval_model.vq_device)
                 texture_code = torch.as_tensor(texture_code_list).to(eval_model.vq_device)
 
@@ -926,6 +987,12 @@ if __name__ == "__main__":
                         help="Path to Tokenizer config file (e.g., tokenizer_config.py).")
     parser.add_argument("--tokenizer_checkpoint", type=str, default=None,
                         help="Path to VQ Tokenizer checkpoint (.pth).")
+    parser.add_argument("--image_feature_cache_mb", type=int, default=1024,
+                        help="GPU memory for the features of the images encoded in previous turns, 0 to disable.")
+    parser.add_argument("--continuous_batching", action="store_true",
+                        help="Generate the images of all sessions in one shared decode batch.")
+    parser.add_argument("--max_batch_rows", type=int, default=16,
+                        help="Rows of the continuous batching decode batch, a request with CFG takes two.")
 
     # --- End ILLUME arguments ---
     parser.add_argument("--share", action="store_true", help="Create a public Gradio share link")
@@ -999,6 +1066,9 @@ if __name__ == "__main__":
         if hasattr(eval_model, 'diffusion_decoder_pipe') and eval_model.diffusion_decoder_pipe:
             eval_model.diffusion_decoder_pipe.to(diffusion_device)  # Move the whole pipeline
 
+        # Images are sent again with every turn of a conversation, encode each of them once
+        eval_model.mllm_model.enable_image_feature_cache(max_bytes=args.image_feature_cache_mb * 1024 ** 2)
+
         # Assign device to eval_model for later use
         eval_model.device = device
         eval_model.mllm_device = mllm_device
@@ -1006,7 +1076,9 @@ if __name__ == "__main__":
         eval_model.diffusion_device = diffusion_device
         eval_model.local_rank = local_rank
 
-        streamer = TextIteratorStreamer(eval_model.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
+        if args.continuous_batching:
+            engine = eval_model.build_continuous_batching_engine(max_batch_rows=args.max_batch_rows,
+                                                                 model_lock=model_lock).start()
 
         logging.info("ILLUME model built successfully.")
 
@@ -1017,6 +1089,8 @@ if __name__ == "__main__":
 
     demo = build_demo(args.embed)
     demo.queue(
+        # with the engine, the sessions run concurrently and share its decode batch
+        concurrency_count=args.max_batch_rows // 2 if args.continuous_batching else 1,
         max_size=10,
         api_open=False
     ).launch(
@@ -3,7 +3,7 @@ import os
 import traceback
 import logging
 from functools import partial
-from threading import Thread
+from threading import Lock, Thread
 
 import re  # Added for parsing image tokens
 
@@ -23,12 +23,17 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 import gradio as gr
 
 from illume.conversation import default_conversation, conv_templates, SeparatorStyle
+from illume.mm_utils import VisionTokenMapper
+from illume.data.data_utils import calculate_image_token_num
+from generation_eval.models.continuous_batching import ContinuousBatchingEngine, ImageGenerationRequest
 # from conversation import default_conversation, conv_templates, SeparatorStyle
 
 # --- Global Variables and Model Loading ---
 model = None  # Global variable to hold the loaded ILLUME model
 args = None  # Global variable to hold command line args
-streamer = None  # Global variable to hold command line args
+engine = None  # ContinuousBatchingEngine shared by all sessions, enabled with --continuous_batching
+# every forward of the models runs under this lock: the engine steps, the `generate` calls and the image decoding
+model_lock = Lock()
 
 DEFAULT_IMAGE_TOKEN = '<image>'
 
@@ -174,11 +179,18 @@ def add_text(state, text, image, mode):
 
 
 def stream_response(model, inputs, streamer, prompt, gen_kwargs):
-    thread = Thread(target=model.generate, kwargs=dict(
-        streamer=streamer,
-        **inputs,
-        **gen_kwargs
-    ))
+    generation_result = {}
+
+    def run_generate():
+        # the generation thread holds the lock, the text is streamed to the session without it
+        try:
+            with model_lock:
+                model.generate(streamer=streamer, **inputs, **gen_kwargs)
+        except BaseException as e:
+            generation_result["error"] = e
+            streamer.end()
+
+    thread = Thread(target=run_generate)
     thread.start()
 
     generated_text = prompt
@@ -186,11 +198,14 @@ def stream_response(model, inputs, streamer, prompt, gen_kwargs):
     for new_text in streamer:
         generated_text += new_text
         yield generated_text
+    thread.join()
+    if "error" in generation_result:
+        raise generation_result["error"]
 
 
 # @spaces.GPU
 def http_chat_bot(state, temperature, top_k, top_p, max_new_tokens):
-    global model, args, streamer  # Use global model and args
+    global model, args  # Use global model and args
     logging.info("http_chat_bot.")
 
     if state.skip_next:
@@ -252,7 +267,9 @@ def http_chat_bot(state, temperature, top_k, top_p, max_new_tokens):
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 2
 
-    # Stream output
+    # Stream output, with a streamer per request as the sessions run concurrently. It waits without timeout, the
+    # generation may wait for the model lock and ends the streamer on errors.
+    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
     try:
         for generated_text in stream_response(model, inputs, streamer, prompt, gen_kwargs):
             output = generated_text[len(prompt):].strip()
@@ -396,15 +413,30 @@ def http_gen_edit_bot(state, temperature, top_k, top_p,
     generated_image = None
     generated_text = ""
     try:
-        with torch.inference_mode():  # Ensure no gradients are calculated
-            output_ids = model.generate(
-                **inputs,
-                use_cache=True,
-                **gen_kwargs,
-                **image_gen_kwargs,
-                pad_token_id = processor.tokenizer.pad_token_id,
-                eos_token_id = processor.tokenizer.eos_token_id,
+        if engine is not None and not len(all_images):
+            # The request joins the decode batch of the engine next to the requests of the other sessions.
+            # Editing stays on `model.generate`, the engine prefills images the way of the ILLUME codebase model.
+            _, _, h1, w1, h2, w2 = calculate_image_token_num(*target_image_resolution)
+            request = ImageGenerationRequest(
+                input_ids=inputs.input_ids[0],
+                image_token_layout=(h1, w1, h2, w2),
+                uncond_input_ids=uncond_inputs.input_ids[0],
+                guidance_scale=llm_cfg_scale,
+                do_sample=temperature > 0,
+                level0_temp=image_gen_temperature, level0_top_k=image_gen_top_k, level0_top_p=image_gen_top_p,
+                level1_temp=image_gen_temperature, level1_top_k=image_gen_top_k * 3, level1_top_p=image_gen_top_p,
             )
+            output_ids = torch.tensor([engine.submit(request).result()])
+        else:
+            with model_lock, torch.inference_mode():  # Ensure no gradients are calculated
+                output_ids = model.generate(
+                    **inputs,
+                    use_cache=True,
+                    **gen_kwargs,
+                    **image_gen_kwargs,
+                    pad_token_id = processor.tokenizer.pad_token_id,
+                    eos_token_id = processor.tokenizer.eos_token_id,
+                )
 
             output_ids = output_ids[:, inputs['input_ids'].shape[1]:]
 
@@ -436,9 +468,11 @@ def http_gen_edit_bot(state, temperature, top_k, top_p,
             logging.info("Image tokens found. Attempting detokenization...")
             yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 2
 
-            samples = processor.decode_images(image_embed_inds_list, target_resolution=target_image_resolution,
-                                              use_diffusion=use_diffusion, diffusion_cfg_scale=diffusion_cfg_scale,
-                                              diffusion_num_inference_steps=diffusion_num_inference_steps)
+            # the decoders are shared by the sessions, the diffusion pipeline is not thread safe
+            with model_lock:
+                samples = processor.decode_images(image_embed_inds_list, target_resolution=target_image_resolution,
+                                                  use_diffusion=use_diffusion, diffusion_cfg_scale=diffusion_cfg_scale,
+                                                  diffusion_num_inference_steps=diffusion_num_inference_steps)
             generated_image = samples[0]
             if use_diffusion:
                 logging.info(
@@ -797,6 +831,10 @@ if __name__ == "__main__":
     parser.add_argument("--share", action="store_true", help="Create a public Gradio share link")
     parser.add_argument("--embed", action="store_true", help="Run in embed mode (minimal UI)")
     parser.add_argument("--device", type=str, default="cuda", help="Device to run on (cuda, cpu).")
+    parser.add_argument("--continuous_batching", action="store_true",
+                        help="Generate the images of all sessions in one shared decode batch.")
+    parser.add_argument("--max_batch_rows", type=int, default=16,
+                        help="Rows of the continuous batching decode batch, a request with CFG takes two.")
 
     args = parser.parse_args()
 
@@ -863,12 +901,29 @@ if __name__ == "__main__":
     processor.load_diffusion_vision_detokenizer(args.diffusion_decoder_path, device=diffusion_device)
 
     # Assign device to model for later use
-    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
+    if args.continuous_batching:
+        vision_tokens = VisionTokenMapper(processor.tokenizer)
+        engine_special_tokens = {
+            "start_of_image": vision_tokens.start_of_image,
+            "end_of_image": vision_tokens.end_of_image,
+            "start_of_level0": vision_tokens.start_of_level[0],
+            "end_of_level0": vision_tokens.end_of_level[0],
+            "start_of_level1": vision_tokens.start_of_level[1],
+            "end_of_level1": vision_tokens.end_of_level[1],
+            "end_of_line": vision_tokens.end_of_line,
+            "end_of_text": processor.tokenizer.eos_token_id,
+        }
+        pad_token_id = processor.tokenizer.pad_token_id if processor.tokenizer.pad_token_id is not None \
+            else processor.tokenizer.eos_token_id
+        engine = ContinuousBatchingEngine(model, engine_special_tokens, *vision_tokens.level_ranges, pad_token_id,
+                                          max_batch_rows=args.max_batch_rows, model_lock=model_lock).start()
 
     logging.info("ILLUME model built successfully.")
 
     demo = build_demo(args.embed)
     demo.queue(
+        # with the engine, the sessions run concurrently and share its decode batch
+        concurrency_count=args.max_batch_rows // 2 if args.continuous_batching else 1,
         max_size=10,
         api_open=False
     ).launch(
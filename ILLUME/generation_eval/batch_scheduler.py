@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+def build_bucketed_batches(indices, get_bucket, batch_size, max_batch_tokens=None):
+    """
+    Groups sample indices into batches that can be generated together.
+
+    Samples are grouped by the bucket key returned by `get_bucket(idx) -> (key, num_tokens)`, e.g.
+    `(task, (h, w))` of the generated image, so that every batch shares one image token layout. Each group is
+    then split into batches of at most `batch_size` samples and, if given, `max_batch_tokens` tokens. Groups
+    keep the order in which they first appear and samples keep their order inside a group.
+
+    Args:
+        indices (list): Sample indices.
+        get_bucket (callable): Returns the bucket key and the number of generated tokens of a sample.
+            A key of `None` puts the sample in a batch of its own.
+        batch_size (int): Max number of samples per batch.
+        max_batch_tokens (int, *optional*): Max sum of the generated tokens of a batch.
+
+    Returns:
+        list of (key, list of indices)
+    """
+    groups = OrderedDict()
+    for idx in indices:
+        key, num_tokens = get_bucket(idx)
+        if key is None:
+            key = ("unbatched", idx)
+        groups.setdefault(key, []).append((idx, num_tokens))
+
+    batches = []
+    for key, samples in groups.items():
+        batch, batch_tokens = [], 0
+        for idx, num_tokens in samples:
+            exceeds_budget = max_batch_tokens is not None and batch_tokens + num_tokens > max_batch_tokens
+            if batch and (len(batch) >= batch_size or exceeds_budget):
+                batches.append((key, batch))
+                batch, batch_tokens = [], 0
+            batch.append(idx)
+            batch_tokens += num_tokens
+        if batch:
+            batches.append((key, batch))
+    return batches
@@ -57,6 +57,20 @@ class DefaultDataset(Dataset):
     def get_role(self):
         return self.role
 
+    def get_input_image_sizes(self, idx):
+        """(w, h) of the input images of a sample, read from the image headers only."""
+        info = self.annotations[idx]
+        if "input_image_path" not in info:
+            return []
+        image_paths = info["input_image_path"]
+        if isinstance(image_paths, str):
+            image_paths = [image_paths]
+        image_sizes = []
+        for cur_image_path in image_paths:
+            with Image.open(os.path.join(self.image_dir, cur_image_path)) as image:
+                image_sizes.append(image.size)
+        return image_sizes
+
     def __len__(self):
         return len(self.annotations)
 
@@ -5,9 +5,11 @@ from tqdm import tqdm
 import numpy as np
 from PIL import Image
 import itertools
+from functools import partial
 
-from illume.data.data_utils import write_to_jsonl, unpad_and_resize_back
+from illume.data.data_utils import write_to_jsonl, unpad_and_resize_back, calculate_image_token_num
 
+from generation_eval.batch_scheduler import build_bucketed_batches
 from generation_eval.generation_dataset.builder import build_eval_dataset
 from generation_eval.models.builder import build_eval_model
 
@@ -65,7 +67,8 @@ def main_inference(args):
         diffusion_decoder_path=args.diffusion_decoder_path,
         tokenizer_checkpoint=args.tokenizer_checkpoint,
         torch_dtype=args.torch_dtype,
-        seed=args.seed
+        seed=args.seed,
+        prefix_cache_mb=args.prefix_cache_mb
     )
     eval_model = build_eval_model(eval_model_cfg)
 
@@ -76,6 +79,9 @@ def main_inference(args):
         top_p=args.top_p,
         llm_cfg_scale=args.llm_cfg_scale,
         diffusion_cfg_scale=args.diffusion_cfg_scale,
+        cfg_mode=args.cfg_mode,
+        decode_batch_size=args.decode_batch_size,
+        decoder_mode=args.decoder_mode,
     )
 
     rank0_print(f"temperature: {inference_config.temperature}")
@@ -83,6 +89,9 @@ def main_inference(args):
     rank0_print(f"top_p: {inference_config.top_p}")
     rank0_print(f"llm_cfg_scale: {inference_config.llm_cfg_scale}")
     rank0_print(f"diffusion_cfg_scale: {inference_config.diffusion_cfg_scale}")
+    rank0_print(f"cfg_mode: {inference_config.cfg_mode}")
+    rank0_print(f"decode_batch_size: {inference_config.decode_batch_size}")
+    rank0_print(f"decoder_mode: {inference_config.decoder_mode}")
     rank0_print(f"image_semantic_temperature: {inference_config.image_semantic_temperature}")
     rank0_print(f"image_semantic_top_k: {inference_config.image_semantic_top_k}")
     rank0_print(f"image_semantic_top_p: {inference_config.image_semantic_top_p}")
@@ -118,22 +127,46 @@ def main_inference(args):
             rank0_print(f"result_image_diffusion_dir, {result_image_diffusion_dir}")
 
             select_data_index = [i for i in range(len(val_dataset))][rank::world_size]
-            batch_index_list = [select_data_index[i:i + args.batch_size] for i in
-                                range(0, len(select_data_index), args.batch_size)]
 
-            llm_outputs = []
-            for batch_index in tqdm(batch_index_list, disable=(local_rank != 0)):
+            def get_bucket(idx, resolution=resolution):
+                # samples are batched by task and generated image size, which fixes the image token layout.
+                input_image_sizes = val_dataset.get_input_image_sizes(idx)
+                target_resolution = eval_model.get_target_resolution(resolution, input_image_sizes)
+                if target_resolution is None:
+                    return None, 0
+                _, max_new_tokens, _, _, _, _ = calculate_image_token_num(*target_resolution)
+                task = "editing" if input_image_sizes else "generation"
+                return (task, target_resolution), max_new_tokens
+
+            batch_index_list = build_bucketed_batches(select_data_index, get_bucket, args.batch_size,
+                                                      max_batch_tokens=args.max_batch_tokens)
+
+            # the async decoder mode saves the diffusion images from the worker, once they are decoded.
+            save_diffusion_images = partial(save_output_images, output_dir=os.path.join(
+                eval_model.output_dir, "generation_eval", result_image_diffusion_dir))
+
+            outputs_by_index = {}
+            for _, batch_index in tqdm(batch_index_list, disable=(local_rank != 0)):
                 batch_data = [val_dataset.__getitem__(idx) for idx in batch_index]
 
-                output = eval_model.get_one_batch_results(batch_data, inference_config)
-                llm_outputs.extend(output["batch_llm_output"])
+                # inference_mllm overwrites the resolution of editing samples with the one of the batch.
+                inference_config.resolution = resolution
+                output = eval_model.get_one_batch_results(batch_data, inference_config,
+                                                          diffusion_callback=save_diffusion_images)
+                outputs_by_index.update(zip(batch_index, output["batch_llm_output"]))
 
                 # save output images
-                save_output_images(output["out_images_tokenizer"], output["batch_llm_output"],
-                                   os.path.join(eval_model.output_dir, "generation_eval", result_image_dir))
-                                   
-                save_output_images(output["out_images_diffusion"], output["batch_llm_output"],
-                                   os.path.join(eval_model.output_dir, "generation_eval", result_image_diffusion_dir))
+                if output["out_images_tokenizer"] is not None:
+                    save_output_images(output["out_images_tokenizer"], output["batch_llm_output"],
+                                       os.path.join(eval_model.output_dir, "generation_eval", result_image_dir))
+
+                if output["out_images_diffusion"] is not None:
+                    save_diffusion_images(output["out_images_diffusion"], output["batch_llm_output"])
+
+            eval_model.wait_diffusion_decoder()
+
+            # keep the sample order of the dataset in the jsonl
+            llm_outputs = [outputs_by_index[idx] for idx in select_data_index]
 
             if world_size > 1:
                 torch.distributed.barrier()
@@ -147,11 +180,13 @@ def main_inference(args):
             else:
                 merged_outputs = llm_outputs
             if local_rank == 0:
-                print(f"VQ decoded images saved in "
-                      f"{os.path.abspath(os.path.join(eval_model.output_dir, 'generation_eval', result_image_dir))}")
+                if inference_config.decoder_mode != "diffusion":
+                    print(f"VQ decoded images saved in "
+                          f"{os.path.abspath(os.path.join(eval_model.output_dir, 'generation_eval', result_image_dir))}")
 
-                print(f"Diffusion decoded images saved in "
-                      f"{os.path.abspath(os.path.join(eval_model.output_dir, 'generation_eval', result_image_diffusion_dir))}")
+                if inference_config.decoder_mode != "vq":
+                    print(f"Diffusion decoded images saved in "
+                          f"{os.path.abspath(os.path.join(eval_model.output_dir, 'generation_eval', result_image_diffusion_dir))}")
 
                 write_to_jsonl(merged_outputs,
                                os.path.join(eval_model.output_dir, "generation_eval", result_jsonl_file))
@@ -163,8 +198,10 @@ if __name__ == "__main__":
     parser.add_argument("--mllm_config", type=str, default=None)
     parser.add_argument("--tokenizer_config", type=str, default=None)
     parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_batch_tokens", type=int, default=None)  # max generated tokens per batch
     parser.add_argument("--torch_dtype", type=str, default='fp32')
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--prefix_cache_mb", type=int, default=256)  # 0 disables the prompt prefix KV cache
     #
     parser.add_argument("--diffusion_decoder_path", type=str, default="<diffusion_decoder_model_path>")
     parser.add_argument("--tokenizer_checkpoint", type=str, default="<tokenzier_checkpoint>")
@@ -175,6 +212,9 @@ if __name__ == "__main__":
     parser.add_argument("--top_p", type=float, default=1.0)
     parser.add_argument("--llm_cfg_scale", type=float, default=2.0)
     parser.add_argument("--diffusion_cfg_scale", type=float, default=2.0)
+    parser.add_argument("--cfg_mode", type=str, default="batched")  # batched, separate
+    parser.add_argument("--decode_batch_size", type=int, default=8)
+    parser.add_argument("--decoder_mode", type=str, default="both")  # vq, diffusion, both, vq-then-diffusion-async
     parser.add_argument("--resolution", type=int, default=512)
     parser.add_argument("--resolution_type", type=str, default="fixed_anchors")  # fixed, fixed_anchors
     args = parser.parse_args()
@@ -0,0 +1,369 @@
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers.cache_utils import DynamicCache
+
+from .guided_generation import BatchedCFGGenerator, build_image_token_layout
+from .inference_utils import ImageGrammarMaskTable, _apply_batched_sampling
+
+
+@dataclass
+class ImageGenerationRequest:
+    """
+    One text-to-image or editing request for `ContinuousBatchingEngine`.
+
+    `input_ids` / `uncond_input_ids` are the unpadded prompt token ids, already ending with the resolution tag.
+    `image_token_layout` is `(h1, w1, h2, w2)` from `calculate_image_token_num`. The generated tokens are
+    `<start_of_image> ... <end_of_image>` following that layout.
+    """
+    input_ids: torch.LongTensor
+    image_token_layout: Tuple[int, int, int, int]
+    uncond_input_ids: Optional[torch.LongTensor] = None
+    guidance_scale: float = 1.0
+    images: Any = None
+    image_sizes: Any = None
+    do_sample: bool = True
+    level0_temp: float = 1.0
+    level0_top_k: int = 0
+    level0_top_p: float = 1.0
+    level1_temp: float = 1.0
+    level1_top_k: int = 0
+    level1_top_p: float = 1.0
+
+    @classmethod
+    def from_dict(cls, payload):
+        payload = dict(payload)
+        payload["input_ids"] = torch.as_tensor(payload["input_ids"], dtype=torch.long)
+        if payload.get("uncond_input_ids") is not None:
+            payload["uncond_input_ids"] = torch.as_tensor(payload["uncond_input_ids"], dtype=torch.long)
+        payload["image_token_layout"] = tuple(payload["image_token_layout"])
+        return cls(**payload)
+
+
+class _ActiveRequest:
+    def __init__(self, request, future, layout_states):
+        self.request = request
+        self.future = future
+        self.layout_states = layout_states  # [layout_len] `ImageGrammarMaskTable` state of every position
+        self.generated = []
+        self.num_rows = _num_request_rows(request)
+
+    @property
+    def finished(self):
+        return len(self.generated) == len(self.layout_states)
+
+
+def _num_request_rows(request):
+    # the unconditional branch only exists with guidance
+    return 2 if request.uncond_input_ids is not None and request.guidance_scale != 1 else 1
+
+
+def _cat_left_padded(cache_a, mask_a, cache_b, mask_b):
+    """Stacks two left-padded legacy caches of different lengths along the batch dimension."""
+    length = max(mask_a.shape[1], mask_b.shape[1])
+
+    def pad(x, dim):
+        missing = length - x.shape[dim]
+        if missing == 0:
+            return x
+        shape = list(x.shape)
+        shape[dim] = missing
+        return torch.cat([x.new_zeros(shape), x], dim=dim)
+
+    cache = tuple((torch.cat([pad(k_a, 2), pad(k_b, 2)]), torch.cat([pad(v_a, 2), pad(v_b, 2)]))
+                  for (k_a, v_a), (k_b, v_b) in zip(cache_a, cache_b))
+    return cache, torch.cat([pad(mask_a, 1), pad(mask_b, 1)])
+
+
+def _select_rows(cache, mask, rows):
+    """Keeps `rows` of a left-padded legacy cache and drops the leading columns that became pure padding."""
+    mask = mask[rows]
+    first_column = int(mask.any(dim=0).long().argmax())
+    mask = mask[:, first_column:]
+    cache = tuple((k[rows, :, first_column:], v[rows, :, first_column:]) for k, v in cache)
+    return cache, mask
+
+
+class ContinuousBatchingEngine:
+    """
+    Continuous batching of image generation requests around `IllumeQwen2ForCausalLM`.
+
+    All running requests share one decode batch and one KV cache. New requests are prefilled and merged into
+    the running batch between two decode steps, and a request leaves the batch as soon as it emits
+    `<end_of_image>`. Every request keeps its own CFG branch (an extra unconditional row), its own image
+    token layout and its own sampling parameters, so requests of different resolutions and tasks can run
+    together.
+
+    `submit` is thread safe and returns a `concurrent.futures.Future` with the generated token ids. The
+    engine is driven either by calling `step` / `run_until_idle` or by the background thread of `start`, which
+    runs every step under `model_lock`.
+
+    Args:
+        model: The `IllumeQwen2ForCausalLM`, or any causal LM with the same call signature.
+        special_tokens (dict): The special token dict used by the logits processors.
+        level0_range, level1_range (tuple): Token id ranges of the semantic and pixel codes.
+        pad_token_id (int): Token used for left padding.
+        max_batch_rows (int): Max number of rows (conditional + unconditional) in the running batch.
+        prefix_cache (PrefixKVCache, *optional*): Reuses the prefill of shared prompt prefixes.
+        model_lock (`threading.Lock`, *optional*): Held by the background thread during every step. Pass the lock
+            of the other code running the same model, e.g. `model.generate` calls, so that their forwards do not
+            run concurrently with the steps.
+    """
+
+    def __init__(self, model, special_tokens, level0_range, level1_range, pad_token_id, max_batch_rows=32,
+                 prefix_cache=None, model_lock=None):
+        self.model = model
+        self.model_lock = model_lock if model_lock is not None else threading.Lock()
+        self.special_tokens = special_tokens
+        self.level0_range = level0_range
+        self.level1_range = level1_range
+        self.max_batch_rows = max_batch_rows
+        self.generator = BatchedCFGGenerator(model, 1.0, special_tokens, pad_token_id, prefix_cache=prefix_cache)
+        self.mask_table = None
+        self._layout_states_cache = {}
+
+        self.pending = queue.Queue()
+        self._next_pending = None  # taken from `pending`, waits until its rows fit in the batch
+        self.active = []  # running requests, each owns `num_rows` consecutive rows of the batch
+        self.logits = None  # [num_rows, vocab_size] next-token logits of the running rows
+        self.past_key_values = None  # legacy cache of the running rows
+        self.attention_mask = None
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, request: ImageGenerationRequest):
+        future = Future()
+        self.pending.put((request, future))
+        self._wakeup.set()
+        return future
+
+    @property
+    def num_rows(self):
+        return sum(active.num_rows for active in self.active)
+
+    def _get_mask_table(self, vocab_size, device):
+        if self.mask_table is None or self.mask_table.vocab_size != vocab_size:
+            self.mask_table = ImageGrammarMaskTable.get(self.level0_range, self.level1_range, self.special_tokens,
+                                                        vocab_size, device=device)
+        return self.mask_table
+
+    def _get_layout_states(self, image_token_layout, table):
+        if image_token_layout not in self._layout_states_cache:
+            forced_keys = {self.special_tokens[key]: key for key in ImageGrammarMaskTable.FORCED_KEYS}
+            states, level = [], 0
+            for token in build_image_token_layout(self.special_tokens, *image_token_layout).tolist():
+                if token == self.special_tokens["start_of_level1"]:
+                    level = 1
+                if token >= 0:
+                    states.append(table.forced(forced_keys[token]))
+                else:
+                    states.append(ImageGrammarMaskTable.LEVEL0_CODES if level == 0
+                                  else ImageGrammarMaskTable.LEVEL1_CODES)
+            self._layout_states_cache[image_token_layout] = states
+        return self._layout_states_cache[image_token_layout]
+
+    def _prefill(self, request):
+        device = self.model.device
+        input_ids = request.input_ids.to(device)[None]
+        uncond_input_ids = None
+        if request.uncond_input_ids is not None and request.guidance_scale != 1:
+            uncond_input_ids = request.uncond_input_ids.to(device)[None]
+        stacked_ids, stacked_mask = self.generator.stack_branches(input_ids, None, uncond_input_ids)
+        logits, past_key_values, attention_mask = self.generator.prefill(
+            stacked_ids, stacked_mask, request.images, request.image_sizes,
+            num_branches=1 if uncond_input_ids is None else 2)
+        return logits.float(), past_key_values.to_legacy_cache(), attention_mask
+
+    def _admit(self):
+        while True:
+            if self._next_pending is None:
+                try:
+                    self._next_pending = self.pending.get_nowait()
+                except queue.Empty:
+                    return
+            request, future = self._next_pending
+            # a request that does not fit waits for running ones to retire, unless the batch is empty
+            if self.active and self.num_rows + _num_request_rows(request) > self.max_batch_rows:
+                return
+            self._next_pending = None
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                logits, past_key_values, attention_mask = self._prefill(request)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            table = self._get_mask_table(logits.shape[-1], logits.device)
+            self.active.append(_ActiveRequest(request, future,
+                                              self._get_layout_states(request.image_token_layout, table)))
+            if self.logits is None:
+                self.logits, self.past_key_values, self.attention_mask = logits, past_key_values, attention_mask
+            else:
+                self.logits = torch.cat([self.logits, logits])
+                self.past_key_values, self.attention_mask = _cat_left_padded(
+                    self.past_key_values, self.attention_mask, past_key_values, attention_mask)
+
+    def _sample(self):
+        """Samples the next token of every running request from the guided, grammar-masked scores."""
+        device = self.logits.device
+        table = self._get_mask_table(self.logits.shape[-1], device)
+
+        cond_rows, uncond_rows, row = [], [], 0
+        for active in self.active:
+            cond_rows.append(row)
+            uncond_rows.append(row + active.num_rows - 1)
+            row += active.num_rows
+        requests = [active.request for active in self.active]
+        state = torch.tensor([active.layout_states[len(active.generated)] for active in self.active], device=device)
+        guidance_scale = torch.tensor([r.guidance_scale for r in requests], device=device).unsqueeze(-1)
+
+        cond_log_probs = F.log_softmax(self.logits[cond_rows], dim=-1)
+        uncond_log_probs = F.log_softmax(self.logits[uncond_rows], dim=-1)
+        scores = guidance_scale * (cond_log_probs - uncond_log_probs) + uncond_log_probs
+        scores = scores.masked_fill(table.disallowed[state], -float("Inf"))
+
+        level1 = state == ImageGrammarMaskTable.LEVEL1_CODES
+        params = {}
+        for name in ["temp", "top_k", "top_p"]:
+            level0_values = [getattr(r, f"level0_{name}") for r in requests]
+            level1_values = [getattr(r, f"level1_{name}") for r in requests]
+            params[name] = torch.where(level1, torch.tensor(level1_values, device=device),
+                                       torch.tensor(level0_values, device=device))
+        scores = _apply_batched_sampling(
+            scores, params["temp"], params["top_k"], params["top_p"],
+            max_top_k=max(max(r.level0_top_k, r.level1_top_k) for r in requests),
+            min_top_p=min(min(r.level0_top_p, r.level1_top_p) for r in requests))
+
+        sampled = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        do_sample = torch.tensor([r.do_sample for r in requests], device=device)
+        return torch.where(do_sample, sampled, scores.argmax(dim=-1))
+
+    @torch.no_grad()
+    def step(self):
+        """Admits pending requests, generates one token for every running request and retires finished ones.
+
+        Returns False if there was nothing to do."""
+        self._admit()
+        if not self.active:
+            return False
+
+        next_tokens = self._sample()
+        for active, token in zip(self.active, next_tokens.tolist()):
+            active.generated.append(token)
+
+        keep_rows, row = [], 0
+        for active in self.active:
+            if not active.finished:
+                keep_rows += range(row, row + active.num_rows)
+            row += active.num_rows
+        step_ids = next_tokens.repeat_interleave(torch.tensor([active.num_rows for active in self.active],
+                                                              device=next_tokens.device))
+
+        for active in self.active:
+            if active.finished:
+                active.future.set_result(active.generated)
+        self.active = [active for active in self.active if not active.finished]
+        if not self.active:
+            self.logits = self.past_key_values = self.attention_mask = None
+            return True
+
+        if len(keep_rows) < step_ids.shape[0]:
+            keep_rows = torch.tensor(keep_rows, device=step_ids.device)
+            step_ids = step_ids[keep_rows]
+            self.past_key_values, self.attention_mask = _select_rows(self.past_key_values, self.attention_mask,
+                                                                     keep_rows)
+
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((step_ids.shape[0], 1))],
+                                        dim=-1)
+        logits, past_key_values = self.generator.decode_step(step_ids[:, None], self.attention_mask,
+                                                             DynamicCache.from_legacy_cache(self.past_key_values))
+        self.logits = logits.float()
+        self.past_key_values = past_key_values.to_legacy_cache()
+        return True
+
+    def run_until_idle(self):
+        while self.step():
+            pass
+
+    def _fail_all(self, exception):
+        for active in self.active:
+            active.future.set_exception(exception)
+        self.active = []
+        self.logits = self.past_key_values = self.attention_mask = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with self.model_lock:
+                    busy = self.step()
+            except Exception as e:
+                logging.exception("Continuous batching step failed.")
+                self._fail_all(e)
+                busy = False
+            if not busy:
+                self._wakeup.wait(timeout=0.1)
+                self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="continuous-batching", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+
+def serve_engine(engine, host="127.0.0.1", port=8000, request_builder=None, timeout=None):
+    """
+    Starts `engine` and returns a `ThreadingHTTPServer` for it, run it with `serve_forever()`.
+
+    `POST /generate` takes the fields of `ImageGenerationRequest` as JSON (or any payload understood by
+    `request_builder`, e.g. a prompt) and returns `{"output_ids": [...]}` once the request is finished.
+    """
+    request_builder = request_builder or ImageGenerationRequest.from_dict
+
+    class EngineRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                output_ids = engine.submit(request_builder(payload)).result(timeout=timeout)
+            except Exception as e:
+                logging.exception("Generation request failed.")
+                self._send_json(500, {"error": str(e)})
+                return
+            self._send_json(200, {"output_ids": output_ids})
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), EngineRequestHandler)
+    engine.start()
+    return server
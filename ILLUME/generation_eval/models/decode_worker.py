@@ -0,0 +1,79 @@
+import queue
+import threading
+
+import torch
+
+
+class BackgroundDecodePool:
+    """
+    Runs image decoding jobs in background threads, so that the LLM can generate the next batch meanwhile.
+
+    Jobs are taken from a bounded queue in submission order. `submit` blocks once `max_pending` jobs are
+    waiting, which bounds the memory held by the undecoded outputs. When a job finishes, its callback is called
+    from the worker thread with the result. The first exception raised by a job or a callback is re-raised by
+    the next `submit` or `join`.
+
+    On GPU every worker launches its kernels on its own CUDA stream, so that they can overlap with the LLM
+    forward passes on the default stream.
+
+    Args:
+        num_workers (int): Number of worker threads. Use more than one only if the decode function is thread
+            safe, e.g. the diffusers pipelines keep the scheduler state on the pipeline object.
+        max_pending (int): Max number of queued jobs.
+    """
+
+    def __init__(self, num_workers=1, max_pending=4):
+        self.job_queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self._error_lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._worker_loop, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _worker_loop(self):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        while True:
+            job = self.job_queue.get()
+            try:
+                if job is None:
+                    return
+                fn, callback = job
+                if self.error is not None:
+                    continue  # a previous job failed, drop the remaining ones
+                try:
+                    if stream is not None:
+                        with torch.cuda.stream(stream):
+                            result = fn()
+                        stream.synchronize()
+                    else:
+                        result = fn()
+                    if callback is not None:
+                        callback(result)
+                except BaseException as e:
+                    with self._error_lock:
+                        if self.error is None:
+                            self.error = e
+            finally:
+                self.job_queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, callback=None):
+        """Queues `callback(fn())`."""
+        self._raise_error()
+        self.job_queue.put((fn, callback))
+
+    def join(self):
+        """Waits for all queued jobs to finish."""
+        self.job_queue.join()
+        self._raise_error()
+
+    def shutdown(self):
+        self.join()
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
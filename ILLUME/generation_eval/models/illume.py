@@ -1,25 +1,29 @@
 import torch
 import os
-import re
 import numpy as np
 from transformers import LogitsProcessorList, set_seed
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import Optional, Tuple, Any
 
 from .builder import EVAL_MODELS
-from .inference_utils import CFGLogits, DualVQImageTokenProcessor, DynamicSamplingProcessor, InterleavedLogitsProcessor
+from .inference_utils import CFGLogits, DualVQImageTokenProcessor, DynamicSamplingProcessor, InterleavedLogitsProcessor, \
+    ImageGrammarMaskTable
+from .guided_generation import BatchedCFGGenerator
+from .continuous_batching import ContinuousBatchingEngine, ImageGenerationRequest
+from .prefix_cache import PrefixKVCache
+from .decode_worker import BackgroundDecodePool
 
 from illume.constants import IMAGE_TOKEN_INDEX
 from illume.conversation import conv_templates
 from illume.data.aspect_ratio_utils import RATIOS, AspectRatioCrop
-from illume.data.data_utils import unpad_and_resize_back
+from illume.data.data_utils import unpad_and_resize_back, calculate_image_token_num
 from illume.model.builder import load_pretrained_model
-from illume.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token
+from illume.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token_batch, \
+    PromptChunkCache, VisionTokenMapper
 
 from utils.registry_utils import read_config
 
 from tokenizer.builder import build_vq_model
-from tokenizer.dualvitok_model import RESOLUTION_MAPPING
 
 
 @dataclass
@@ -43,6 +47,13 @@ class InferenceConfig:
     resolution: Optional[Tuple[int, int]] = None
     unconditional_prompt: Optional[Any] = None
     max_new_tokens: Optional[int] = None  # Added max_new_tokens
+    # 'batched' runs the conditional and unconditional CFG branches as one stacked batch,
+    # 'separate' runs the unconditional branch inside the logits processor.
+    cfg_mode: str = "batched"
+    decode_batch_size: int = 8  # micro batch size of the image decoders
+    # 'vq', 'diffusion', 'both' or 'vq-then-diffusion-async', which decodes the VQ images with the batch and
+    # leaves the diffusion decoding to a background worker.
+    decoder_mode: str = "both"
 
     def __post_init__(self):
         if self.image_semantic_temperature is None:
@@ -60,6 +71,9 @@ class InferenceConfig:
             self.image_pixel_top_p = self.image_semantic_top_p
 
 
+DECODER_MODES = ("vq", "diffusion", "both", "vq-then-diffusion-async")
+
+
 # qwen2.5
 special_tokens_ids = [151665, 151666, 151667, 151668, 151669, 151670, 151671]
 start_token = 151672 + 32
@@ -88,23 +102,6 @@ def rank0_print(content):
         print(content)
 
 
-def calculate_image_token_num(h, w, downsample_rate_per_level=[28, 16]):
-    # Level‑0 ─ Semantic tokens
-    mapped_w, mapped_h = RESOLUTION_MAPPING[(w, h)]
-    w1 = mapped_w // downsample_rate_per_level[0]
-    h1 = mapped_h // downsample_rate_per_level[0]
-    semantic_token_num = w1 * h1
-
-    # Level‑1 ─ Pixel tokens
-    w2 = w // downsample_rate_per_level[1]
-    h2 = h // downsample_rate_per_level[1]
-    pixel_token_num = w2 * h2
-
-    # rank0_print(f"semantic_token_num:{semantic_token_num}, pixel_token_num:{pixel_token_num}")
-    max_token_length = (h1 * (w1 + 1) + 2) + (h2 * (w2 + 1) + 2) + 2 + 2 + 1 + 1
-    return [semantic_token_num, pixel_token_num], max_token_length, h1, w1, h2, w2
-
-
 def pad_sequence(tokenizer, input_ids, batch_first, padding_value):
     if tokenizer.padding_side == "left":
         input_ids = [torch.flip(_input_ids, [0]) for _input_ids in input_ids]
@@ -123,6 +120,7 @@ class ILLUME():
                  tokenizer_checkpoint=None,
                  torch_dtype="fp32",
                  seed=42,
+                 prefix_cache_mb=256,
                  **kwargs):
         self.config = read_config(config)
         self.tokenizer_config = read_config(tokenizer_config)
@@ -143,6 +141,13 @@ class ILLUME():
         self.build_mllm_model()
         self.build_detokenizer()
 
+        # prefilled key/value states of the shared prompt prefixes, used by the batched CFG generator.
+        self.prefix_cache = PrefixKVCache(max_bytes=prefix_cache_mb * 1024 ** 2) if prefix_cache_mb > 0 else None
+        # token ids of the templates, resolution tags and unconditional prompts shared by the prompts.
+        self.prompt_chunk_cache = PromptChunkCache()
+        # created on the first batch of the 'vq-then-diffusion-async' decoder mode.
+        self.diffusion_decode_pool = None
+
         self._default_generation_template = "Generate an image of {resolution_tag}, the content of image is {content}\n"
         self._default_generation_unconditional_template = "Generate a random image of {resolution_tag}\n"
 
@@ -181,6 +186,9 @@ class ILLUME():
                                  resolution=None,
                                  unconditional_prompt=None,
                                  max_new_tokens=1024,
+                                 cfg_mode="batched",
+                                 decode_batch_size=8,
+                                 decoder_mode="both",
                                  ):
 
         return InferenceConfig(
@@ -199,6 +207,9 @@ class ILLUME():
             resolution=resolution,
             unconditional_prompt=unconditional_prompt,
             max_new_tokens=max_new_tokens,
+            cfg_mode=cfg_mode,
+            decode_batch_size=decode_batch_size,
+            decoder_mode=decoder_mode,
         )
 
     def build_mllm_model(self):
@@ -232,6 +243,8 @@ class ILLUME():
         self.mllm_model = model
         self.tokenizer = tokenizer
         self.image_processor = image_processor
+        self.vision_token_mapper = VisionTokenMapper(tokenizer,
+                                                     num_levels=self.config.model_args.vision_tokenizer_levels)
         rank0_print("build mllm done")
 
     def build_detokenizer(self):
@@ -279,6 +292,29 @@ class ILLUME():
     def unpad_and_resize_back(self, padded_image, original_width, original_height):
         return unpad_and_resize_back(padded_image, original_width, original_height)
 
+    def get_target_resolution(self, resolution, input_image_sizes=None):
+        """
+        Returns the (h, w) of the image generated for a sample without processing its input images, or None if
+        it cannot be known in advance. It follows `process_images` for editing samples, whose resolution is (-1, -1).
+        """
+        h, w = resolution
+        if h >= 0 and w >= 0:
+            return h, w
+        if not input_image_sizes:
+            return None
+        image_aspect_ratio = getattr(self.config.data_args, "image_aspect_ratio_generation", None)
+        if image_aspect_ratio is None or "anyres_dualvitok" not in image_aspect_ratio:
+            return None
+        if image_aspect_ratio in ["anyres_dualvitok_fix_centercrop", "anyres_dualvitok_fix_resize"]:
+            base_resolution = self.config.data_args.base_resolution
+            return base_resolution, base_resolution
+        if image_aspect_ratio == "anyres_dualvitok_fix_anchors":
+            arc = AspectRatioCrop(RATIOS)
+            pred_w, pred_h, _, _, _ = arc.get_pred_target_w_h(*input_image_sizes[0])
+            return pred_h, pred_w
+        w, h = input_image_sizes[0]
+        return h, w
+
     def prepare_mllm_batch_data(self, batch, is_img_gen_task=True):
         # add system template
         prompts = []
@@ -310,6 +346,7 @@ class ILLUME():
             output["images"] = images
             output["image_sizes"] = image_sizes
             output["original_sizes"] = original_sizes
+            output["num_images"] = [len(b["images_data"]) for b in batch]
 
         for k in batch[0]:
             if k in ['images_data']:
@@ -370,8 +407,16 @@ class ILLUME():
         else:
             h1, w1, h2, w2 = 0, 0, 0, 0
 
+        # without an unconditional branch (or when it is batched outside the processor) CFG is disabled here.
+        guidance_scale = inference_config.llm_cfg_scale if unconditional_input_ids is not None else 1.0
+
+        # the mask table is cached per (vocab, device), so building it for every batch is free after the first one.
+        mask_table = ImageGrammarMaskTable.get(level0_range, level1_range, special_tokens_dict,
+                                               vocab_size=self.mllm_model.get_output_embeddings().weight.shape[0],
+                                               device=self.mllm_model.device)
+
         return [InterleavedLogitsProcessor(
-            guidance_scale=inference_config.llm_cfg_scale,
+            guidance_scale=guidance_scale,
             uncond=unconditional_input_ids,
             model=self.mllm_model,
             level0_range=level0_range,
@@ -386,7 +431,8 @@ class ILLUME():
             default_top_p=inference_config.top_p, level0_top_p=inference_config.image_semantic_top_p,
             level1_top_p=inference_config.image_pixel_top_p,
             images=images,
-            image_sizes=image_sizes
+            image_sizes=image_sizes,
+            mask_table=mask_table
         )]
 
     def prepare_conversation_prompt(self, prompt):
@@ -396,23 +442,105 @@ class ILLUME():
         conv.append_message(conv.roles[1], None)
         return conv.get_prompt()
 
+    def build_continuous_batching_engine(self, max_batch_rows=32, model_lock=None):
+        pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        return ContinuousBatchingEngine(self.mllm_model, special_tokens_dict, level0_range, level1_range,
+                                        pad_token_ids, max_batch_rows=max_batch_rows,
+                                        prefix_cache=self.prefix_cache, model_lock=model_lock)
+
+    def prepare_generation_request(self, caption, resolution, inference_config: InferenceConfig):
+        """Builds the text-to-image `ImageGenerationRequest` of `caption` with the default templates."""
+        h, w = resolution
+        _, _, h1, w1, h2, w2 = calculate_image_token_num(h, w)
+        resolution_tag = self.get_resolution_tag_from_resolution((h, w))
+
+        prompt = self.default_generation_template.format(resolution_tag=resolution_tag, content=caption)
+        prompt = self.prepare_conversation_prompt(prompt) + resolution_tag
+        unconditional_prompt = self.default_generation_unconditional_template.format(resolution_tag=resolution_tag)
+        unconditional_prompt = self.prepare_conversation_prompt(unconditional_prompt) + resolution_tag
+
+        input_ids, uncond_input_ids = tokenizer_image_token_batch([prompt, unconditional_prompt], self.tokenizer,
+                                                                  IMAGE_TOKEN_INDEX, return_tensors="pt",
+                                                                  chunk_cache=self.prompt_chunk_cache)
+        return ImageGenerationRequest(
+            input_ids=input_ids,
+            image_token_layout=(h1, w1, h2, w2),
+            uncond_input_ids=uncond_input_ids,
+            guidance_scale=inference_config.llm_cfg_scale,
+            level0_temp=inference_config.image_semantic_temperature,
+            level0_top_k=inference_config.image_semantic_top_k,
+            level0_top_p=inference_config.image_semantic_top_p,
+            level1_temp=inference_config.image_pixel_temperature,
+            level1_top_k=inference_config.image_pixel_top_k,
+            level1_top_p=inference_config.image_pixel_top_p,
+        )
+
+    @staticmethod
+    def _group_samples_by_target_size(batch_data, inference_config):
+        """
+        Indices of the samples per generated image size (h, w). Without a fixed resolution (anyres editing) a
+        sample is generated at the size of its first input image.
+        """
+        num_samples = len(batch_data["prompts"])
+        resolution = inference_config.resolution
+        if "image_sizes" not in batch_data or (resolution is not None and min(resolution) >= 0):
+            return {resolution: list(range(num_samples))}
+        first_image_indices = np.cumsum([0] + batch_data["num_images"][:-1])
+        groups = {}
+        for i, image_index in enumerate(first_image_indices):
+            w, h = batch_data["image_sizes"][image_index]
+            groups.setdefault((h, w), []).append(i)
+        return groups
+
+    @staticmethod
+    def _select_samples(batch_data, indices):
+        """The prepared batch data of the samples `indices`, with their input images."""
+        image_starts = np.cumsum([0] + batch_data["num_images"])
+        image_indices = [j for i in indices for j in range(image_starts[i], image_starts[i + 1])]
+        selected = {}
+        for k, v in batch_data.items():
+            if k in ["images", "image_sizes", "original_sizes"]:
+                selected[k] = v[image_indices] if torch.is_tensor(v) else [v[j] for j in image_indices]
+            else:
+                selected[k] = [v[i] for i in indices]
+        return selected
+
     def inference_mllm(self, batch_data, inference_config, is_img_gen_task=True, **kwargs):
         batch_data = self.prepare_mllm_batch_data(batch_data, is_img_gen_task=is_img_gen_task)
+        if not is_img_gen_task:
+            return self.inference_mllm_prepared(batch_data, inference_config, is_img_gen_task=False, **kwargs)
+
+        # samples of different sizes have different image token layouts, generate them in sub batches.
+        groups = self._group_samples_by_target_size(batch_data, inference_config)
+        if len(groups) == 1:
+            return self.inference_mllm_prepared(batch_data, inference_config, **kwargs)
+        batch_outputs = [None] * len(batch_data["prompts"])
+        for (h, w), indices in groups.items():
+            group_outputs = self.inference_mllm_prepared(self._select_samples(batch_data, indices),
+                                                         replace(inference_config, resolution=(h, w)), **kwargs)
+            for i, output in zip(indices, group_outputs):
+                batch_outputs[i] = output
+        return batch_outputs
+
+    def inference_mllm_prepared(self, batch_data, inference_config, is_img_gen_task=True, **kwargs):
+        """`inference_mllm` of a batch from `prepare_mllm_batch_data` whose samples share one target size."""
         prompts = batch_data["prompts"]
 
         if inference_config.resolution is not None:
             h, w = inference_config.resolution
-            if h < 0 or w < 0:  # editing setting, for anyres, only support bs=1
+            if h < 0 or w < 0:  # editing setting, for anyres, the samples share the size of their first image
                 image_sizes = batch_data["image_sizes"]
                 w, h = image_sizes[0]
         else:
             image_sizes = batch_data["image_sizes"]
             w, h = image_sizes[0]
 
+        image_token_layout = None
         if is_img_gen_task:
             inference_config.resolution = (h, w)
 
             self.token_nums, max_new_tokens, self.h1, self.w1, self.h2, self.w2 = calculate_image_token_num(h, w)
+            image_token_layout = (self.h1, self.w1, self.h2, self.w2)
             inference_config.max_new_tokens = max_new_tokens
             self.resolution_tag = f"<height_{h}><width_{w}>"
 
@@ -431,15 +559,8 @@ class ILLUME():
             images = None
             image_sizes = None
 
-        input_ids_list = [tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt") for
-                          prompt in prompts]
-
-        pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
-        input_ids = pad_sequence(self.tokenizer, input_ids_list, batch_first=True, padding_value=pad_token_ids).to(
-            self.device)
-        attention_masks = input_ids.ne(pad_token_ids).to(self.device)
-
         # prepare unconditional_prompt
+        unconditional_prompts = []
         if inference_config.unconditional_prompt:
             unconditional_prompt = self.prepare_conversation_prompt(inference_config.unconditional_prompt)
             if is_img_gen_task:
@@ -447,99 +568,182 @@ class ILLUME():
                     unconditional_prompt = unconditional_prompt.replace("<image>", self.resolution_tag + "<image>")
                 unconditional_prompt = unconditional_prompt.format(
                     resolution_tag=self.resolution_tag) + self.resolution_tag
-            unconditional_token_ids = tokenizer_image_token(unconditional_prompt, self.tokenizer, IMAGE_TOKEN_INDEX,
-                                                            return_tensors="pt")
-            unconditional_token_ids = unconditional_token_ids.repeat(input_ids.shape[0], 1)
+            unconditional_prompts.append(unconditional_prompt)
+
+        # the prompts and the unconditional prompt are tokenized together
+        input_ids_list = tokenizer_image_token_batch(prompts + unconditional_prompts, self.tokenizer, IMAGE_TOKEN_INDEX,
+                                                     return_tensors="pt", chunk_cache=self.prompt_chunk_cache)
+        input_ids_list, unconditional_ids_list = input_ids_list[:len(prompts)], input_ids_list[len(prompts):]
+
+        pad_token_ids = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        input_ids = pad_sequence(self.tokenizer, input_ids_list, batch_first=True, padding_value=pad_token_ids).to(
+            self.device)
+        attention_masks = input_ids.ne(pad_token_ids).to(self.device)
+
+        if unconditional_ids_list:
+            unconditional_token_ids = unconditional_ids_list[0].repeat(input_ids.shape[0], 1)
         else:
             unconditional_token_ids = None
 
+        use_batched_cfg = (inference_config.cfg_mode == "batched" and unconditional_token_ids is not None
+                           and inference_config.llm_cfg_scale != 1)
+        # image generation always goes through the guided generator, which fast-forwards the forced structure tokens.
+        use_guided_generator = use_batched_cfg or (inference_config.cfg_mode == "batched" and is_img_gen_task)
+
         # prepare logits processor
         # logit_processor = self.prepare_logit_processor(inference_config, unconditional_token_ids, images, image_sizes)
-        logit_processor = self.prepare_interleaved_logit_processor(inference_config, unconditional_token_ids,
+        logit_processor = self.prepare_interleaved_logit_processor(inference_config,
+                                                                   None if use_batched_cfg else unconditional_token_ids,
                                                                    images, image_sizes,)
 
         set_seed(self.seed, deterministic=False)
         # do_sample = True if inference_config.temperature > 0 else False
         if 'do_sample' not in kwargs:
             kwargs['do_sample'] = True
-        output_ids = self.mllm_model.generate(
-            input_ids,
-            attention_mask=attention_masks,
-            images=images,
-            image_sizes=image_sizes,
-            pad_token_id=pad_token_ids,
-            # do_sample=do_sample,
-            temperature=inference_config.temperature,
-            top_k=inference_config.top_k,
-            top_p=inference_config.top_p,
-            max_new_tokens=inference_config.max_new_tokens,
-            logits_processor=LogitsProcessorList(logit_processor),
-            use_cache=True,
-            **kwargs
-        )
-
-        text_outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
-
-        # parse vision token from llm output
+        if use_guided_generator:
+            generator = BatchedCFGGenerator(self.mllm_model,
+                                            guidance_scale=inference_config.llm_cfg_scale,
+                                            special_tokens=special_tokens_dict,
+                                            pad_token_id=pad_token_ids,
+                                            prefix_cache=self.prefix_cache)
+            output_ids = generator.generate(
+                input_ids,
+                unconditional_token_ids.to(self.device) if use_batched_cfg else None,
+                attention_mask=attention_masks,
+                images=images,
+                image_sizes=image_sizes,
+                logits_processor=LogitsProcessorList(logit_processor),
+                do_sample=kwargs['do_sample'],
+                temperature=inference_config.temperature,
+                top_k=inference_config.top_k,
+                top_p=inference_config.top_p,
+                max_new_tokens=inference_config.max_new_tokens,
+                image_token_layout=image_token_layout,
+                streamer=kwargs.get("streamer"),
+            )
+        else:
+            output_ids = self.mllm_model.generate(
+                input_ids,
+                attention_mask=attention_masks,
+                images=images,
+                image_sizes=image_sizes,
+                pad_token_id=pad_token_ids,
+                # do_sample=do_sample,
+                temperature=inference_config.temperature,
+                top_k=inference_config.top_k,
+                top_p=inference_config.top_p,
+                max_new_tokens=inference_config.max_new_tokens,
+                logits_processor=LogitsProcessorList(logit_processor),
+                use_cache=True,
+                **kwargs
+            )
+
+        # parse vision token from llm output, the codes are read from the token ids and only the other tokens
+        # are decoded to text.
         batch_outputs = []
-        for i, output in enumerate(text_outputs):
-            image_embed_inds = []
-            for level in range(self.config.model_args.vision_tokenizer_levels):
-                pattern = r'<\|image_level{}_(\d+)\|>'.format(level)
-                matches = re.findall(pattern, output)
-                image_embed_ind = [int(num) for num in matches]
-                # rank0_print(f"level {level}, {len(image_embed_ind)}")
-                image_embed_inds.append(image_embed_ind)
-
-                output = re.sub(pattern, '', output)
+        for i, one_output_ids in enumerate(output_ids):
+            image_embed_inds = self.vision_token_mapper.token_ids_to_codes(one_output_ids)
+            output = self.tokenizer.decode(one_output_ids[~self.vision_token_mapper.is_code(one_output_ids)],
+                                           skip_special_tokens=True)
 
             tmp = {
                 "image_embed_inds": image_embed_inds,
-                "output_text": output
+                "output_text": output,
+                # the decoders read the layout of the sample from here, the model fields change with the next batch
+                "image_token_layout": image_token_layout,
             }
 
             for k, v in batch_data.items():
-                if k in ["image", "images", "prompts", "prompt"]:
+                if k in ["image", "images", "prompts", "prompt", "num_images"]:
                     continue
                 tmp[k] = v[i]
             batch_outputs.append(tmp)
         return batch_outputs
 
+    @staticmethod
+    def _group_outputs_by_layout(batch_llm_output):
+        """Indices of the outputs per image token layout `(h1, w1, h2, w2)`, outputs without image are left out."""
+        groups = {}
+        for i, one_output in enumerate(batch_llm_output):
+            if one_output.get("image_token_layout") is None:
+                continue
+            groups.setdefault(tuple(one_output["image_token_layout"]), []).append(i)
+        return groups
+
+    def _decode_vq_micro_batch(self, semantic_code, texture_code):
+        quant_semantic = self.vq_model.semantic_quantizer.indices_to_codes(semantic_code)
+        quant_pixel = self.vq_model.pixel_quantizer.indices_to_codes(texture_code)
+        samples = self.vq_model.decode(quant_semantic, quant_pixel)
+        samples = torch.clamp(127.5 * samples + 128.0, 0, 255).permute(0, 2, 3, 1).to(torch.uint8)
+        if samples.device.type == "cpu":
+            return samples
+        # copy into pinned memory without blocking, the next micro batch is decoded while the copy runs.
+        host_samples = torch.empty(samples.shape, dtype=torch.uint8, pin_memory=True)
+        host_samples.copy_(samples, non_blocking=True)
+        return host_samples
+
     @torch.inference_mode()
     def inference_tokenizer_decoder(self, batch_llm_output,
                                     inference_config: InferenceConfig,
                                     use_diffusion_decoder=False):
-        batch_decode_images = []
-        for one_output in batch_llm_output:
-            image_embed_inds = one_output["image_embed_inds"]
-            semantic_code = torch.as_tensor([image_embed_inds[0]])
-            texture_code = torch.as_tensor([image_embed_inds[1]])
-            semantic_code = semantic_code.view(semantic_code.shape[0], self.h1, self.w1)
-            texture_code = texture_code.view(texture_code.shape[0], self.h2, self.w2)
-
-            if use_diffusion_decoder:
-                h, w = inference_config.resolution
-                diffusion_outputs = self.diffusion_decoder_pipe(
-                    vq_indices=(semantic_code, texture_code),
-                    height=h * 2,
-                    width=w * 2,
-                    guidance_scale=inference_config.diffusion_cfg_scale,
-                    num_inference_steps=inference_config.diffusion_num_inference_steps,
-                    generator=torch.Generator(self.device).manual_seed(self.seed),
-                )
-                samples = diffusion_outputs.images
-                samples = [np.asarray(sample) for sample in samples]
-            else:
-                quant_semantic = self.vq_model.semantic_quantizer.indices_to_codes(semantic_code)
-                quant_pixel = self.vq_model.pixel_quantizer.indices_to_codes(texture_code)
-                samples = self.vq_model.decode(quant_semantic, quant_pixel)
-                samples = torch.clamp(127.5 * samples + 128.0, 0, 255).permute(0, 2, 3, 1).to("cpu",
-                                                                                              dtype=torch.uint8).numpy()
-
-            batch_decode_images.append(samples[0])
+        """
+        Decodes the image tokens of `batch_llm_output` with the DualViTok decoder or the diffusion decoder.
+
+        Outputs are grouped by their image token layout `(h1, w1, h2, w2)` and every group is decoded in micro
+        batches of `inference_config.decode_batch_size` samples. Images are returned in the order of
+        `batch_llm_output`.
+        """
+        batch_decode_images = [None] * len(batch_llm_output)
+        decode_batch_size = max(1, inference_config.decode_batch_size)
+        pending_copies = []
+        for (h1, w1, h2, w2), group_indices in self._group_outputs_by_layout(batch_llm_output).items():
+            for start in range(0, len(group_indices), decode_batch_size):
+                micro_batch = group_indices[start:start + decode_batch_size]
+                semantic_code = torch.as_tensor([batch_llm_output[i]["image_embed_inds"][0] for i in micro_batch])
+                texture_code = torch.as_tensor([batch_llm_output[i]["image_embed_inds"][1] for i in micro_batch])
+                semantic_code = semantic_code.view(len(micro_batch), h1, w1)
+                texture_code = texture_code.view(len(micro_batch), h2, w2)
+
+                if use_diffusion_decoder:
+                    # the size of the group, pixel codes are 16x downsampled (see `calculate_image_token_num`)
+                    h, w = h2 * 16, w2 * 16
+                    diffusion_outputs = self.diffusion_decoder_pipe(
+                        vq_indices=(semantic_code, texture_code),
+                        height=h * 2,
+                        width=w * 2,
+                        guidance_scale=inference_config.diffusion_cfg_scale,
+                        num_inference_steps=inference_config.diffusion_num_inference_steps,
+                        # one generator per sample, so every image gets the noise of an unbatched decode.
+                        generator=[torch.Generator(self.device).manual_seed(self.seed) for _ in micro_batch],
+                    )
+                    for i, sample in zip(micro_batch, diffusion_outputs.images):
+                        batch_decode_images[i] = np.asarray(sample)
+                else:
+                    samples = self._decode_vq_micro_batch(semantic_code.to(self.vq_model.device),
+                                                          texture_code.to(self.vq_model.device))
+                    pending_copies.append((micro_batch, samples))
+
+        if any(samples.is_pinned() for _, samples in pending_copies):
+            torch.cuda.synchronize()
+        for micro_batch, samples in pending_copies:
+            samples = samples.numpy()
+            for j, i in enumerate(micro_batch):
+                batch_decode_images[i] = samples[j]
         return batch_decode_images
 
-    def get_one_batch_results(self, batch_data, inference_config: InferenceConfig):
+    def get_one_batch_results(self, batch_data, inference_config: InferenceConfig, diffusion_callback=None):
+        """
+        Generates one batch and decodes its images with the decoders of `inference_config.decoder_mode`.
+
+        The images of a skipped decoder are `None`. In the 'vq-then-diffusion-async' mode the diffusion decoding
+        is queued to a background worker and `out_images_diffusion` is `None`, the worker calls
+        `diffusion_callback(out_images_diffusion, batch_llm_output)` once the images are decoded. Call
+        `wait_diffusion_decoder` to wait for the queued batches.
+        """
+        decoder_mode = inference_config.decoder_mode
+        if decoder_mode not in DECODER_MODES:
+            raise ValueError(f"Unknown decoder_mode {decoder_mode}, choose from {DECODER_MODES}")
+
         set_seed(self.seed)
 
         # get mllm output results
@@ -547,11 +751,27 @@ class ILLUME():
 
         # get image results
         # tokenizer decoder
-        out_images_tokenizer = self.inference_tokenizer_decoder(batch_llm_output, inference_config,
-                                                                use_diffusion_decoder=False)
+        out_images_tokenizer = None
+        if decoder_mode in ("vq", "both", "vq-then-diffusion-async"):
+            out_images_tokenizer = self.inference_tokenizer_decoder(batch_llm_output, inference_config,
+                                                                    use_diffusion_decoder=False)
         # diffusion decoder
-        out_images_diffusion = self.inference_tokenizer_decoder(batch_llm_output, inference_config,
-                                                                use_diffusion_decoder=True)
+        out_images_diffusion = None
+        if decoder_mode in ("diffusion", "both"):
+            out_images_diffusion = self.inference_tokenizer_decoder(batch_llm_output, inference_config,
+                                                                    use_diffusion_decoder=True)
+        elif decoder_mode == "vq-then-diffusion-async":
+            if self.diffusion_decode_pool is None:
+                # a single worker, the diffusion pipeline is not thread safe.
+                self.diffusion_decode_pool = BackgroundDecodePool(num_workers=1)
+            # the caller updates the config in place for the next batches.
+            batch_config = replace(inference_config)
+            callback = None
+            if diffusion_callback is not None:
+                callback = lambda images: diffusion_callback(images, batch_llm_output)
+            self.diffusion_decode_pool.submit(
+                lambda: self.inference_tokenizer_decoder(batch_llm_output, batch_config, use_diffusion_decoder=True),
+                callback=callback)
 
         output = {
             "batch_llm_output": batch_llm_output,
@@ -559,3 +779,8 @@ class ILLUME():
             "out_images_diffusion": out_images_diffusion,
         }
         return output
+
+    def wait_diffusion_decoder(self):
+        """Waits for the diffusion decoding queued by the 'vq-then-diffusion-async' decoder mode."""
+        if self.diffusion_decode_pool is not None:
+            self.diffusion_decode_pool.join()
@@ -0,0 +1,134 @@
+import queue
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+
+@torch.inference_mode()
+def decode_image_preview(vq_model, semantic_indices, pixel_indices, num_pixel_rows, image_token_layout):
+    """
+    Decodes a partially generated image with the DualViTok pixel decoder.
+
+    The pixel code rows that are not generated yet are zeroed, the same as the pixel codes dropped by
+    `DualViTok.apply_noise` in training, so the preview of a complete semantic grid is already a full image.
+
+    Returns:
+        `np.ndarray` of shape [H, W, 3] and dtype uint8.
+    """
+    h1, w1, h2, w2 = image_token_layout
+    device = vq_model.device
+    semantic_code = torch.as_tensor(semantic_indices, dtype=torch.long, device=device).view(1, h1, w1)
+    texture_code = torch.zeros(h2 * w2, dtype=torch.long, device=device)
+    texture_code[:len(pixel_indices)] = torch.as_tensor(pixel_indices, dtype=torch.long, device=device)
+    texture_code = texture_code.view(1, h2, w2)
+
+    quant_semantic, quant_pixel = vq_model.indices_to_codes(semantic_code, texture_code)
+    quant_pixel[:, :, num_pixel_rows:] = 0
+    samples = vq_model.decode(quant_semantic, quant_pixel)
+    samples = torch.clamp(127.5 * samples + 128.0, 0, 255).permute(0, 2, 3, 1).to("cpu", dtype=torch.uint8).numpy()
+    return samples[0]
+
+
+class ImagePreviewStreamer(BaseStreamer):
+    """
+    Streamer that turns the image tokens of a running `generate` call into progressive previews.
+
+    A first preview is available as soon as the semantic (level0) grid is complete, then one more after every
+    pixel (level1) row. The previews are decoded by the consumer when iterating, not in the generation loop,
+    and only the latest pending snapshot is decoded if the consumer falls behind. Only batch size 1 is
+    supported, like the `transformers` streamers.
+
+    Usage:
+        streamer = ImagePreviewStreamer(partial(decode_image_preview, vq_model), special_tokens,
+                                        level0_range, level1_range, (h1, w1, h2, w2))
+        Thread(target=model.generate, kwargs=dict(..., streamer=streamer)).start()
+        for preview in streamer:
+            ...
+
+    Args:
+        decode_fn (callable): `decode_fn(semantic_indices, pixel_indices, num_pixel_rows, image_token_layout)`,
+            e.g. `decode_image_preview` bound to a vq model.
+        image_token_layout (tuple): `(h1, w1, h2, w2)` from `calculate_image_token_num`.
+        timeout (float, *optional*): Timeout of the queue, `None` blocks forever.
+    """
+
+    def __init__(self, decode_fn, special_tokens, level0_range, level1_range, image_token_layout, timeout=None):
+        self.decode_fn = decode_fn
+        self.special_tokens = special_tokens
+        self.level0_range = level0_range
+        self.level1_range = level1_range
+        self.image_token_layout = tuple(image_token_layout)
+        self.timeout = timeout
+
+        self.snapshot_queue = queue.Queue()
+        self.stop_signal = None
+        self.finished = False
+        self._reset_image()
+
+    def _reset_image(self):
+        self.level = None
+        self.semantic_indices = []
+        self.pixel_indices = []
+        self.num_pixel_rows = 0
+
+    def _push_snapshot(self):
+        h1, w1, _, w2 = self.image_token_layout
+        if len(self.semantic_indices) != h1 * w1:
+            return
+        pixel_indices = self.pixel_indices[:self.num_pixel_rows * w2]
+        self.snapshot_queue.put((list(self.semantic_indices), pixel_indices, self.num_pixel_rows))
+
+    def _update(self, token):
+        if token == self.special_tokens["start_of_image"]:
+            self._reset_image()
+        elif token == self.special_tokens["start_of_level0"]:
+            self.level = 0
+        elif token == self.special_tokens["start_of_level1"]:
+            self.level = 1
+        elif token == self.special_tokens["end_of_level0"]:
+            self.level = None
+            self._push_snapshot()
+        elif token == self.special_tokens["end_of_level1"]:
+            self.level = None
+        elif token == self.special_tokens["end_of_line"]:
+            if self.level == 1:
+                self.num_pixel_rows += 1
+                self._push_snapshot()
+        elif self.level == 0 and self.level0_range[0] <= token < self.level0_range[1]:
+            self.semantic_indices.append(token - self.level0_range[0])
+        elif self.level == 1 and self.level1_range[0] <= token < self.level1_range[1]:
+            self.pixel_indices.append(token - self.level1_range[0])
+
+    def put(self, value):
+        if value.dim() > 1:
+            if value.shape[0] > 1:
+                raise ValueError("ImagePreviewStreamer only supports batch size 1")
+            value = value[0]
+        for token in value.tolist():
+            self._update(token)
+
+    def end(self):
+        self.snapshot_queue.put(self.stop_signal)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration()
+        snapshot = self.snapshot_queue.get(timeout=self.timeout)
+        if snapshot is self.stop_signal:
+            self.finished = True
+            raise StopIteration()
+        # only the latest snapshot is worth decoding
+        while True:
+            try:
+                newer = self.snapshot_queue.get_nowait()
+            except queue.Empty:
+                break
+            if newer is self.stop_signal:
+                self.finished = True
+                break
+            snapshot = newer
+        semantic_indices, pixel_indices, num_pixel_rows = snapshot
+        return self.decode_fn(semantic_indices, pixel_indices, num_pixel_rows, self.image_token_layout)
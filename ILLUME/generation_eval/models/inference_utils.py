@@ -118,23 +118,6 @@ def parse_interleaved_text_image(
     return generated_text, all_image_indices, list_image_token_parts
 
 
-def calculate_image_token_num(h, w, downsample_rate_per_level=[28, 16]):
-    # Assuming RESOLUTION_MAPPING is accessible or hardcoded if needed
-    # For simplicity, let's assume direct calculation based on downsampling
-    # Replace with actual RESOLUTION_MAPPING logic if necessary
-    # Example: w1, h1 = RESOLUTION_MAPPING.get((w, h), (w, h)) # Get from mapping
-    w1, h1 = w, h  # Placeholder if mapping not available/needed here
-    w1, h1 = w1 // downsample_rate_per_level[0], h1 // downsample_rate_per_level[0]
-    semantic_token_num = w1 * h1
-
-    w2, h2 = w // downsample_rate_per_level[1], h // downsample_rate_per_level[1]
-    pixel_token_num = w2 * h2
-    logging.info(f"Calculated token nums: semantic={semantic_token_num}, pixel={pixel_token_num} for target ({h},{w})")
-    # Estimate max_token_length (adjust based on special tokens in your format)
-    max_token_length = (h1 * (w1 + 1) + 2) + (h2 * (w2 + 1) + 2) + 2 + 2 + 1 + 1 + 50  # Add buffer
-    return [semantic_token_num, pixel_token_num], max_token_length, h1, w1, h2, w2
-
-
 def check_image_token_num(image_embed_inds, token_nums=[81, 256], identifier=""):
     image_embed_inds_out = []
     if len(image_embed_inds) != len(token_nums):
@@ -223,9 +206,122 @@ class CFGLogits(LogitsProcessor):
         return out
 
 
+NO_LEVEL = -1
+
+
+def _token_range_mask(vocab_ids, token_range):
+    return (vocab_ids >= token_range[0]) & (vocab_ids < token_range[1])
+
+
+class ImageGrammarMaskTable:
+    """
+    Precomputed masks of the image token grammar, one row per grammar state.
+
+    `disallowed[state]` is the [vocab_size] mask of tokens that must not be generated in `state`, so a processor
+    only has to compute the per-row state index and apply one indexed `masked_fill`. `forced_token[state]` is
+    the single token the grammar allows in `state`, or -1 if more than one token is allowed.
+
+    Tables only depend on the token ids and the vocab size, use `ImageGrammarMaskTable.get` to share them.
+    """
+    # states with more than one allowed token
+    TEXT = 0  # text phase, everything except image codes and intermediate structure tokens
+    LEVEL0_CODES = 1
+    LEVEL1_CODES = 2
+    STRUCTURE = 3  # <start_of_level0>, <start_of_level1> or <end_of_image>
+    ANY = 4  # no constraint
+    # states with a single forced token
+    FORCED_KEYS = ["start_of_image", "start_of_level0", "end_of_level0", "start_of_level1", "end_of_level1",
+                   "end_of_line", "end_of_image", "end_of_text"]
+
+    _cache = {}
+
+    def __init__(self, level0_range, level1_range, special_tokens, vocab_size, device=None):
+        self.level0_range = level0_range
+        self.level1_range = level1_range
+        self.special_tokens = special_tokens
+        self.vocab_size = vocab_size
+        self.forced_states = {key: self.ANY + 1 + i for i, key in enumerate(self.FORCED_KEYS)}
+
+        vocab_ids = torch.arange(vocab_size, device=device)
+        level0_tokens = _token_range_mask(vocab_ids, level0_range)
+        level1_tokens = _token_range_mask(vocab_ids, level1_range)
+
+        allowed = torch.zeros((self.ANY + 1 + len(self.FORCED_KEYS), vocab_size), dtype=torch.bool, device=device)
+        # Allow *all* tokens in the text phase, then specifically *disallow* image content and
+        # intermediate structure tokens, and finally allow <end_of_text> / <start_of_image>.
+        allowed[self.TEXT] = ~(level0_tokens | level1_tokens)
+        for key in ["start_of_level0", "end_of_level0", "start_of_level1", "end_of_level1", "end_of_line"]:
+            allowed[self.TEXT, special_tokens[key]] = False
+        allowed[self.TEXT, special_tokens["end_of_text"]] = True
+        allowed[self.TEXT, special_tokens["start_of_image"]] = True
+
+        allowed[self.LEVEL0_CODES] = level0_tokens
+        allowed[self.LEVEL1_CODES] = level1_tokens
+        for key in ["start_of_level0", "start_of_level1", "end_of_image"]:
+            allowed[self.STRUCTURE, special_tokens[key]] = True
+        allowed[self.ANY] = True
+
+        forced_token = torch.full((allowed.shape[0],), -1, dtype=torch.long, device=device)
+        for key, state in self.forced_states.items():
+            allowed[state, special_tokens[key]] = True
+            forced_token[state] = special_tokens[key]
+
+        self.disallowed = ~allowed
+        self.forced_token = forced_token
+
+    @classmethod
+    def get(cls, level0_range, level1_range, special_tokens, vocab_size, device=None):
+        key = (tuple(level0_range), tuple(level1_range),
+               tuple((k, special_tokens[k]) for k in cls.FORCED_KEYS), vocab_size, str(device))
+        if key not in cls._cache:
+            cls._cache[key] = cls(level0_range, level1_range, special_tokens, vocab_size, device=device)
+        return cls._cache[key]
+
+    def forced(self, key):
+        return self.forced_states[key]
+
+
+def _apply_batched_sampling(scores, temp, top_k, top_p, max_top_k, min_top_p):
+    """
+    Apply per-row temperature, top-k and top-p without leaving the device.
+
+    Args:
+        scores: Shape [batch_size, vocab_size].
+        temp, top_k, top_p: Shape [batch_size], the sampling parameters of every row.
+        max_top_k, min_top_p: Python bounds of the per-row values, used to skip the filters statically.
+    """
+    scores = scores / temp.to(scores.dtype).unsqueeze(-1)
+
+    # Top-K filtering
+    if max_top_k > 0:
+        _max_top_k = min(max_top_k, scores.size(-1))
+        top_k_values, _ = torch.topk(scores, _max_top_k)
+        kth_index = (top_k.clamp(min=1, max=_max_top_k) - 1).unsqueeze(-1)
+        kth_score = top_k_values.gather(-1, kth_index)
+        indices_to_remove = (scores < kth_score) & (top_k > 0).unsqueeze(-1)
+        scores = scores.masked_fill(indices_to_remove, -float("Inf"))
+
+    # Top-P filtering
+    if min_top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(scores, descending=True)
+        cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # Only keep tokens with cumulative probability <= top_p
+        sorted_indices_to_remove = cumulative_probs > top_p.to(cumulative_probs.dtype).unsqueeze(-1)
+        sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+        sorted_indices_to_remove[:, 0] = False
+        # rows with top_p >= 1 are not filtered at all
+        sorted_indices_to_remove &= (top_p < 1.0).unsqueeze(-1)
+
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        scores = scores.masked_fill(indices_to_remove, -float("Inf"))
+
+    return scores
+
+
 class DualVQImageTokenProcessor(LogitsProcessor):
     def __init__(self, level0_range, level1_range, num_level0_rows, num_level0_tokens,
-                 num_level1_rows, num_level1_tokens, special_tokens):
+                 num_level1_rows, num_level1_tokens, special_tokens, mask_table=None):
         self.level0_range = level0_range  # (min_id, max_id) for level0 tokens
         self.level1_range = level1_range  # (min_id, max_id) for level1 tokens
         self.num_level0_rows = num_level0_rows  # 9 rows for level0
@@ -233,126 +329,83 @@ class DualVQImageTokenProcessor(LogitsProcessor):
         self.num_level1_rows = num_level1_rows  # 16 rows for level1
         self.num_level1_tokens = num_level1_tokens  # 16 tokens per row
         self.special_tokens = special_tokens  # Dictionary of special tokens
-
-        self.current_level = None  # "level0" or "level1"
-        self.tokens_in_row = 0  # Count of tokens in the current row
-        self.rows_in_level = 0  # Count of rows in the current level
-        self.generating_image = False  # True if inside <start_of_image> ... <end_of_image>
+        self.mask_table = mask_table  # ImageGrammarMaskTable, built on the first call if None
+
+        # Per-row state, shape [batch_size]. Created on the first call.
+        self.current_level = None  # NO_LEVEL, 0 or 1
+        self.tokens_in_row = None  # Count of tokens in the current row
+        self.rows_in_level = None  # Count of rows in the current level
+        self.generating_image = None  # True if inside <start_of_image> ... <end_of_image>
+
+    def _init_state(self, batch_size, device):
+        self.current_level = torch.full((batch_size,), NO_LEVEL, dtype=torch.long, device=device)
+        self.tokens_in_row = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.rows_in_level = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.generating_image = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def _get_mask_table(self, vocab_size, device):
+        if self.mask_table is None or self.mask_table.vocab_size != vocab_size or \
+                self.mask_table.disallowed.device != device:
+            self.mask_table = ImageGrammarMaskTable.get(self.level0_range, self.level1_range, self.special_tokens,
+                                                        vocab_size, device=device)
+        return self.mask_table
 
     def __call__(self, input_ids, scores):
-        try:
-            last_token = input_ids[0, -1].item()
-        except:
-            # print("last_token error", input_ids.shape)
-            # TODO FIXME
-            # Ensure the first token is <start_of_image> for image generation tasks
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.special_tokens["start_of_image"]] = 0  # 只允许生成 <start_of_image>
-            scores += mask
-            return scores
-
-        # --- State transition logic based on last token ---
-
-        # Just finished generating <start_of_image>
-        if last_token == self.special_tokens["start_of_image"]:
-            self.generating_image = True
-            self.current_level = None  # Reset level state
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.special_tokens["start_of_level0"]] = 0  # 只允许生成 <start_of_level0>
-            scores += mask
-            return scores
-
-        # Just finished generating <start_of_level0> (Only if 0 in selected_levels)
-        if last_token == self.special_tokens["start_of_level0"]:
-            self.current_level = "level0"
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            # Allow level 0 tokens next (handled below in level 0 processing logic)
-            # No immediate return needed here, fall through to level 0 processing.
-
-        # Just finished generating <end_of_level0>
-        if last_token == self.special_tokens["end_of_level0"]:
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.special_tokens["start_of_level1"]] = 0  # 只允许生成 <start_of_level1>
-            scores += mask
-            return scores
-
-        # Just finished generating <start_of_level1> (Only if 1 in selected_levels)
-        if last_token == self.special_tokens["start_of_level1"]:
-            self.current_level = "level1"
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            # Allow level 1 tokens next (handled below in level 1 processing logic)
-            # No immediate return needed here, fall through to level 1 processing.
-
-        # Just finished generating <end_of_level1>
-        if last_token == self.special_tokens["end_of_level1"]:
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.special_tokens["end_of_image"]] = 0  # Force <end_of_image>
-            scores += mask
-            return scores
+        batch_size, vocab_size = scores.shape
+        if self.current_level is None or self.current_level.shape[0] != batch_size:
+            self._init_state(batch_size, scores.device)
+        table = self._get_mask_table(vocab_size, scores.device)
 
-        # Just finished generating <end_of_image>
-        if last_token == self.special_tokens["end_of_image"]:
-            self.generating_image = False
-            self.current_level = None
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.special_tokens["end_of_text"]] = 0
-            scores += mask
+        if input_ids.shape[1] == 0:
+            # Ensure the first token is <start_of_image> for image generation tasks
+            scores = scores.masked_fill(table.disallowed[table.forced("start_of_image")], float("-inf"))
             return scores
 
-        # processing Level 0 token limit
-        if self.current_level == "level0":
-            if self.tokens_in_row == self.num_level0_tokens:  # 9 tokens reached, enforce <end_of_line>
-                mask = torch.full_like(scores, float("-inf"))
-                mask[:, self.special_tokens["end_of_line"]] = 0
-                scores += mask
-                self.tokens_in_row = 0
-                self.rows_in_level += 1
-                return scores
-
-            if self.rows_in_level == self.num_level0_rows:  # 9 rows reached, enforce <end_of_level0>
-                mask = torch.full_like(scores, float("-inf"))
-                mask[:, self.special_tokens["end_of_level0"]] = 0
-                scores += mask
-                return scores
-
-            # Only allow generating level0 tokens
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.level0_range[0]:self.level0_range[1]] = 0
-            scores += mask
-            self.tokens_in_row += 1
-            return scores
+        last_token = input_ids[:, -1]
+        is_start_of_image = last_token == self.special_tokens["start_of_image"]
+        is_end_of_level0 = last_token == self.special_tokens["end_of_level0"]
+        is_end_of_level1 = last_token == self.special_tokens["end_of_level1"]
+        is_end_of_image = last_token == self.special_tokens["end_of_image"]
+        is_start_of_level0 = last_token == self.special_tokens["start_of_level0"]
+        is_start_of_level1 = last_token == self.special_tokens["start_of_level1"]
 
-        # processing Level 1 token limit
-        if self.current_level == "level1":
-            if self.tokens_in_row == self.num_level1_tokens:  # 16 tokens reached, enforce <end_of_line>
-                mask = torch.full_like(scores, float("-inf"))
-                mask[:, self.special_tokens["end_of_line"]] = 0
-                scores += mask
-                self.tokens_in_row = 0
-                self.rows_in_level += 1
-                return scores
-
-            if self.rows_in_level == self.num_level1_rows:  # 16 rows reached, enforce <end_of_level1>
-                mask = torch.full_like(scores, float("-inf"))
-                mask[:, self.special_tokens["end_of_level1"]] = 0
-                scores += mask
-                return scores
-
-            # Only allow generating level1 tokens
-            mask = torch.full_like(scores, float("-inf"))
-            mask[:, self.level1_range[0]:self.level1_range[1]] = 0
-            scores += mask
-            self.tokens_in_row += 1
-            return scores
-
-        # If not generating an image or between states not handled above, return original scores
+        # --- State transition logic based on last token ---
+        # <start_of_image> / <end_of_image> reset the state, <start_of_level*> enters a level.
+        reset = is_start_of_image | is_end_of_image | is_start_of_level0 | is_start_of_level1
+        self.generating_image = (self.generating_image | is_start_of_image) & ~is_end_of_image
+        self.current_level = torch.where(is_start_of_image | is_end_of_image, NO_LEVEL, self.current_level)
+        self.current_level = torch.where(is_start_of_level0, 0, self.current_level)
+        self.current_level = torch.where(is_start_of_level1, 1, self.current_level)
+        self.tokens_in_row = torch.where(reset, 0, self.tokens_in_row)
+        self.rows_in_level = torch.where(reset, 0, self.rows_in_level)
+
+        # If not generating an image or between states not handled above, keep the original scores
         # (e.g., generating text before <start_of_image> or after <end_of_text>)
+        state = torch.full_like(last_token, ImageGrammarMaskTable.ANY)
+        state = torch.where(is_start_of_image, table.forced("start_of_level0"), state)
+        state = torch.where(is_end_of_level0, table.forced("start_of_level1"), state)
+        state = torch.where(is_end_of_level1, table.forced("end_of_image"), state)
+        state = torch.where(is_end_of_image, table.forced("end_of_text"), state)
+        structure_handled = state != ImageGrammarMaskTable.ANY
+
+        # processing Level 0 / Level 1 token limit
+        num_tokens = torch.where(self.current_level == 0, self.num_level0_tokens, self.num_level1_tokens)
+        num_rows = torch.where(self.current_level == 0, self.num_level0_rows, self.num_level1_rows)
+        in_level = ~structure_handled & (self.current_level != NO_LEVEL)
+
+        row_full = in_level & (self.tokens_in_row == num_tokens)  # enforce <end_of_line>
+        level_full = in_level & ~row_full & (self.rows_in_level == num_rows)  # enforce <end_of_level*>
+        allow_codes = in_level & ~row_full & ~level_full
+
+        state = torch.where(row_full, table.forced("end_of_line"), state)
+        state = torch.where(level_full & (self.current_level == 0), table.forced("end_of_level0"), state)
+        state = torch.where(level_full & (self.current_level == 1), table.forced("end_of_level1"), state)
+        state = torch.where(allow_codes & (self.current_level == 0), ImageGrammarMaskTable.LEVEL0_CODES, state)
+        state = torch.where(allow_codes & (self.current_level == 1), ImageGrammarMaskTable.LEVEL1_CODES, state)
+        self.tokens_in_row = torch.where(row_full, 0, self.tokens_in_row + allow_codes.long())
+        self.rows_in_level = self.rows_in_level + row_full.long()
+
+        scores = scores.masked_fill(table.disallowed[state], float("-inf"))
         return scores
 
 
@@ -365,6 +418,7 @@ class DynamicSamplingProcessor(LogitsProcessor):
                  ):
         """
         Custom LogitsProcessor to dynamically adjust temperature, top_k, top_p based on the current generated token ID.
+        The sampling mode is tracked per batch row.
         """
 
         self.start_of_level0_token_id = special_tokens["start_of_level0"]
@@ -384,8 +438,8 @@ class DynamicSamplingProcessor(LogitsProcessor):
         self.level1_top_k = level1_top_k
         self.level1_top_p = level1_top_p
 
-        self.in_level0_mode = False  # Whether in Level 0
-        self.in_level1_mode = False  # Whether in Level 1
+        # Per-row sampling mode, shape [batch_size]: NO_LEVEL (default), 0 (Level 0) or 1 (Level 1)
+        self.current_level = None
 
     def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
         """
@@ -394,90 +448,45 @@ class DynamicSamplingProcessor(LogitsProcessor):
         :param scores: Shape [batch_size, vocab_size], current logits scores
         :return: Processed logits scores
         """
-        batch_size = input_ids.shape[0]  # Although code uses input_ids[0, -1], get batch_size for potential future use
-
-        try:
-            # Assuming batch_size is 1 for state tracking simplicity here.
-            # If batch_size > 1, this state logic needs to be batched.
-            last_token = input_ids[0, -1].item()  # Get the last token of the current batch (assuming bs=1)
-
-            # Update state
-            if last_token == self.start_of_level0_token_id:
-                self.in_level0_mode = True
-                self.in_level1_mode = False
-            elif last_token == self.end_of_level0_token_id:
-                self.in_level0_mode = False
-                # Don't change in_level1_mode here, wait for start_of_level1
-
-            if last_token == self.start_of_level1_token_id:
-                self.in_level0_mode = False
-                self.in_level1_mode = True
-            elif last_token == self.end_of_level1_token_id:
-                self.in_level1_mode = False
-                # Don't change in_level0_mode here
-
-        except IndexError:
-            # multimodal setting when predicting the first token, there is no last token, input_ids shape might be [bs, 0] or similar
-            # Or during initial prompt processing. Reset modes.
-            self.in_level0_mode = False
-            self.in_level1_mode = False
-
-        # Apply sampling based on the current mode
-        if self.in_level0_mode:
-            scores = self._apply_sampling(scores, self.level0_temp, self.level0_top_k, self.level0_top_p)
-        elif self.in_level1_mode:
-            scores = self._apply_sampling(scores, self.level1_temp, self.level1_top_k, self.level1_top_p)
-        else:
-            # Apply default sampling when not inside level0 or level1 image generation
-            scores = self._apply_sampling(scores, self.default_temp, self.default_top_k, self.default_top_p)
-
-        return scores
+        batch_size = input_ids.shape[0]
 
-    def _apply_sampling(self, scores, temp, top_k, top_p):
-        """ Apply top-k, top-p, and temperature """
-        # Apply temperature
-        if temp > 0.0:  # Avoid division by 0.0
-            scores = scores / temp
-
-        # Top-K filtering
-        if top_k > 0:
-            # Ensure top_k is not larger than vocab size
-            _top_k = min(top_k, scores.size(-1))
-            # Remove all tokens with a probability less than the k-th token's probability
-            top_k_values, _ = torch.topk(scores, _top_k)
-            # Get the score of the k-th token (last one in the top_k_values tensor)
-            kth_score = top_k_values[:, -1].unsqueeze(-1)
-            # Set scores below the k-th score to -inf
-            scores[scores < kth_score] = -float("Inf")
-
-        # Top-P (nucleus) filtering
-        if top_p < 1.0:
-            # Sort logits in descending order
-            sorted_logits, sorted_indices = torch.sort(scores, descending=True)
-            # Calculate cumulative probabilities
-            cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
-
-            # Remove tokens with cumulative probability above the threshold (nucleus)
-            # We keep tokens whose cumulative probability is <= top_p
-            sorted_indices_to_remove = cumulative_probs > top_p
-
-            # Shift the mask to the right to keep the first token above the threshold
-            # If all tokens are removed (e.g., due to numerical instability), keep at least the top token
-            sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-            sorted_indices_to_remove[:, 0] = False  # Always keep the highest probability token
-
-            # Scatter the boolean mask back to the original indices
-            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-            # Apply the mask by setting scores to -inf
-            scores[indices_to_remove] = -float("Inf")
+        if self.current_level is None or self.current_level.shape[0] != batch_size or input_ids.shape[1] == 0:
+            # multimodal setting when predicting the first token, there is no last token,
+            # input_ids shape might be [bs, 0] or similar. Reset modes.
+            self.current_level = torch.full((batch_size,), NO_LEVEL, dtype=torch.long, device=scores.device)
 
-        return scores
+        if input_ids.shape[1] > 0:
+            last_token = input_ids[:, -1]
+            # Update state. <end_of_level*> only leaves its own level.
+            level = self.current_level
+            level = torch.where(last_token == self.start_of_level0_token_id, 0, level)
+            level = torch.where((last_token == self.end_of_level0_token_id) & (level == 0), NO_LEVEL, level)
+            level = torch.where(last_token == self.start_of_level1_token_id, 1, level)
+            level = torch.where((last_token == self.end_of_level1_token_id) & (level == 1), NO_LEVEL, level)
+            self.current_level = level
+
+        # Apply sampling based on the current mode of every row
+        temp = scores.new_tensor([self.default_temp, self.level0_temp, self.level1_temp])[self.current_level + 1]
+        top_k = torch.tensor([self.default_top_k, self.level0_top_k, self.level1_top_k],
+                             device=scores.device)[self.current_level + 1]
+        top_p = torch.tensor([self.default_top_p, self.level0_top_p, self.level1_top_p],
+                             device=scores.device)[self.current_level + 1]
+        # Avoid division by 0.0
+        temp = torch.where(temp > 0.0, temp, torch.ones_like(temp))
+
+        return _apply_batched_sampling(scores, temp, top_k, top_p,
+                                       max_top_k=max(self.default_top_k, self.level0_top_k, self.level1_top_k),
+                                       min_top_p=min(self.default_top_p, self.level0_top_p, self.level1_top_p))
 
 
 class InterleavedLogitsProcessor(LogitsProcessor):
     """
     Combines CFG, Dual VQ Image Token Structure Enforcement, and Dynamic Sampling
     for interleaved text and image generation.
+
+    The structure state (level, row and column counters) is kept per batch row as tensors, so rows
+    progress independently and no GPU->CPU synchronization is needed to build the mask. Every state maps to
+    one row of a precomputed `ImageGrammarMaskTable`.
     """
 
     def __init__(self,
@@ -492,7 +501,7 @@ class InterleavedLogitsProcessor(LogitsProcessor):
                  default_top_k=2048, level0_top_k=2048, level1_top_k=2048 * 3,
                  default_top_p=0.8, level0_top_p=0.8, level1_top_p=1.0,
                  # General
-                 images=None, image_sizes=None
+                 images=None, image_sizes=None, mask_table=None
                  ):
 
         # --- CFG ---
@@ -502,6 +511,8 @@ class InterleavedLogitsProcessor(LogitsProcessor):
         self.image_sizes = image_sizes
         self.model = model
         self.out = None
+        # tokens the unconditional branch has not consumed yet, because their step was forced by the grammar.
+        self.num_uncond_pending = 0
 
         # --- DualVQ ---
         self.level0_range = level0_range
@@ -511,12 +522,16 @@ class InterleavedLogitsProcessor(LogitsProcessor):
         self.num_level1_rows = num_level1_rows
         self.num_level1_tokens = num_level1_tokens
         self.special_tokens = special_tokens
+        self.mask_table = mask_table  # ImageGrammarMaskTable, built on the first call if None
 
-        # DualVQ State
-        self.generating_image = False
+        # DualVQ State, shape [batch_size]. Created on the first call.
+        # current_level is NO_LEVEL, 0 or 1. It also selects the dynamic sampling parameters.
+        self.generating_image = None
         self.current_level = None
-        self.tokens_in_row = 0
-        self.rows_in_level = 0
+        self.tokens_in_row = None
+        self.rows_in_level = None
+        self.num_seen_tokens = None  # length of `input_ids` at the previous call
+        self.forced_tokens = None  # forced next token of every row at the last call, -1 if not forced
 
         # --- Dynamic Sampling ---
         self.start_of_level0_token_id = special_tokens["start_of_level0"]
@@ -536,10 +551,6 @@ class InterleavedLogitsProcessor(LogitsProcessor):
         self.level1_top_k = level1_top_k
         self.level1_top_p = level1_top_p
 
-        # Dynamic Sampling State
-        self.in_level0_mode = False
-        self.in_level1_mode = False
-
         # --- Validation ---
         if not self.special_tokens:
             raise ValueError("special_tokens dictionary cannot be empty.")
@@ -551,10 +562,44 @@ class InterleavedLogitsProcessor(LogitsProcessor):
             if key not in self.special_tokens:
                 raise ValueError(f"Missing required key in special_tokens: {key}")
 
+    def _init_state(self, batch_size, device):
+        self.generating_image = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        self.current_level = torch.full((batch_size,), NO_LEVEL, dtype=torch.long, device=device)
+        self.tokens_in_row = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.rows_in_level = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.num_seen_tokens = None
+
+    def _update_state(self, last_token):
+        """Advance the per-row state machine with the *last generated* token of every row."""
+        is_start_of_image = last_token == self.start_of_image_token_id
+        is_end_of_image = last_token == self.end_of_image_token_id
+        is_start_of_level0 = last_token == self.start_of_level0_token_id
+        is_end_of_level0 = last_token == self.end_of_level0_token_id
+        is_start_of_level1 = last_token == self.start_of_level1_token_id
+        is_end_of_level1 = last_token == self.end_of_level1_token_id
+        is_structure = is_start_of_image | is_end_of_image | is_start_of_level0 | is_end_of_level0 | \
+                       is_start_of_level1 | is_end_of_level1
+        is_end_of_line = (last_token == self.special_tokens["end_of_line"]) & self.generating_image
+        is_code = ~is_structure & ~is_end_of_line & self.generating_image & (
+                ((self.current_level == 0) &
+                 (last_token >= self.level0_range[0]) & (last_token < self.level0_range[1])) |
+                ((self.current_level == 1) &
+                 (last_token >= self.level1_range[0]) & (last_token < self.level1_range[1])))
+
+        reset_counters = is_start_of_image | is_end_of_image | is_start_of_level0 | is_start_of_level1
+        self.generating_image = (self.generating_image | is_start_of_image) & ~is_end_of_image
+        level = torch.where(is_start_of_level0, 0, self.current_level)
+        level = torch.where(is_start_of_level1, 1, level)
+        level = torch.where(is_start_of_image | is_end_of_image | is_end_of_level0 | is_end_of_level1,
+                            NO_LEVEL, level)
+        self.current_level = level
+        self.tokens_in_row = torch.where(reset_counters | is_end_of_line, 0, self.tokens_in_row + is_code.long())
+        self.rows_in_level = torch.where(reset_counters, 0, self.rows_in_level + is_end_of_line.long())
+
     def _apply_cfg(self, input_ids, scores):
         """Applies Classifier-Free Guidance."""
         scores = F.log_softmax(scores, dim=-1)
-        if self.guidance_scale == 1:
+        if self.guidance_scale == 1 or self.uncond is None:
             return scores
 
         if self.out is None:
@@ -572,161 +617,124 @@ class InterleavedLogitsProcessor(LogitsProcessor):
                                   images=self.images, image_sizes=self.image_sizes, use_cache=True)
         else:
             self.out = self.model(
-                input_ids[:, -1:],
+                input_ids[:, -(1 + self.num_uncond_pending):],
                 use_cache=True,
                 past_key_values=self.out.past_key_values,
             )
+            self.num_uncond_pending = 0
         unconditional_logits = F.log_softmax(self.out.logits[:, -1, :], dim=-1)
         out = self.guidance_scale * (scores - unconditional_logits) + unconditional_logits
         return out
 
-    def _apply_sampling(self, scores, temp, top_k, top_p):
-        """ Apply top-k, top-p, and temperature """
-        scores = scores / temp
-
-        # Top-K filtering
-        if top_k > 0:
-            top_k_values, _ = torch.topk(scores, min(top_k, scores.size(-1)))
-            scores[scores < top_k_values[:, -1].unsqueeze(-1)] = -float("Inf")
-
-        # Top-P filtering
-        if top_p < 1.0:
-            sorted_logits, sorted_indices = torch.sort(scores, descending=True)
-            cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+    def _get_mask_table(self, vocab_size, device):
+        if self.mask_table is None or self.mask_table.vocab_size != vocab_size or \
+                self.mask_table.disallowed.device != device:
+            self.mask_table = ImageGrammarMaskTable.get(self.level0_range, self.level1_range, self.special_tokens,
+                                                        vocab_size, device=device)
+        return self.mask_table
+
+    def _grammar_state(self, input_ids, table):
+        """Returns the [batch_size] `ImageGrammarMaskTable` state that determines the *next* token of every row."""
+        generating = self.generating_image
+        level = self.current_level
+        num_tokens = torch.where(level == 0, self.num_level0_tokens, self.num_level1_tokens)
+        num_rows = torch.where(level == 0, self.num_level0_rows, self.num_level1_rows)
+
+        # Text phase
+        state = torch.full_like(level, ImageGrammarMaskTable.TEXT)
+
+        # --- Image Generation Masking ---
+        in_level = generating & (level != NO_LEVEL)
+        level_full = in_level & (self.rows_in_level == num_rows)
+        row_full = in_level & ~level_full & (self.tokens_in_row == num_tokens)
+        allow_codes = in_level & ~level_full & ~row_full
+        state = torch.where(level_full & (level == 0), table.forced("end_of_level0"), state)
+        state = torch.where(level_full & (level == 1), table.forced("end_of_level1"), state)
+        state = torch.where(row_full, table.forced("end_of_line"), state)
+        state = torch.where(allow_codes & (level == 0), ImageGrammarMaskTable.LEVEL0_CODES, state)
+        state = torch.where(allow_codes & (level == 1), ImageGrammarMaskTable.LEVEL1_CODES, state)
+
+        # Between structure tokens
+        between = generating & (level == NO_LEVEL)
+        if input_ids.shape[1] > 0:
+            last_token = input_ids[:, -1]
+            # Allow relevant structural tokens if needed
+            state = torch.where(between, ImageGrammarMaskTable.STRUCTURE, state)
+            state = torch.where(between & (last_token == self.start_of_image_token_id),
+                                table.forced("start_of_level0"), state)
+            state = torch.where(between & (last_token == self.end_of_level0_token_id),
+                                table.forced("start_of_level1"), state)
+            state = torch.where(between & (last_token == self.end_of_level1_token_id),
+                                table.forced("end_of_image"), state)
+        else:
+            # Very first token is image?
+            state = torch.where(between, table.forced("start_of_image"), state)
+        return state
 
-            # Only keep tokens with cumulative probability <= top_p
-            sorted_indices_to_remove = cumulative_probs > top_p
-            sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-            sorted_indices_to_remove[:, 0] = False
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        batch_size, vocab_size = scores.shape
+        if self.current_level is None or self.current_level.shape[0] != batch_size:
+            self._init_state(batch_size, scores.device)
+        table = self._get_mask_table(vocab_size, scores.device)
+
+        # --- Step 1: Update State ---
+        # State updates based on the tokens generated since the previous call. That is usually only the *last
+        # generated* token, but a generation loop may fast-forward forced structure tokens without calling us.
+        if self.num_seen_tokens is not None and self.num_seen_tokens <= input_ids.shape[1]:
+            first_new = self.num_seen_tokens
+        else:
+            first_new = max(input_ids.shape[1] - 1, 0)
+        for i in range(first_new, input_ids.shape[1]):
+            self._update_state(input_ids[:, i])
+        # the separate unconditional branch also has to consume the fast-forwarded tokens.
+        self.num_uncond_pending += max(input_ids.shape[1] - first_new - 1, 0)
+        self.num_seen_tokens = input_ids.shape[1]
 
-            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-            scores[indices_to_remove] = -float("Inf")
+        # Apply constraints based on the *current* state (determining the *next* token)
+        state = self._grammar_state(input_ids, table)
+        disallowed = table.disallowed[state]
 
-        return scores
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        # --- Step 0: Get last token and Vocab Size ---
-        last_token = None
-        if input_ids.shape[1] > 0:
-            last_token = input_ids[0, -1].item()  # Assuming batch size 1
-
-        # --- Step 1: Update State & Apply Constraints ---
-        # State updates based on the *last generated* token
-        if last_token == self.start_of_image_token_id:
-            self.generating_image = True
-            self.current_level = None
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            self.in_level0_mode = False
-            self.in_level1_mode = False
-        elif last_token == self.start_of_level0_token_id:
-            self.current_level = "level0"
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            self.in_level0_mode = True
-            self.in_level1_mode = False
-        elif last_token == self.end_of_level0_token_id:
-            self.current_level = None
-            self.in_level0_mode = False
-        elif last_token == self.start_of_level1_token_id:
-            self.current_level = "level1"
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            self.in_level0_mode = False
-            self.in_level1_mode = True
-        elif last_token == self.end_of_level1_token_id:
-            self.current_level = None
-            self.in_level1_mode = False
-        elif last_token == self.end_of_image_token_id:
-            self.generating_image = False
-            self.current_level = None
-            self.tokens_in_row = 0
-            self.rows_in_level = 0
-            self.in_level0_mode = False
-            self.in_level1_mode = False
-        elif last_token == self.special_tokens["end_of_line"] and self.generating_image:
-            self.tokens_in_row = 0
-            self.rows_in_level += 1
-        elif self.generating_image and self.current_level is not None:
-            if (self.current_level == "level0" and self.level0_range[0] <= last_token < self.level0_range[1]) or \
-                    (self.current_level == "level1" and self.level1_range[0] <= last_token < self.level1_range[1]):
-                self.tokens_in_row += 1
+        # [batch_size] token the grammar forces for every row (<end_of_line>, <start_of_level1>, ...), or -1.
+        # Kept on the device, a generation loop that knows the layout on the host can fast-forward instead.
+        self.forced_tokens = table.forced_token[state]
 
         # --- Step 2: Apply CFG ---
-        if self.generating_image:
-            scores = self._apply_cfg(input_ids, scores)
-        else:
-            if self.out:
+        generating = self.generating_image.unsqueeze(-1)
+        separate_cfg = self.guidance_scale != 1 and self.uncond is not None
+        if separate_cfg:
+            # The separate unconditional forward needs to know on the host whether any row is inside an image,
+            # and it is skipped when the grammar forces the token of every row. One sync for both.
+            all_forced, any_generating = torch.stack(
+                [(self.forced_tokens >= 0).all(), self.generating_image.any()]).tolist()
+            if all_forced and self.out is not None:
+                self.num_uncond_pending += 1
+                return torch.zeros_like(scores).masked_fill_(disallowed, -float("Inf"))
+            if any_generating:
+                scores = torch.where(generating, self._apply_cfg(input_ids, scores), scores)
+            elif self.out:
                 self.out = None
+                self.num_uncond_pending = 0
+        else:
+            scores = torch.where(generating, F.log_softmax(scores, dim=-1), scores)
 
-        # Apply constraints based on the *current* state (determining the *next* token)
-        mask = torch.zeros_like(scores, dtype=torch.bool)  # True means ALLOWED
-
-        if self.generating_image:
-            # --- Image Generation Masking ---
-            if self.current_level == "level0":
-                if self.rows_in_level == self.num_level0_rows:
-                    mask[:, self.special_tokens["end_of_level0"]] = True
-                elif self.tokens_in_row == self.num_level0_tokens:
-                    mask[:, self.special_tokens["end_of_line"]] = True
-                else:
-                    mask[:, self.level0_range[0]:self.level0_range[1]] = True
-            elif self.current_level == "level1":
-                if self.rows_in_level == self.num_level1_rows:
-                    mask[:, self.special_tokens["end_of_level1"]] = True
-                elif self.tokens_in_row == self.num_level1_tokens:
-                    mask[:, self.special_tokens["end_of_line"]] = True
-                else:
-                    mask[:, self.level1_range[0]:self.level1_range[1]] = True
-            else:  # Between structure tokens
-                if last_token == self.start_of_image_token_id:
-                    mask[:, self.special_tokens["start_of_level0"]] = True
-                elif last_token == self.end_of_level0_token_id:
-                    mask[:, self.special_tokens["start_of_level1"]] = True
-                elif last_token == self.end_of_level1_token_id:
-                    mask[:, self.special_tokens["end_of_image"]] = True
-                elif last_token is None and input_ids.shape[1] == 0:  # Very first token is image?
-                    mask[:, self.start_of_image_token_id] = True
-                else:  # Allow relevant structural tokens if needed
-                    mask[:, self.special_tokens["start_of_level0"]] = True
-                    mask[:, self.special_tokens["start_of_level1"]] = True
-                    mask[:, self.special_tokens["end_of_image"]] = True
+        scores = scores.masked_fill(disallowed, -float("Inf"))
 
-        else:
-            # Allow *all* tokens by default...
-            mask[:, :] = True
-            # ...then specifically *disallow* image content and intermediate structure tokens
-            mask[:, self.level0_range[0]:self.level0_range[1]] = False
-            mask[:, self.level1_range[0]:self.level1_range[1]] = False
-            mask[:, self.special_tokens["start_of_level0"]] = False
-            mask[:, self.special_tokens["end_of_level0"]] = False
-            mask[:, self.special_tokens["start_of_level1"]] = False
-            mask[:, self.special_tokens["end_of_level1"]] = False
-            mask[:, self.special_tokens["end_of_line"]] = False  # EOL only allowed within image context
-
-            # Ensure the specific allowed tokens for text phase are indeed allowed
-            # (This overrides any potential disallowing above if IDs overlap, e.g., if EOS was in image range)
-            mask[:, self.special_tokens["end_of_text"]] = True
-            mask[:, self.special_tokens["start_of_image"]] = True
-
-        # Apply the mask
-        scores[~mask] = -float("Inf")
-
-        # Handle edge case: If all tokens are masked
-        if not torch.any(scores > -float("Inf"), dim=-1).all():
-            print("WARN: All tokens masked, allowing EOS.")
-            # Allow EOS and potentially other safe tokens if needed
-            scores[:] = -float("Inf")  # Reset all to -inf first
-            scores[:, self.special_tokens["end_of_text"]] = 0
+        # Handle edge case: If all tokens of a row are masked, allow EOS for that row.
+        all_masked = ~torch.any(scores > -float("Inf"), dim=-1, keepdim=True)
+        eos_only = torch.zeros_like(scores[:1]).masked_fill_(table.disallowed[table.forced("end_of_text")],
+                                                             -float("Inf"))
+        scores = torch.where(all_masked, eos_only, scores)
 
         # --- Step 3: Apply Dynamic Sampling ---
-        current_temp, current_top_k, current_top_p = self.default_temp, self.default_top_k, self.default_top_p
-        if self.in_level0_mode:
-            current_temp, current_top_k, current_top_p = self.level0_temp, self.level0_top_k, self.level0_top_p
-        elif self.in_level1_mode:
-            current_temp, current_top_k, current_top_p = self.level1_temp, self.level1_top_k, self.level1_top_p
-
-        scores = self._apply_sampling(scores, current_temp, current_top_k, current_top_p)
+        sampling_index = self.current_level + 1
+        temp = scores.new_tensor([self.default_temp, self.level0_temp, self.level1_temp])[sampling_index]
+        top_k = torch.tensor([self.default_top_k, self.level0_top_k, self.level1_top_k],
+                             device=scores.device)[sampling_index]
+        top_p = torch.tensor([self.default_top_p, self.level0_top_p, self.level1_top_p],
+                             device=scores.device)[sampling_index]
+        scores = _apply_batched_sampling(scores, temp, top_k, top_p,
+                                         max_top_k=max(self.default_top_k, self.level0_top_k, self.level1_top_k),
+                                         min_top_p=min(self.default_top_p, self.level0_top_p, self.level1_top_p))
 
         return scores
 
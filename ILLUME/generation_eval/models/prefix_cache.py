@@ -0,0 +1,144 @@
+from collections import Counter, OrderedDict
+
+import torch
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixKVEntry:
+    def __init__(self, token_ids, key_values, last_logits):
+        self.token_ids = token_ids  # tuple of ints
+        self.key_values = key_values  # tuple of (key, value) per layer, each [1, num_kv_heads, seq_len, head_dim]
+        self.last_logits = last_logits  # [vocab_size], logits after the last token
+        self.num_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in key_values) + \
+                         last_logits.numel() * last_logits.element_size()
+
+
+class PrefixKVCache:
+    """
+    LRU cache of prefilled `past_key_values`, keyed by the token ids of the prompt prefix.
+
+    Only prefixes that recur are worth a copy of their key/value states: the unconditional CFG prompt, identical
+    for a whole resolution bucket, and the conversation template up to the caption. `admit` tells whether a
+    prefix has been seen before, one-off prompts like the captioned ones are only remembered by their hash.
+
+    Entries are indexed by their token ids, `match` looks up the prefixes of a prompt of every cached length
+    instead of comparing the prompt with every entry. Entries are evicted in LRU order once `max_bytes` is
+    exceeded.
+
+    Only text prompts can be cached, the key/value states of image tokens depend on the image.
+
+    Args:
+        max_bytes (int): Memory budget of the cached key/value states.
+        min_prefix_length (int): Shorter shared prefixes are not worth a separate forward and are ignored.
+        max_seen (int): Number of hashes of prefixes seen once kept by `admit`.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, min_prefix_length=16, max_seen=4096):
+        self.max_bytes = max_bytes
+        self.min_prefix_length = min_prefix_length
+        self.max_seen = max_seen
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self._length_counts = Counter()  # number of entries of every length
+        self._seen = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token_ids):
+        """The entry of exactly `token_ids`, or None."""
+        token_ids = tuple(token_ids)
+        entry = self.entries.get(token_ids)
+        if entry is not None:
+            self.entries.move_to_end(token_ids)
+        return entry
+
+    def match(self, token_ids, max_length=None):
+        """Returns `(prefix_length, entry)` for the longest cached prefix of `token_ids`, or `(0, None)`."""
+        max_length = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        token_ids = tuple(token_ids)
+        for length in sorted(self._length_counts, reverse=True):
+            if length > max_length:
+                continue
+            if length < self.min_prefix_length:
+                break
+            entry = self.get(token_ids[:length])
+            if entry is not None:
+                return length, entry
+        return 0, None
+
+    def admit(self, token_ids):
+        """Whether `token_ids` has been seen before, remembering it otherwise."""
+        key = hash(tuple(token_ids))
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = None
+        while len(self._seen) > self.max_seen:
+            self._seen.popitem(last=False)
+        return False
+
+    def insert(self, token_ids, key_values, last_logits):
+        token_ids = tuple(token_ids)
+        if token_ids in self.entries:
+            self.entries.move_to_end(token_ids)
+            return
+        # clone, so that the entry does not keep the whole padded batch alive.
+        entry = PrefixKVEntry(token_ids,
+                              tuple((k.clone(), v.clone()) for k, v in key_values),
+                              last_logits.clone())
+        if entry.num_bytes > self.max_bytes:
+            return
+        self.entries[token_ids] = entry
+        self.num_bytes += entry.num_bytes
+        self._length_counts[len(token_ids)] += 1
+        while self.num_bytes > self.max_bytes:
+            evicted_ids, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.num_bytes
+            self._length_counts[len(evicted_ids)] -= 1
+            if not self._length_counts[len(evicted_ids)]:
+                del self._length_counts[len(evicted_ids)]
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+        self._length_counts.clear()
+        self._seen.clear()
+
+
+def merge_left_padded(key_values_list):
+    """
+    Stacks per-row key/value states of different lengths into one left-padded batch.
+
+    Args:
+        key_values_list: For every row, a tuple of (key, value) per layer, each [1, num_kv_heads, len_i, head_dim].
+
+    Returns:
+        The batched legacy cache (tuple of (key, value) per layer) and the [batch_size, max_len] attention mask.
+    """
+    lengths = [kv[0][0].shape[2] for kv in key_values_list]
+    max_length = max(lengths)
+    num_layers = len(key_values_list[0])
+    reference = key_values_list[0][0][0]
+    attention_mask = torch.zeros((len(lengths), max_length), dtype=torch.long, device=reference.device)
+    for i, length in enumerate(lengths):
+        attention_mask[i, max_length - length:] = 1
+
+    legacy_cache = []
+    for layer in range(num_layers):
+        layer_states = []
+        for j in range(2):
+            states = [kv[layer][j] for kv in key_values_list]
+            batched = states[0].new_zeros((len(states), states[0].shape[1], max_length, states[0].shape[3]))
+            for i, (state, length) in enumerate(zip(states, lengths)):
+                batched[i, :, max_length - length:] = state[0]
+            layer_states.append(batched)
+        legacy_cache.append(tuple(layer_states))
+    return tuple(legacy_cache), attention_mask
@@ -11,3 +11,4 @@ DEFAULT_IMAGE_PATCH_TOKEN = "<im_patch>"
 DEFAULT_IM_START_TOKEN = "<im_start>"
 DEFAULT_IM_END_TOKEN = "<im_end>"
 IMAGE_PLACEHOLDER = "<image-placeholder>"
+VISION_CODES_PLACEHOLDER = "<vision-codes-{}>"  # replaced with the token ids of the k-th image of a sample
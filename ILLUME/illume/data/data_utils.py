@@ -93,6 +93,35 @@ def encode_image_token_into_code(image_embed_inds, add_token_name="<|image_level
     return image_token_return
 
 
+def calculate_image_token_num(h, w, downsample_rate_per_level=[28, 16]):
+    '''
+    Token layout of a DualViTok image of size (h, w), see `encode_image_token_into_code`.
+    Returns:
+        [semantic_token_num, pixel_token_num], the number of tokens of the image with its structure tokens,
+        and the (h1, w1) semantic and (h2, w2) pixel code grids.
+    '''
+    # imported here, the tokenizer package loads the whole DualViTok stack
+    from tokenizer.dualvitok_model import RESOLUTION_MAPPING
+
+    # Level-0: semantic tokens, from the image resized by the semantic encoder
+    if (w, h) in RESOLUTION_MAPPING:
+        mapped_w, mapped_h = RESOLUTION_MAPPING[(w, h)]
+    else:
+        factor = downsample_rate_per_level[0]
+        mapped_w, mapped_h = max(factor, w // factor * factor), max(factor, h // factor * factor)
+    w1 = mapped_w // downsample_rate_per_level[0]
+    h1 = mapped_h // downsample_rate_per_level[0]
+    semantic_token_num = w1 * h1
+
+    # Level-1: pixel tokens
+    w2 = w // downsample_rate_per_level[1]
+    h2 = h // downsample_rate_per_level[1]
+    pixel_token_num = w2 * h2
+
+    max_token_length = (h1 * (w1 + 1) + 2) + (h2 * (w2 + 1) + 2) + 2 + 2 + 1 + 1
+    return [semantic_token_num, pixel_token_num], max_token_length, h1, w1, h2, w2
+
+
 def center_crop_and_resize(img, output_size=(256, 256)):
     target_h, target_w = output_size
     img_w, img_h = img.size
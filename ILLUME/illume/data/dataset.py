@@ -1,3 +1,4 @@
+import bisect
 import copy
 import json
 import orjson
@@ -7,6 +8,7 @@ import random
 from dataclasses import dataclass
 import tarfile
 from collections import defaultdict
+import numpy as np
 import torch
 from io import BytesIO
 from PIL import Image
@@ -15,10 +17,15 @@ from torch.utils.data import Dataset, ConcatDataset
 from illume.utils import rank0_print
 
 from .preprocess import *
-from ..constants import IGNORE_INDEX
-from ..mm_utils import expand2square, process_anyres_image
+from ..constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from ..mm_utils import expand2square, process_anyres_image, VisionTokenMapper
+from ..constants import VISION_CODES_PLACEHOLDER
 
-from .data_utils import ROLE_TEMPLATES, read_data_file, encode_image_token_into_code, center_crop_and_resize, return_all_files_in_dir
+from .data_utils import ROLE_TEMPLATES, read_data_file, encode_image_token_into_code, center_crop_and_resize, return_all_files_in_dir, \
+    calculate_image_token_num
+from .token_store import TokenStore, get_token_store_path
+from .indexed_jsonl import IndexedJsonlFile, LazyDataList
+from .length_cache import load_modality_lengths
 
 
 class DefaultDataset(Dataset):
@@ -40,6 +47,13 @@ class DefaultDataset(Dataset):
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
 
+        # splice the token ids of the generated images into the tokenized conversation, instead of tokenizing
+        # their vision token strings.
+        self.vision_token_mapper = None
+        if self.is_gen_task and data_args.get("direct_vision_token_ids", True):
+            self.vision_token_mapper = VisionTokenMapper(tokenizer,
+                                                         num_levels=data_args.get("vision_tokenizer_levels", 2))
+
     def load_data(self, meta_info):
         self.image_folder = meta_info["image_dir"] if "image_dir" in meta_info else ""
         self.dataset_name = meta_info["dataset_name"]
@@ -60,11 +74,24 @@ class DefaultDataset(Dataset):
 
     def _load_data(self, files, sample_num):
         total_num = 0
-        infos = []
+        segments = []
+        # first sample and token store path of every file with a binary token store, see `load_image_embed_inds`
+        self.token_store_starts, self.token_store_paths = [], []
+        self._token_stores = {}
         for i, file in enumerate(files):
-            cur_infos = read_data_file(file, load_with_bytes=True)
+            if file.endswith('.jsonl') and os.path.exists(file):
+                # lines are read on demand through an offset index cached next to the file
+                cur_infos = IndexedJsonlFile(file)
+            else:
+                cur_infos = read_data_file(file, load_with_bytes=True)
+            token_store_path = get_token_store_path(file)
+            if TokenStore.exists(token_store_path):
+                self.token_store_starts.append(total_num)
+                self.token_store_paths.append(token_store_path)
             total_num += len(cur_infos)
-            infos.extend(cur_infos)
+            segments.append(cur_infos)
+        infos = LazyDataList(segments)
+        self.data_files = list(zip(files, segments))
 
         if sample_num > 0:
             infos = infos[:sample_num]
@@ -77,11 +104,25 @@ class DefaultDataset(Dataset):
 
     @property
     def lengths(self):
-        return [1] * len(self.list_data_dict)  # not support yet
+        return [abs(length) for length in self.modality_lengths]
+
+    @property
+    def length_cache_files(self):
+        """`(file, infos, default_image_size)` of every annotation file, see `load_modality_lengths`."""
+        base_resolution = self.data_args.get("base_resolution", 256)
+        return [(file, infos, (base_resolution, base_resolution)) for file, infos in self.data_files]
+
+    def set_file_modality_lengths(self, file_lengths):
+        lengths = np.concatenate(file_lengths)[:len(self.list_data_dict)] if file_lengths \
+            else np.zeros(0, dtype=np.int32)
+        self._modality_lengths = lengths.tolist()
 
     @property
     def modality_lengths(self):
-        return [1] * len(self.list_data_dict)  # not support yet
+        """Token length of every sample, negative for text-only samples, cached next to the annotation files."""
+        if getattr(self, "_modality_lengths", None) is None:
+            self.set_file_modality_lengths(load_modality_lengths(self.length_cache_files, self.tokenizer))
+        return self._modality_lengths
 
     def get_ratio_tag_from_ratio(self, ratio):
         h, w = ratio
@@ -96,6 +137,7 @@ class DefaultDataset(Dataset):
         matched_ratios = info["matched_ratios"]
         image_cnt = 0
         images = []
+        vision_token_ids = []
         for conv in info["conversations"]:
             text_list = conv["value"].split(image_tag)
             image_num = len(text_list) - 1
@@ -115,20 +157,37 @@ class DefaultDataset(Dataset):
                 for i in range(image_num):
                     matched_ratio = matched_ratios[image_cnt]
                     ratio_tag = self.get_ratio_tag_from_ratio(matched_ratio)
-                    image_embed_string = encode_image_token_into_code(image_embed_inds[image_cnt])
+                    if self.vision_token_mapper is not None:
+                        image_embed_string = VISION_CODES_PLACEHOLDER.format(len(vision_token_ids))
+                        vision_token_ids.append(self.vision_token_mapper.codes_to_token_ids(image_embed_inds[image_cnt]))
+                    else:
+                        image_embed_string = encode_image_token_into_code(image_embed_inds[image_cnt])
                     text = re.sub(image_tag, ratio_tag + image_embed_string, text)
                     image_cnt += 1
             conv["value"] = text
 
+        output = {
+            "conversations": info["conversations"]
+        }
         if len(images):
-            return {
-                "images": images,
-                "conversations": info["conversations"]
-            }
-        else:
-            return {
-                "conversations": info["conversations"]
-            }
+            output["images"] = images
+        if len(vision_token_ids):
+            output["vision_token_ids"] = vision_token_ids
+        return output
+
+    def get_token_store(self, i):
+        file_id = bisect.bisect_right(self.token_store_starts, i) - 1
+        path = self.token_store_paths[file_id]
+        # opened lazily, so that every dataloader worker maps the files itself
+        if path not in self._token_stores:
+            self._token_stores[path] = TokenStore(path)
+        return self._token_stores[path]
+
+    def load_image_embed_inds(self, i, info):
+        """Reads the codes of samples whose jsonl record refers to the binary token store of its file."""
+        if "token_store_index" in info:
+            info["image_embed_inds"] = self.get_token_store(i)[info.pop("token_store_index")]
+        return info
 
     def get_one_sample_data(self, info):
         # replace <image> tag with vision token and ratio tag.
@@ -193,6 +252,7 @@ class DefaultDataset(Dataset):
             info = self.list_data_dict[i]
             if isinstance(info, bytes):
                 info = orjson.loads(info)
+            info = self.load_image_embed_inds(i, info)
             sources = self.get_one_sample_data(info)
         except Exception as e:
             print(e)
@@ -219,13 +279,15 @@ class DefaultDataset(Dataset):
                 image_list.append(image)
                 image_size_list.append(image_size)
 
+        vision_token_ids = sources[0].get("vision_token_ids")
         sources = copy.deepcopy([e["conversations"] for e in sources])
 
         try:
             data_dict = preprocess(
                 sources,
                 self.tokenizer,
-                has_image=has_image)
+                has_image=has_image,
+                vision_token_ids=vision_token_ids)
         except Exception as e:
             print(e)
             return self.__getitem__(random.randint(0, len(self) - 1))
@@ -341,28 +403,129 @@ class DataCollatorForSupervisedDataset(object):
         return batch
 
 
+@dataclass
+class DataCollatorForPackedDataset(DataCollatorForSupervisedDataset):
+    """
+    Collate examples for supervised fine-tuning by packing them into as few rows of `model_max_length` as possible.
+
+    The samples of a row are concatenated without padding, and `position_ids` restart from 0 at every sample. The
+    model splices the image features per sample and keeps samples from attending to each other, see
+    `prepare_inputs_labels_for_multimodal`. Rows are padded to the longest one with a padding segment of their own.
+    `packing_efficiency` is the fraction of the batch taken by sample tokens, logged by the trainer.
+    """
+
+    def estimate_length(self, instance):
+        """Token length of a sample after its images are spliced in, the image features counted from their size."""
+        input_ids = instance['input_ids'][:self.tokenizer.model_max_length]
+        num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+        length = len(input_ids) - num_images
+        for image in instance.get('image', [])[:num_images]:
+            h, w = image.shape[-2:]
+            length += calculate_image_token_num(h, w)[1]
+        return length
+
+    def pack(self, lengths):
+        """First-fit decreasing, returns the sample indices of every row in their original order."""
+        max_length = self.tokenizer.model_max_length
+        rows, row_lengths = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for row_id, row_length in enumerate(row_lengths):
+                if row_length + lengths[i] <= max_length:
+                    rows[row_id].append(i)
+                    row_lengths[row_id] += lengths[i]
+                    break
+            else:
+                rows.append([i])
+                row_lengths.append(lengths[i])
+        return [sorted(row) for row in rows]
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        lengths = [self.estimate_length(instance) for instance in instances]
+        rows = self.pack(lengths)
+        row_lengths = [sum(lengths[i] for i in row) for row in rows]
+
+        input_ids, labels, position_ids, images, image_sizes = [], [], [], [], []
+        for row in rows:
+            row_input_ids, row_labels, row_images, row_image_sizes = [], [], [], []
+            for i in row:
+                cur_input_ids = instances[i]['input_ids'][:self.tokenizer.model_max_length]
+                cur_labels = instances[i]['labels'][:self.tokenizer.model_max_length].clone()
+                # the first token of a sample is never a target, and must not be predicted from the previous sample
+                cur_labels[0] = IGNORE_INDEX
+                row_input_ids.append(cur_input_ids)
+                row_labels.append(cur_labels)
+                # text-only samples come with a dummy image, only keep the images that are spliced in
+                if (cur_input_ids == IMAGE_TOKEN_INDEX).any():
+                    row_images.extend(instances[i]['image'])
+                    row_image_sizes.extend(instances[i]['image_size'])
+            if not row_images:
+                # a row without image tokens consumes one image, see `prepare_inputs_labels_for_multimodal`
+                row_images = instances[row[0]].get('image', [])[:1]
+                row_image_sizes = instances[row[0]].get('image_size', [])[:1]
+            input_ids.append(torch.cat(row_input_ids))
+            labels.append(torch.cat(row_labels))
+            position_ids.append(torch.cat([torch.arange(len(x)) for x in row_input_ids]))
+            images.extend(row_images)
+            image_sizes.extend(row_image_sizes)
+
+        max_len = max(len(x) for x in input_ids)
+        for i in range(len(input_ids)):
+            pad_len = max_len - len(input_ids[i])
+            input_ids[i] = torch.cat([input_ids[i], input_ids[i].new_full((pad_len,), self.tokenizer.pad_token_id)])
+            labels[i] = torch.cat([labels[i], labels[i].new_full((pad_len,), IGNORE_INDEX)])
+            position_ids[i] = torch.cat([position_ids[i], torch.arange(pad_len)])
+
+        batch = dict(
+            input_ids=torch.stack(input_ids),
+            labels=torch.stack(labels),
+            position_ids=torch.stack(position_ids),
+            dataset_names=[instance['dataset_name'] for instance in instances],
+            packing_efficiency=sum(row_lengths) / (len(rows) * max(row_lengths)),
+        )
+        batch['images'] = images if images else None
+        batch['image_sizes'] = image_sizes
+        return batch
+
+
 class CustomConcatDataset(ConcatDataset):
     def __init__(self, datasets):
         super().__init__(datasets)
-        self.modality_lengths = self._compute_modality_lengths()
-        self.lengths = self._compute_lengths()
+        # computed on first use, only the length grouped samplers need them
+        self._modality_lengths = None
+
+    @property
+    def modality_lengths(self):
+        if self._modality_lengths is None:
+            self._modality_lengths = self._compute_modality_lengths()
+        return self._modality_lengths
+
+    @property
+    def lengths(self):
+        return [abs(length) for length in self.modality_lengths]
 
     def _compute_modality_lengths(self):
+        # the missing lengths of all datasets are computed in one pass spread over the ranks.
+        pending = [dataset for dataset in self.datasets
+                   if hasattr(dataset, "length_cache_files") and getattr(dataset, "_modality_lengths", None) is None]
+        if pending:
+            files = [dataset.length_cache_files for dataset in pending]
+            file_lengths = load_modality_lengths([f for dataset_files in files for f in dataset_files],
+                                                 pending[0].tokenizer)
+            for dataset, dataset_files in zip(pending, files):
+                dataset.set_file_modality_lengths(file_lengths[:len(dataset_files)])
+                file_lengths = file_lengths[len(dataset_files):]
         modality_lengths = []
         for dataset in self.datasets:
             modality_lengths.extend(dataset.modality_lengths)
         return modality_lengths
 
-    def _compute_lengths(self):
-        lengths = []
-        for dataset in self.datasets:
-            lengths.extend(dataset.lengths)
-        return lengths
-
 
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                                 data_args) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
+    # the packed collator keeps the images as a list per sample, like the anyres_dualvitok collate
+    if data_args.get("packing", False) and "anyres_dualvitok" not in data_args.image_aspect_ratio:
+        raise ValueError(f"packing is not supported with image_aspect_ratio {data_args.image_aspect_ratio}")
 
     train_dataset = []
     meta_data_info_list = data_args.meta_data_info_list
@@ -398,8 +561,12 @@ def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
     rank0_print(f"dataset length: {train_dataset.__len__()}")
     rank0_print("------------------------------------------------")
 
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer,
+    if data_args.get("packing", False):
+        data_collator = DataCollatorForPackedDataset(tokenizer=tokenizer,
                                                      image_aspect_ratio=data_args.image_aspect_ratio)
+    else:
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer,
+                                                         image_aspect_ratio=data_args.image_aspect_ratio)
     return dict(train_dataset=train_dataset,
                 eval_dataset=None,
                 data_collator=data_collator)
@@ -0,0 +1,129 @@
+import bisect
+import mmap
+import os
+
+import numpy as np
+
+
+def get_line_index_path(file):
+    return file + ".index.npy"
+
+
+def build_line_index(file, chunk_size=64 * 1024 ** 2):
+    """Returns the byte offsets of the lines of `file`, plus the file size as the end of the last line."""
+    starts = [np.zeros(1, dtype=np.int64)]
+    file_size = 0
+    with open(file, "rb") as fr:
+        while True:
+            chunk = fr.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype(np.int64) + file_size + 1)
+            file_size += len(chunk)
+    offsets = np.concatenate(starts)
+    # a trailing newline does not start another line
+    if len(offsets) > 1 and offsets[-1] == file_size:
+        offsets = offsets[:-1]
+    if file_size == 0:
+        offsets = offsets[:0]
+    return np.concatenate([offsets, np.asarray([file_size], dtype=np.int64)])
+
+
+def load_line_index(file):
+    """
+    Loads the line index of `file` from its cache `<file>.index.npy`, building and caching it if needed.
+
+    The cache is memory mapped, so that all ranks and dataloader workers share it through the page cache. It is
+    rebuilt when the jsonl file is newer or has a different size. If the cache can not be written, e.g. in a
+    read-only directory, the index is kept in memory.
+    """
+    index_path = get_line_index_path(file)
+    file_size = os.path.getsize(file)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(file):
+        offsets = np.load(index_path, mmap_mode='r')
+        if len(offsets) and offsets[-1] == file_size:
+            return offsets
+
+    offsets = build_line_index(file)
+    tmp_path = f"{index_path}.tmp{os.getpid()}.npy"
+    try:
+        np.save(tmp_path, offsets)
+        os.replace(tmp_path, index_path)  # atomic, other ranks may build the same index
+    except OSError as e:
+        print(f"can not cache the line index of {file}: {e}")
+        return offsets
+    return np.load(index_path, mmap_mode='r')
+
+
+class IndexedJsonlFile:
+    """
+    Random access to the lines of a jsonl file through its line index and a read-only memory map.
+
+    `file[i]` returns line `i` as bytes, including its newline, the same as the items of `open(file, "rb")`.
+    The memory map is opened on first access, and a pickled copy, e.g. in a spawned dataloader worker, maps the
+    file and its index itself instead of copying them.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.offsets = load_line_index(file)
+        self._mmap = None
+
+    def __getstate__(self):
+        return {"file": self.file}
+
+    def __setstate__(self, state):
+        self.__init__(state["file"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"line {i} out of range of {self.file}")
+        if self._mmap is None:
+            with open(self.file, "rb") as fr:
+                self._mmap = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+
+class LazyDataList:
+    """
+    Concatenates the samples of several annotation files without loading them, like a list.
+
+    Args:
+        segments (list): `IndexedJsonlFile`s or lists of already loaded samples.
+        max_len (int, *optional*): Only the first `max_len` samples are visible.
+    """
+
+    def __init__(self, segments, max_len=None):
+        self.segments = [segment for segment in segments if len(segment)]
+        self.starts = []
+        total = 0
+        for segment in self.segments:
+            self.starts.append(total)
+            total += len(segment)
+        self.length = total if max_len is None else min(total, max_len)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if start == 0 and step == 1:
+                return LazyDataList(self.segments, max_len=stop)
+            return [self[j] for j in range(start, stop, step)]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(f"index {i} out of range")
+        segment_id = bisect.bisect_right(self.starts, i) - 1
+        return self.segments[segment_id][i - self.starts[segment_id]]
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
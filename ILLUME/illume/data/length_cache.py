@@ -0,0 +1,122 @@
+import hashlib
+import os
+
+import numpy as np
+import orjson
+import torch.distributed as dist
+
+from .data_utils import calculate_image_token_num
+
+
+def get_length_cache_path(file, tokenizer, default_image_size):
+    """
+    `<file>.lengths.<key>.npy`, the key covers everything the lengths depend on besides the file itself: the
+    tokenizer (name and vocab size) and the size assumed for images without matched ratios.
+    """
+    key = f"{tokenizer.name_or_path}|{len(tokenizer)}|{tuple(default_image_size)}"
+    return f"{file}.lengths.{hashlib.md5(key.encode('utf-8')).hexdigest()[:12]}.npy"
+
+
+def compute_modality_lengths(infos, tokenizer, default_image_size=(256, 256), start=0, stop=None, batch_size=1024):
+    """
+    Returns the token length of the samples `infos[start:stop]`, negative for text-only samples like in
+    `get_modality_length_grouped_indices`.
+
+    Text tokens are counted by tokenizing the conversations without their image tags. Every image adds the tokens
+    of its `matched_ratios` entry, or of `default_image_size` if the sample has no matched ratios.
+    """
+    stop = len(infos) if stop is None else min(stop, len(infos))
+    lengths = np.zeros(max(stop - start, 0), dtype=np.int32)
+    for batch_start in range(start, stop, batch_size):
+        texts, image_token_nums, is_multimodal = [], [], []
+        for i in range(batch_start, min(batch_start + batch_size, stop)):
+            info = infos[i]
+            if isinstance(info, bytes):
+                try:
+                    info = orjson.loads(info)
+                except orjson.JSONDecodeError:  # broken lines are skipped by the dataset anyway
+                    info = {"conversations": []}
+            text = "".join(conv["value"] for conv in info["conversations"])
+            num_images = text.count("<image>")
+            texts.append(text.replace("<image>", "").replace("{resolution_tag}", ""))
+
+            ratios = info.get("matched_ratios") or [default_image_size] * num_images
+            image_token_nums.append(sum(calculate_image_token_num(h, w)[1] for h, w in ratios[:num_images]))
+            is_multimodal.append(num_images > 0)
+
+        text_lengths = [len(input_ids) for input_ids in tokenizer(texts, add_special_tokens=False).input_ids]
+        for j, (text_length, image_token_num, multimodal) in enumerate(zip(text_lengths, image_token_nums,
+                                                                          is_multimodal)):
+            length = max(1, text_length + image_token_num)
+            lengths[batch_start - start + j] = length if multimodal else -length
+    return lengths
+
+
+def read_length_cache(file, num_samples, tokenizer, default_image_size):
+    """The cached lengths of `file`, or None if there are none, the file is newer or has another number of samples."""
+    cache_path = get_length_cache_path(file, tokenizer, default_image_size)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file):
+        lengths = np.load(cache_path)
+        if len(lengths) == num_samples:
+            return lengths
+    return None
+
+
+def write_length_cache(file, lengths, tokenizer, default_image_size):
+    cache_path = get_length_cache_path(file, tokenizer, default_image_size)
+    tmp_path = f"{cache_path}.tmp{os.getpid()}.npy"
+    try:
+        np.save(tmp_path, lengths)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"can not cache the token lengths of {file}: {e}")
+
+
+def load_modality_lengths(files, tokenizer, chunk_size=2 ** 16):
+    """
+    Loads the modality lengths of the samples of annotation files from their caches next to them, computing and
+    caching the missing ones.
+
+    Args:
+        files: `(file, infos, default_image_size)` of every annotation file.
+        chunk_size (int): The missing lengths are computed in chunks of samples spread over the ranks, and
+            gathered on every rank. Rank 0 writes the caches.
+    Returns:
+        The lengths of every file.
+    """
+    is_distributed = dist.is_available() and dist.is_initialized()
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if is_distributed else (0, 1)
+
+    results = [read_length_cache(file, len(infos), tokenizer, default_image_size)
+               for file, infos, default_image_size in files]
+    # every rank has to compute the same chunks, recompute a file if any rank misses its cache
+    missing = [lengths is None for lengths in results]
+    if is_distributed:
+        all_missing = [None] * world_size
+        dist.all_gather_object(all_missing, missing)
+        missing = [any(rank_missing) for rank_missing in zip(*all_missing)]
+
+    chunks = [(i, start) for i, (_, infos, _) in enumerate(files) if missing[i]
+              for start in range(0, len(infos), chunk_size)]
+    if not chunks:
+        return results
+
+    computed = {}
+    for i, start in chunks[rank::world_size]:
+        _, infos, default_image_size = files[i]
+        computed[(i, start)] = compute_modality_lengths(infos, tokenizer, default_image_size=default_image_size,
+                                                        start=start, stop=start + chunk_size)
+    if is_distributed:
+        all_computed = [None] * world_size
+        dist.all_gather_object(all_computed, computed)
+        computed = {key: lengths for rank_computed in all_computed for key, lengths in rank_computed.items()}
+
+    for i, (file, infos, default_image_size) in enumerate(files):
+        if not missing[i]:
+            continue
+        starts = range(0, len(infos), chunk_size)
+        results[i] = np.concatenate([computed[(i, start)] for start in starts]) if len(infos) \
+            else np.zeros(0, dtype=np.int32)
+        if rank == 0:
+            write_length_cache(file, results[i], tokenizer, default_image_size)
+    return results
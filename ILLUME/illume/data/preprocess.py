@@ -1,14 +1,15 @@
 import copy
+import functools
 import torch
 import torch.distributed as dist
 import transformers
 
 from typing import Dict, Optional, Sequence, List
 
-from illume.mm_utils import tokenizer_image_token
+from illume.mm_utils import tokenizer_image_token, tokenizer_vision_token
 
 from illume.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, \
-    DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+    DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, VISION_CODES_PLACEHOLDER
 
 from illume import conversation as conversation_lib
 
@@ -548,10 +549,106 @@ def preprocess_llama3_expand(
     )
 
 
+@functools.lru_cache(maxsize=64)
+def _tokenize_template_fragment(tokenizer, text):
+    return tuple(tokenizer(text).input_ids)
+
+
+@functools.lru_cache(maxsize=64)
+def _starts_with_added_token(tokenizer, text):
+    return any(text.startswith(token.content) and not token.lstrip
+               for token in tokenizer.added_tokens_decoder.values())
+
+
+def _preprocess_mpt_single_pass(
+    conversation,
+    conv,
+    tokenizer: transformers.PreTrainedTokenizer,
+    has_image: bool = False,
+    vision_token_ids=None
+) -> Optional[Dict]:
+    """
+    Tokenizes the prompt `conversation` of the messages of `conv` message by message, and masks the labels with the
+    token counts of the messages, instead of tokenizing every round and its instruction again.
+
+    The roles and the separator start with added tokens, which split the text before the tokenization, so the ids of
+    the messages concatenate to the ids of the whole prompt. The round and instruction lengths are those of the
+    round by round masking of `preprocess_qwen2`, its off-by-one cases included, and the system prompt, the roles
+    and the separator are tokenized once per tokenizer. Returns None for prompts this does not hold for, e.g.
+    messages containing the separator, which are left to the round by round masking.
+    """
+    sep, user, assistant = conv.sep, conv.roles[0], conv.roles[1]
+    messages = [message for _, message in conv.messages]
+    round_sep = sep + assistant
+    if (len(messages) < 2 or len(messages) % 2 == 1
+            or not all(isinstance(message, str) and message for message in messages)
+            or _tokenize_template_fragment(tokenizer, "")
+            or not all(_starts_with_added_token(tokenizer, text) for text in (user, assistant, sep))):
+        return None
+    turns = [role + message for role, message in zip([user, assistant] * len(messages), messages)]
+    if conversation.split(sep) != [conv.system] + turns + [""]:
+        return None
+    for i in range(0, len(turns), 2):
+        prefix = conv.system + sep if i == 0 else ""
+        if (prefix + turns[i] + sep + turns[i + 1]).split(round_sep) != [prefix + turns[i], messages[i + 1]]:
+            return None
+    system_ids = _tokenize_template_fragment(tokenizer, conv.system + sep)
+    if tokenizer.bos_token_id is not None and tokenizer.bos_token_id in [
+            _tokenize_template_fragment(tokenizer, text)[0] for text in (conv.system + sep, user, assistant)]:
+        return None
+
+    if vision_token_ids is not None:
+        turn_ids = [tokenizer_vision_token(turn + sep, tokenizer, vision_token_ids, has_image=has_image)
+                    for turn in turns]
+    elif has_image:
+        turn_ids = [tokenizer_image_token(turn + sep, tokenizer) for turn in turns]
+    else:
+        turn_ids = [tokenizer(turn + sep).input_ids for turn in turns]
+
+    input_ids = list(system_ids)
+    for ids in turn_ids:
+        input_ids.extend(ids)
+    if vision_token_ids is None and not has_image and len(input_ids) > tokenizer.model_max_length:
+        if tokenizer.truncation_side == "left":
+            input_ids = input_ids[-tokenizer.model_max_length:]
+        else:
+            input_ids = input_ids[:tokenizer.model_max_length]
+    input_ids = torch.tensor([input_ids], dtype=torch.long)
+    targets = input_ids.clone()
+    target = targets[0]
+    total_len = int(target.ne(tokenizer.pad_token_id).sum())
+
+    # the separator after a round counts as 2 tokens, an instruction ends with the assistant role tokenized alone
+    sep_len = len(_tokenize_template_fragment(tokenizer, sep))
+    assistant_len = len(_tokenize_template_fragment(tokenizer, assistant))
+    cur_len = 0
+    for i in range(0, len(turn_ids), 2):
+        prefix_len = len(system_ids) if i == 0 else 0
+        instruction_len = prefix_len + len(turn_ids[i]) + assistant_len
+        round_len = prefix_len + len(turn_ids[i]) + len(turn_ids[i + 1]) - sep_len + 2
+        target[cur_len: cur_len + instruction_len] = IGNORE_INDEX
+        cur_len += round_len
+    target[cur_len:] = IGNORE_INDEX
+
+    if cur_len < tokenizer.model_max_length:
+        if cur_len != total_len:
+            target[:] = IGNORE_INDEX
+            print(
+                f"WARNING: tokenization mismatch: {cur_len} vs. {total_len}."
+                f" (ignored)"
+            )
+
+    return dict(
+        input_ids=input_ids,
+        labels=targets,
+    )
+
+
 def preprocess_qwen2(
     sources,
     tokenizer: transformers.PreTrainedTokenizer,
-    has_image: bool = False
+    has_image: bool = False,
+    vision_token_ids=None
 ) -> Dict:
     conv = conversation_lib.default_conversation.copy()
     roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
@@ -570,9 +667,19 @@ def preprocess_qwen2(
             conv.append_message(role, sentence["value"])
         conversations.append(conv.get_prompt())
 
+    if len(sources) == 1:
+        data_dict = _preprocess_mpt_single_pass(conversations[0], conv, tokenizer, has_image=has_image,
+                                                vision_token_ids=vision_token_ids)
+        if data_dict is not None:
+            return data_dict
+
     # Tokenize conversations
 
-    if has_image:
+    if vision_token_ids is not None:
+        input_ids = torch.stack(
+            [tokenizer_vision_token(prompt, tokenizer, vision_token_ids, has_image=has_image, return_tensors='pt')
+             for prompt in conversations], dim=0)
+    elif has_image:
         input_ids = torch.stack(
             [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations], dim=0)
     else:
@@ -607,7 +714,11 @@ def preprocess_qwen2(
                 break
             parts[0] += sep
 
-            if has_image:
+            if vision_token_ids is not None:
+                round_len = len(tokenizer_vision_token(rou, tokenizer, vision_token_ids, has_image=has_image)) + 1
+                instruction_len = len(tokenizer_vision_token(parts[0], tokenizer, vision_token_ids,
+                                                             has_image=has_image))
+            elif has_image:
                 round_len = len(tokenizer_image_token(rou, tokenizer)) + 1
                 instruction_len = len(tokenizer_image_token(parts[0], tokenizer))
             else:
@@ -638,7 +749,8 @@ def preprocess_qwen2(
 def preprocess_qwen2_think(
     sources,
     tokenizer: transformers.PreTrainedTokenizer,
-    has_image: bool = False
+    has_image: bool = False,
+    vision_token_ids=None
 ) -> Dict:
     conv = conversation_lib.default_conversation.copy()
     roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
@@ -657,9 +769,19 @@ def preprocess_qwen2_think(
             conv.append_message(role, sentence["value"])
         conversations.append(conv.get_prompt())
 
+    if len(sources) == 1:
+        data_dict = _preprocess_mpt_single_pass(conversations[0], conv, tokenizer, has_image=has_image,
+                                                vision_token_ids=vision_token_ids)
+        if data_dict is not None:
+            return data_dict
+
     # Tokenize conversations
 
-    if has_image:
+    if vision_token_ids is not None:
+        input_ids = torch.stack(
+            [tokenizer_vision_token(prompt, tokenizer, vision_token_ids, has_image=has_image, return_tensors='pt')
+             for prompt in conversations], dim=0)
+    elif has_image:
         input_ids = torch.stack(
             [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations], dim=0)
     else:
@@ -694,7 +816,11 @@ def preprocess_qwen2_think(
                 break
             parts[0] += sep
 
-            if has_image:
+            if vision_token_ids is not None:
+                round_len = len(tokenizer_vision_token(rou, tokenizer, vision_token_ids, has_image=has_image)) + 1
+                instruction_len = len(tokenizer_vision_token(parts[0], tokenizer, vision_token_ids,
+                                                             has_image=has_image))
+            elif has_image:
                 round_len = len(tokenizer_image_token(rou, tokenizer)) + 1
                 instruction_len = len(tokenizer_image_token(parts[0], tokenizer))
             else:
@@ -828,10 +954,23 @@ def preprocess_glm4(
     )
 
 
+def restore_vision_token_strings(sources, tokenizer, vision_token_ids):
+    """Replaces the `VISION_CODES_PLACEHOLDER`s with the vision token strings, for the string-only templates."""
+    for source in sources:
+        for sentence in source:
+            for k, token_ids in enumerate(vision_token_ids):
+                placeholder = VISION_CODES_PLACEHOLDER.format(k)
+                if placeholder in sentence["value"]:
+                    image_tokens = "".join(tokenizer.convert_ids_to_tokens([int(x) for x in token_ids]))
+                    sentence["value"] = sentence["value"].replace(placeholder, image_tokens)
+    return sources
+
+
 def preprocess(
     sources: Sequence[str],
     tokenizer: transformers.PreTrainedTokenizer,
-    has_image: bool = False
+    has_image: bool = False,
+    vision_token_ids=None
 ) -> Dict:
     """
     Given a list of sources, each is a conversation list. This transform:
@@ -839,7 +978,16 @@ def preprocess(
     2. Concatenate conversations together;
     3. Tokenize the concatenated conversation;
     4. Make a deepcopy as the target. Mask human words with IGNORE_INDEX.
+
+    `vision_token_ids` are the token ids of the `VISION_CODES_PLACEHOLDER`s in the sources. The qwen2 templates
+    splice them into the tokenized conversation, the other templates tokenize them back from strings.
     """
+    if vision_token_ids is not None:
+        if conversation_lib.default_conversation.version == "qwen2":
+            return preprocess_qwen2(sources, tokenizer, has_image=has_image, vision_token_ids=vision_token_ids)
+        if conversation_lib.default_conversation.version == "qwen2_think":
+            return preprocess_qwen2_think(sources, tokenizer, has_image=has_image, vision_token_ids=vision_token_ids)
+        sources = restore_vision_token_strings(sources, tokenizer, vision_token_ids)
     if conversation_lib.default_conversation.sep_style == conversation_lib.SeparatorStyle.PLAIN:
         return preprocess_plain(sources, tokenizer)
     if conversation_lib.default_conversation.sep_style == conversation_lib.SeparatorStyle.LLAMA_2:
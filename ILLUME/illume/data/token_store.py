@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+
+
+CODES_FILE = "codes.bin"
+LEVEL_INDEX_FILE = "level_index.npy"
+IMAGE_INDEX_FILE = "image_index.npy"
+SAMPLE_INDEX_FILE = "sample_index.npy"
+
+
+def get_token_store_path(jsonl_file):
+    """The token store of a codebook jsonl file is the directory `<file>.tokens` next to it."""
+    return os.path.splitext(jsonl_file)[0] + ".tokens"
+
+
+class TokenStoreWriter:
+    """
+    Writes the DualViTok codes of a codebook jsonl file into a binary token store.
+
+    The codes of all samples are appended to `codes.bin` as flat uint32 arrays. Three index arrays locate them:
+        level_index.npy  [num_levels, 3]   (offset in codes.bin, h, w) of every level of every image
+        image_index.npy  [num_images + 1]  first row of every image in level_index
+        sample_index.npy [num_samples + 1] first row of every sample in image_index
+    `sample_index.npy` is written last by `close`, a store without it is incomplete.
+
+    Usage:
+        writer = TokenStoreWriter(get_token_store_path(out_file))
+        record["token_store_index"] = writer.add(record.pop("image_embed_inds"))
+        writer.close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        sample_index_file = os.path.join(path, SAMPLE_INDEX_FILE)
+        if os.path.exists(sample_index_file):
+            os.remove(sample_index_file)
+        self.f_codes = open(os.path.join(path, CODES_FILE), 'wb')
+        self.num_codes = 0
+        self.level_index = []
+        self.image_index = [0]
+        self.sample_index = [0]
+
+    def add(self, image_embed_inds):
+        """
+        Args:
+            image_embed_inds: Codes of one sample, [image][level][h][w].
+        Returns:
+            The index of the sample in the store.
+        """
+        for image_embed_ind in image_embed_inds:
+            for level_codes in image_embed_ind:
+                level_codes = np.asarray(level_codes, dtype=np.uint32)
+                assert level_codes.ndim == 2, f"expect [h, w] codes, got shape {level_codes.shape}"
+                self.f_codes.write(level_codes.tobytes())
+                self.level_index.append((self.num_codes, level_codes.shape[0], level_codes.shape[1]))
+                self.num_codes += level_codes.size
+            self.image_index.append(len(self.level_index))
+        self.sample_index.append(len(self.image_index) - 1)
+        return len(self.sample_index) - 2
+
+    def close(self):
+        self.f_codes.close()
+        np.save(os.path.join(self.path, LEVEL_INDEX_FILE), np.asarray(self.level_index, dtype=np.int64).reshape(-1, 3))
+        np.save(os.path.join(self.path, IMAGE_INDEX_FILE), np.asarray(self.image_index, dtype=np.int64))
+        np.save(os.path.join(self.path, SAMPLE_INDEX_FILE), np.asarray(self.sample_index, dtype=np.int64))
+
+
+class TokenStore:
+    """
+    Read-only view of a token store written by `TokenStoreWriter`.
+
+    The codes and the index are memory mapped, `store[i]` returns the codes of sample `i` as views into the
+    mapped file, [image][level] of uint32 arrays of shape [h, w], without copying or parsing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.level_index = np.load(os.path.join(path, LEVEL_INDEX_FILE), mmap_mode='r')
+        self.image_index = np.load(os.path.join(path, IMAGE_INDEX_FILE), mmap_mode='r')
+        self.sample_index = np.load(os.path.join(path, SAMPLE_INDEX_FILE), mmap_mode='r')
+        codes_file = os.path.join(path, CODES_FILE)
+        if os.path.getsize(codes_file) > 0:
+            self.codes = np.memmap(codes_file, dtype=np.uint32, mode='r')
+        else:  # np.memmap can not map an empty file
+            self.codes = np.zeros(0, dtype=np.uint32)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, SAMPLE_INDEX_FILE))
+
+    def __len__(self):
+        return len(self.sample_index) - 1
+
+    def __getitem__(self, i):
+        image_embed_inds = []
+        for image_id in range(self.sample_index[i], self.sample_index[i + 1]):
+            levels = []
+            for offset, h, w in self.level_index[self.image_index[image_id]:self.image_index[image_id + 1]]:
+                levels.append(self.codes[offset:offset + h * w].reshape(h, w))
+            image_embed_inds.append(levels)
+        return image_embed_inds
@@ -5,9 +5,13 @@ import torch
 import math
 import ast
 import random
+import re
+import threading
+import numpy as np
+from collections import OrderedDict
 
 from transformers import StoppingCriteria
-from illume.constants import IMAGE_TOKEN_INDEX
+from illume.constants import IMAGE_TOKEN_INDEX, VISION_CODES_PLACEHOLDER
 
 select_metric = 'org'
 max_image_pixels = None
@@ -265,10 +269,7 @@ def process_images(images, image_processor, model_cfg, config, is_gen_task=False
     return new_images, image_sizes
 
 
-def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
-    # print("prompt in tokenizer_image_token", prompt)
-    prompt_chunks = [tokenizer(chunk).input_ids for chunk in prompt.split('<image>')]
-
+def _join_image_chunks(prompt_chunks, tokenizer, image_token_index):
     def insert_separator(X, sep):
         return [ele for sublist in zip(X, [sep] * len(X)) for ele in sublist][:-1]
 
@@ -280,6 +281,13 @@ def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX
 
     for x in insert_separator(prompt_chunks, [image_token_index] * (offset + 1)):
         input_ids.extend(x[offset:])
+    return input_ids
+
+
+def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
+    # print("prompt in tokenizer_image_token", prompt)
+    prompt_chunks = [tokenizer(chunk).input_ids for chunk in prompt.split('<image>')]
+    input_ids = _join_image_chunks(prompt_chunks, tokenizer, image_token_index)
 
     if return_tensors is not None:
         if return_tensors == 'pt':
@@ -289,6 +297,245 @@ def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX
     return input_ids
 
 
+# candidates for the added tokens of a prompt: `<|im_start|>`, `<height_512>`, ...
+_ADDED_TOKEN_PATTERN = re.compile(r'(<[^<>\s]+>)')
+
+
+class PromptChunkCache:
+    """
+    Cache of the token ids of the fixed fragments of prompts, see `tokenizer_image_token_batch`.
+
+    Prompts are split at the added tokens of the tokenizer (`<|im_start|>`, `<|im_end|>`, the resolution tags),
+    which the tokenizer never merges with the text around them. The added tokens are looked up directly, and the
+    text fragments between them that come back, the system template, the role headers and the instruction
+    templates around the resolution tags, are cached once they have been seen twice. The caption fragments are
+    seen once and only remembered by their hash. A cache is only valid for the tokenizer it is used with, and can
+    be shared by threads.
+    """
+
+    def __init__(self, max_size=4096, max_seen=4096):
+        self.max_size = max_size
+        self.max_seen = max_seen
+        self.hits = 0
+        self.misses = 0
+        self._input_ids = OrderedDict()
+        self._seen = OrderedDict()
+        self._tokenizer_info = None
+        self._lock = threading.Lock()
+
+    def get_tokenizer_info(self, tokenizer):
+        """
+        The ids of the added tokens that can split a prompt (the ones without lstrip, rstrip or single_word), and
+        the ids the tokenizer adds before every text, e.g. a bos token.
+        """
+        with self._lock:
+            if self._tokenizer_info is None:
+                added_token_ids = {token.content: token_id
+                                   for token_id, token in tokenizer.added_tokens_decoder.items()
+                                   if not (token.lstrip or token.rstrip or token.single_word)}
+                self._tokenizer_info = added_token_ids, tokenizer("").input_ids
+            return self._tokenizer_info
+
+    def get(self, fragment):
+        with self._lock:
+            input_ids = self._input_ids.get(fragment)
+            if input_ids is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._input_ids.move_to_end(fragment)
+            return input_ids
+
+    def put(self, fragment, input_ids):
+        """Caches the ids of `fragment` if it has been put before."""
+        key = hash(fragment)
+        with self._lock:
+            if key not in self._seen:
+                self._seen[key] = None
+                while len(self._seen) > self.max_seen:
+                    self._seen.popitem(last=False)
+                return
+            self._input_ids[fragment] = input_ids
+            self._input_ids.move_to_end(fragment)
+            while len(self._input_ids) > self.max_size:
+                self._input_ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._input_ids.clear()
+            self._seen.clear()
+            self._tokenizer_info = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._input_ids)
+
+
+def _split_added_tokens(text, added_token_ids):
+    """Splits `text` into text fragments and added tokens, which are returned as their ids."""
+    fragments = ['']
+    for i, piece in enumerate(_ADDED_TOKEN_PATTERN.split(text)):
+        if i % 2 == 1 and piece in added_token_ids:
+            fragments += [added_token_ids[piece], '']
+        else:
+            fragments[-1] += piece
+    return [fragment for fragment in fragments if fragment != '']
+
+
+def tokenizer_image_token_batch(prompts, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, return_tensors=None,
+                                chunk_cache=None):
+    """
+    Batched `tokenizer_image_token`, giving the same ids for every prompt.
+
+    The chunks of all `prompts` are tokenized with a single call of the tokenizer, each distinct chunk once. With
+    a `chunk_cache` (a `PromptChunkCache`), the chunks are split at the added tokens and only the text fragments
+    missing from the cache are tokenized. Tokenizers that add special tokens after a text are not supported then.
+
+    Returns:
+        list: The input ids of every prompt, as tensors if `return_tensors` is 'pt'.
+    """
+    if return_tensors not in (None, 'pt'):
+        raise ValueError(f'Unsupported tensor type: {return_tensors}')
+    prompts_chunks = [prompt.split('<image>') for prompt in prompts]
+    chunks = list(OrderedDict.fromkeys(chunk for chunks in prompts_chunks for chunk in chunks))
+
+    if chunk_cache is None:
+        chunk_input_ids = dict(zip(chunks, tokenizer(chunks).input_ids))
+    else:
+        added_token_ids, prefix_ids = chunk_cache.get_tokenizer_info(tokenizer)
+        chunk_fragments = {chunk: _split_added_tokens(chunk, added_token_ids) for chunk in chunks}
+        fragment_input_ids = {}
+        for fragments in chunk_fragments.values():
+            for fragment in fragments:
+                if isinstance(fragment, str) and fragment not in fragment_input_ids:
+                    fragment_input_ids[fragment] = chunk_cache.get(fragment)
+        missing = [fragment for fragment, input_ids in fragment_input_ids.items() if input_ids is None]
+        if missing:
+            for fragment, input_ids in zip(missing, tokenizer(missing, add_special_tokens=False).input_ids):
+                fragment_input_ids[fragment] = input_ids
+                chunk_cache.put(fragment, input_ids)
+
+        chunk_input_ids = {}
+        for chunk, fragments in chunk_fragments.items():
+            input_ids = list(prefix_ids)
+            for fragment in fragments:
+                if isinstance(fragment, str):
+                    input_ids.extend(fragment_input_ids[fragment])
+                else:
+                    input_ids.append(fragment)
+            chunk_input_ids[chunk] = input_ids
+
+    batch_input_ids = []
+    for chunks in prompts_chunks:
+        input_ids = _join_image_chunks([chunk_input_ids[chunk] for chunk in chunks], tokenizer, image_token_index)
+        batch_input_ids.append(torch.tensor(input_ids, dtype=torch.long) if return_tensors == 'pt' else input_ids)
+    return batch_input_ids
+
+
+_VISION_CODES_PATTERN = re.compile(re.escape(VISION_CODES_PLACEHOLDER).replace(r'\{\}', r'(\d+)'))
+
+
+def tokenizer_vision_token(prompt, tokenizer, vision_token_ids, has_image=False, image_token_index=IMAGE_TOKEN_INDEX,
+                           return_tensors=None):
+    """
+    Tokenizes a prompt whose generated images are `VISION_CODES_PLACEHOLDER`s and splices in their token ids.
+
+    Gives the same ids as tokenizing the prompt with the vision token strings of `encode_image_token_into_code`,
+    as the vision tokens are added tokens that split the text around them, but skips building and
+    tokenizing thousands of vision token strings. Tokenizers that prepend a bos token to every call, unlike
+    Qwen2, are not supported.
+
+    Args:
+        vision_token_ids: Token ids of every image, see `VisionTokenMapper.codes_to_token_ids`.
+        has_image: Whether to tokenize the `<image>` tags like `tokenizer_image_token`.
+    """
+    input_ids = []
+    for i, chunk in enumerate(_VISION_CODES_PATTERN.split(prompt)):
+        if i % 2 == 1:
+            input_ids.extend(vision_token_ids[int(chunk)])
+        elif chunk:
+            if has_image:
+                input_ids.extend(tokenizer_image_token(chunk, tokenizer, image_token_index))
+            else:
+                input_ids.extend(tokenizer(chunk).input_ids)
+
+    if return_tensors is not None:
+        if return_tensors == 'pt':
+            return torch.tensor(input_ids, dtype=torch.long)
+        raise ValueError(f'Unsupported tensor type: {return_tensors}')
+    return input_ids
+
+
+class VisionTokenMapper:
+    """
+    Maps DualViTok codes to LLM token ids and back with offset arithmetic.
+
+    The `<|image_level{level}_{code}|>` tokens of a level are added to the tokenizer in code order, see
+    `scripts/prepare_llm_with_extended_vision_tokenizer.py`, so the token id of a code is the id of code 0 of
+    its level plus the code.
+
+    Args:
+        tokenizer: Tokenizer extended with the vision tokens.
+        num_levels (int): Number of vision tokenizer levels.
+    """
+
+    def __init__(self, tokenizer, num_levels=2, add_token_name="<|image_level{}_{}|>"):
+        self.num_levels = num_levels
+
+        def token_id(token):
+            token_id = tokenizer.convert_tokens_to_ids(token)
+            if token_id is None or tokenizer.convert_ids_to_tokens(token_id) != token:
+                raise ValueError(f"{token} is not in the vocabulary")
+            return token_id
+
+        self.start_of_image = token_id("<start_of_image>")
+        self.end_of_image = token_id("<end_of_image>")
+        self.end_of_line = token_id("<end_of_line>")
+        self.start_of_level = [token_id("<start_of_level{}>".format(level)) for level in range(num_levels)]
+        self.end_of_level = [token_id("<end_of_level{}>".format(level)) for level in range(num_levels)]
+
+        level_starts = [token_id(add_token_name.format(level, 0)) for level in range(num_levels)] + [len(tokenizer)]
+        # (start, end) token ids of every level, the last level runs to the end of the vocabulary
+        self.level_ranges = [(level_starts[level], level_starts[level + 1]) for level in range(num_levels)]
+        last_start, last_end = self.level_ranges[-1]
+        token_id(add_token_name.format(num_levels - 1, last_end - last_start - 1))
+
+    def codes_to_token_ids(self, image_embed_inds):
+        """
+        Returns the token ids of one image, the same as tokenizing `encode_image_token_into_code(image_embed_inds)`.
+
+        Args:
+            image_embed_inds: Codes of every level, each [h, w].
+        """
+        token_ids = [np.asarray([self.start_of_image], dtype=np.int64)]
+        for level, codes in enumerate(image_embed_inds):
+            codes = np.asarray(codes, dtype=np.int64) + self.level_ranges[level][0]
+            rows = np.concatenate([codes, np.full((codes.shape[0], 1), self.end_of_line, dtype=np.int64)], axis=1)
+            token_ids.extend([np.asarray([self.start_of_level[level]], dtype=np.int64),
+                              rows.reshape(-1),
+                              np.asarray([self.end_of_level[level]], dtype=np.int64)])
+        token_ids.append(np.asarray([self.end_of_image], dtype=np.int64))
+        return np.concatenate(token_ids)
+
+    def is_code(self, token_ids):
+        """Mask of the vision code tokens of a token id tensor."""
+        return (token_ids >= self.level_ranges[0][0]) & (token_ids < self.level_ranges[-1][1])
+
+    def token_ids_to_codes(self, token_ids):
+        """
+        Returns the codes of every level in generation order, the same as matching the
+        `<|image_level{level}_(\\d+)|>` tokens in the decoded text.
+
+        Args:
+            token_ids: 1D token id tensor.
+        """
+        codes = []
+        for start, end in self.level_ranges:
+            level_token_ids = token_ids[(token_ids >= start) & (token_ids < end)]
+            codes.append((level_token_ids - start).tolist())
+        return codes
+
+
 def get_model_name_from_path(model_path):
     model_path = model_path.strip("/")
     model_paths = model_path.split("/")
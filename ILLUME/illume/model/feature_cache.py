@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class ImageFeatureCache:
+    """
+    LRU cache of the projected features of encoded images, keyed by a hash of the image content.
+
+    In a chat or editing session the images of the previous turns are sent with every turn, and the unconditional
+    branch of the classifier-free guidance encodes them again. With the cache each image goes through the vision
+    tower and the projector once. The cache holds at most `max_bytes` of features, the least recently used ones are
+    evicted first. It can be shared by threads serving requests concurrently.
+    """
+
+    # signed int64 constants of splitmix64, mixing the position of every element into the on-device hash
+    _MIX = (-7046029254386353131, -4658895280553007687, -7723592293110705685)
+    _INT_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._features = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_key(cls, image, *extra_keys):
+        image = image.detach().contiguous()
+        h = hashlib.sha1(repr((tuple(image.shape), str(image.dtype), image.device.type) + extra_keys).encode())
+        if image.device.type == "cpu":
+            h.update(image.view(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            # hash the image where it is instead of copying it to the host, only the two sums are copied.
+            h.update(cls._device_hash(image).cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def _device_hash(cls, image):
+        """128-bit multiply-add hash of the bits of `image`, with int64 arithmetic wrapping around."""
+        bits = image.view(-1).view(cls._INT_DTYPES[image.element_size()]).long()
+        weights = torch.arange(bits.numel(), device=bits.device) * cls._MIX[0] + 1
+        weights = (weights ^ (weights >> 30)) * cls._MIX[1]
+        weights = (weights ^ (weights >> 27)) * cls._MIX[2]
+        return torch.stack([(bits * weights).sum(), (bits * (weights ^ (weights >> 31))).sum()])
+
+    def get(self, key):
+        with self._lock:
+            feature = self._features.get(key)
+            if feature is not None:
+                self._features.move_to_end(key)
+            return feature
+
+    def put(self, key, feature):
+        feature = feature.detach()
+        feature_bytes = self._nbytes(feature)
+        if feature_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._features:
+                self.num_bytes -= self._nbytes(self._features.pop(key))
+            self._features[key] = feature
+            self.num_bytes += feature_bytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._features.popitem(last=False)
+                self.num_bytes -= self._nbytes(evicted)
+
+    def encode(self, images, encode_fn, *extra_keys):
+        """
+        Returns the features of `images`, encoding the images missing from the cache with a single call of
+        `encode_fn(images) -> list of features`. `extra_keys` are added to the key, e.g. the preprocessing mode.
+
+        The lock is not held while encoding, two threads missing the same image both encode it.
+        """
+        keys = [self.get_key(image, *extra_keys) for image in images]
+        features = [self.get(key) for key in keys]
+
+        missing = OrderedDict()
+        for i, (key, feature) in enumerate(zip(keys, features)):
+            if feature is None:
+                missing.setdefault(key, []).append(i)
+        with self._lock:
+            self.hits += len(images) - sum(len(indices) for indices in missing.values())
+            self.misses += len(missing)
+
+        if missing:
+            new_features = encode_fn([images[indices[0]] for indices in missing.values()])
+            for (key, indices), feature in zip(missing.items(), new_features):
+                self.put(key, feature)
+                for i in indices:
+                    features[i] = feature
+        return features
+
+    def clear(self):
+        with self._lock:
+            self._features.clear()
+            self.num_bytes = 0
+
+    @staticmethod
+    def _nbytes(feature):
+        return feature.numel() * feature.element_size()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._features)
@@ -27,6 +27,7 @@ from illume.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATC
 from illume.mm_utils import get_anyres_image_grid_shape
 
 from illume.model.utils import load_state_dict_maybe_zero_3
+from illume.model.feature_cache import ImageFeatureCache
 from illume.utils import rank0_print, local_rank
 
 from ..utils import get_state_maybe_zero_3, dicts_equal
@@ -213,6 +214,24 @@ def _reformat_image_sequence(x, special_tokens_features, level):
     return x
 
 
+def _get_packed_position_ids(segment_ids):
+    """Positions of packed rows [batch, seq], restarting from 0 at every segment."""
+    idx = torch.arange(segment_ids.shape[-1], device=segment_ids.device).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[..., 1:] = segment_ids[..., 1:] != segment_ids[..., :-1]
+    segment_starts = torch.cummax(torch.where(is_start, idx, torch.zeros_like(idx)), dim=-1).values
+    return idx - segment_starts
+
+
+def _get_packed_causal_mask(segment_ids, dtype):
+    """4D causal mask [batch, 1, seq, seq] of packed rows, in which tokens only attend to their own segment."""
+    seq_len = segment_ids.shape[1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device).tril()
+    attend = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+    mask = torch.zeros(attend.shape, dtype=dtype, device=segment_ids.device)
+    return mask.masked_fill(~attend, torch.finfo(dtype).min)[:, None]
+
+
 class IllumeMetaForCausalLM(ABC):
     _skip_names = ['mm_projector', 'vision_tower', 'image_newline']
     mask_hires_vision_tokens_p = 0.
@@ -239,7 +258,20 @@ class IllumeMetaForCausalLM(ABC):
                        for skip_name in self._skip_names):
                 p.requires_grad_(False)
 
+    def enable_image_feature_cache(self, max_bytes=1024 ** 3):
+        """Caches the features of the encoded images at inference, see `ImageFeatureCache`."""
+        self.image_feature_cache = ImageFeatureCache(max_bytes) if max_bytes > 0 else None
+
     def encode_images(self, images, image_sizes=None):
+        image_aspect_ratio = getattr(self.config, 'image_aspect_ratio', 'square')
+        image_feature_cache = getattr(self, 'image_feature_cache', None)
+        # only the anyres_dualvitok features are encoded per image, independent of the other images
+        if image_feature_cache is not None and not self.training and isinstance(images, list) \
+                and "anyres_dualvitok" in image_aspect_ratio:
+            return image_feature_cache.encode(images, self._encode_images, image_aspect_ratio)
+        return self._encode_images(images, image_sizes)
+
+    def _encode_images(self, images, image_sizes=None):
         image_aspect_ratio = getattr(self.config, 'image_aspect_ratio', 'square')
         mm_patch_merge_type = getattr(self.config, 'mm_patch_merge_type', 'flat')
 
@@ -315,12 +347,28 @@ class IllumeMetaForCausalLM(ABC):
     def set_mask_hires_vision_tokens_probability(self, p):
         self.mask_hires_vision_tokens = p
 
+    @staticmethod
+    def is_packed_batch(position_ids, attention_mask):
+        """Rows packed with several samples by `DataCollatorForPackedDataset` come without attention mask, and their
+        position ids restart from 0 at every sample."""
+        return (attention_mask is None and position_ids is not None and position_ids.dim() == 2
+                and bool((position_ids[:, 1:] == 0).any()))
+
+    def get_packed_attention_mask(self, segment_ids, dtype):
+        # flash attention 2 finds the samples from the position ids and runs varlen attention on them
+        if getattr(self.config, '_attn_implementation', None) == "flash_attention_2":
+            return None
+        return _get_packed_causal_mask(segment_ids, dtype)
+
     def prepare_inputs_labels_for_multimodal(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
         images, image_sizes=None
     ):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
+            if self.is_packed_batch(position_ids, attention_mask):
+                attention_mask = self.get_packed_attention_mask((position_ids == 0).cumsum(dim=-1),
+                                                                self.get_model().embed_tokens.weight.dtype)
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
         if type(images) is list or images.ndim == 5:
@@ -418,123 +466,102 @@ class IllumeMetaForCausalLM(ABC):
         _labels = labels
         _position_ids = position_ids
         _attention_mask = attention_mask
+        # every sample of a packed row is a segment
+        packed = self.is_packed_batch(position_ids, attention_mask)
+        segment_ids = (position_ids == 0).cumsum(dim=-1) if packed else None
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
         else:
             attention_mask = attention_mask.bool()
-        if position_ids is None:
-            position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=input_ids.device)
         if labels is None:
             labels = torch.full_like(input_ids, IGNORE_INDEX)
 
-        # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
-        input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in
-                     zip(input_ids, attention_mask)]
-        labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
-
-        new_input_embeds = []
-        new_labels = []
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0:
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids)
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0]], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-
-            image_token_indices = [-1] + torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [
-                cur_input_ids.shape[0]]
-            cur_input_ids_noim = []
-            cur_labels = labels[batch_idx]
-            cur_labels_noim = []
-            for i in range(len(image_token_indices) - 1):
-                cur_input_ids_noim.append(cur_input_ids[image_token_indices[i] + 1:image_token_indices[i + 1]])
-                cur_labels_noim.append(cur_labels[image_token_indices[i] + 1:image_token_indices[i + 1]])
-            split_sizes = [x.shape[0] for x in cur_labels_noim]
-            cur_input_embeds = self.get_model().embed_tokens(torch.cat(cur_input_ids_noim))
-            cur_input_embeds_no_im = torch.split(cur_input_embeds, split_sizes, dim=0)
-            cur_new_input_embeds = []
-            cur_new_labels = []
-
-            for i in range(num_images + 1):
-                cur_new_input_embeds.append(cur_input_embeds_no_im[i])
-                cur_new_labels.append(cur_labels_noim[i])
-                if i < num_images:
-                    cur_image_features = image_features[cur_image_idx]
-                    cur_image_idx += 1
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_labels.append(
-                        torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=cur_labels.device,
-                                   dtype=cur_labels.dtype))
-
-            cur_new_input_embeds = [x.to(self.device) for x in cur_new_input_embeds]
-
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-            cur_new_labels = torch.cat(cur_new_labels)
-
-            new_input_embeds.append(cur_new_input_embeds)
-            new_labels.append(cur_new_labels)
+        # The output rows are built in one pass: every kept token of a row is either a text token, embedded in one
+        # `embed_tokens` call for the whole batch, or an image token, replaced by the features of its image. Their
+        # offsets in the padded rows come from a cumsum over the token lengths, and all of them are scattered into
+        # the padded buffer at once. Padding tokens, removed with the attention mask, take no room.
+        batch_size = input_ids.shape[0]
+        device = input_ids.device
+        is_image = (input_ids == IMAGE_TOKEN_INDEX) & attention_mask
+        is_text = (input_ids != IMAGE_TOKEN_INDEX) & attention_mask
+
+        # images are consumed in order, a row without image tokens still consumes one with zero length
+        num_images = is_image.sum(dim=1)
+        num_consumed = num_images.clamp(min=1)
+        first_image_idx = num_consumed.cumsum(dim=0) - num_consumed
+        num_consumed_total = int(num_consumed.sum())
+        image_features = image_features[:num_consumed_total]
+        image_lens = torch.tensor([x.shape[0] for x in image_features], dtype=torch.long, device=device)
+        image_idx = first_image_idx[:, None] + is_image.cumsum(dim=1) - 1
+
+        token_lens = torch.where(is_image, image_lens[image_idx.clamp(0, num_consumed_total - 1)], is_text.long())
+        token_starts = token_lens.cumsum(dim=1) - token_lens
 
         # Truncate sequences to max length as image embeddings can make the sequence longer
+        row_lens = token_lens.sum(dim=1)
         tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
         if tokenizer_model_max_length is not None:
-            new_input_embeds = [x[:tokenizer_model_max_length] for x in new_input_embeds]
-            new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
-
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-
-        new_input_embeds_padded = []
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=new_labels[0].dtype,
-                                       device=new_labels[0].device)
-        attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
-        position_ids = torch.zeros((batch_size, max_len), dtype=position_ids.dtype, device=position_ids.device)
-
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
-                new_input_embeds_padded.append(torch.cat((
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype,
-                                device=cur_new_embed.device),
-                    cur_new_embed
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, -cur_len:] = cur_new_labels
-                    attention_mask[i, -cur_len:] = True
-                    position_ids[i, -cur_len:] = torch.arange(0, cur_len, dtype=position_ids.dtype,
-                                                              device=position_ids.device)
-            else:
-                new_input_embeds_padded.append(torch.cat((
-                    cur_new_embed,
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype,
-                                device=cur_new_embed.device)
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, :cur_len] = cur_new_labels
-                    attention_mask[i, :cur_len] = True
-                    position_ids[i, :cur_len] = torch.arange(0, cur_len, dtype=position_ids.dtype,
-                                                             device=position_ids.device)
-
-        new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
+            row_lens = row_lens.clamp(max=tokenizer_model_max_length)
+        max_len = int(row_lens.max())
+        if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
+            row_starts = max_len - row_lens
+        else:
+            row_starts = torch.zeros_like(row_lens)
+
+        # text tokens
+        text_keep = is_text & (token_starts < row_lens[:, None])
+        text_rows = text_keep.nonzero(as_tuple=True)[0]
+        text_dest = text_rows * max_len + row_starts[text_rows] + token_starts[text_keep]
+        text_embeds = self.get_model().embed_tokens(input_ids[text_keep])
+
+        # image features, `x[0:0]` keeps the images of rows without image tokens in the graph
+        image_rows, image_cols = is_image.nonzero(as_tuple=True)
+        unused_images = set(first_image_idx[num_images == 0].tolist())
+        image_embeds = torch.cat([x[0:0] if i in unused_images else x for i, x in enumerate(image_features)])
+        image_embeds = image_embeds.to(device=text_embeds.device, dtype=text_embeds.dtype)
+        cur_image_lens = image_lens[image_idx[image_rows, image_cols]]
+        image_offsets = torch.arange(int(cur_image_lens.sum()), device=device) - (
+                cur_image_lens.cumsum(dim=0) - cur_image_lens).repeat_interleave(cur_image_lens)
+        image_token_rows = image_rows.repeat_interleave(cur_image_lens)
+        image_token_starts = token_starts[image_rows, image_cols].repeat_interleave(cur_image_lens) + image_offsets
+        image_keep = image_token_starts < row_lens[image_token_rows]
+        image_dest = (image_token_rows * max_len + row_starts[image_token_rows] + image_token_starts)[image_keep]
+
+        new_input_embeds = text_embeds.new_zeros((batch_size * max_len, text_embeds.shape[-1])).index_copy(
+            0, torch.cat([text_dest, image_dest]), torch.cat([text_embeds, image_embeds[image_keep]]))
+        new_input_embeds = new_input_embeds.view(batch_size, max_len, -1)
+
+        new_labels = torch.full((batch_size * max_len,), IGNORE_INDEX, dtype=labels.dtype, device=device)
+        new_labels[text_dest] = labels[text_keep]
+        new_labels = new_labels.view(batch_size, max_len)
+
+        positions = torch.arange(max_len, device=device)[None, :] - row_starts[:, None]
+        valid = (positions >= 0) & (positions < row_lens[:, None])
+
+        if packed:
+            # image features belong to the segment of their image token, the padding of a row is a segment of its own
+            new_segment_ids = torch.full((batch_size * max_len,), -1, dtype=segment_ids.dtype, device=device)
+            new_segment_ids[text_dest] = segment_ids[text_keep]
+            new_segment_ids[image_dest] = segment_ids[image_rows, image_cols].repeat_interleave(
+                cur_image_lens)[image_keep]
+            new_segment_ids = new_segment_ids.view(batch_size, max_len)
+            position_ids = _get_packed_position_ids(new_segment_ids).to(_position_ids.dtype)
+            attention_mask = self.get_packed_attention_mask(new_segment_ids, new_input_embeds.dtype)
+            new_labels = new_labels if _labels is not None else None
+            return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
 
         if _labels is None:
             new_labels = None
-        else:
-            new_labels = new_labels_padded
 
         if _attention_mask is None:
             attention_mask = None
         else:
-            attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
+            attention_mask = valid.to(dtype=_attention_mask.dtype)
 
         if _position_ids is None:
             position_ids = None
+        else:
+            position_ids = torch.where(valid, positions, 0).to(_position_ids.dtype)
 
         return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
 
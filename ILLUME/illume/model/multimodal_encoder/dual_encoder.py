@@ -2,6 +2,7 @@ import torch
 import os
 import math
 import torch.nn as nn
+from collections import defaultdict
 from pathlib import Path
 from einops import rearrange
 
@@ -27,6 +28,7 @@ class DualVisionTower(BaseModalityEncoder):
                  use_ema=False,
                  delay_load=False,
                  unfreeze_mm_vision_tower=False,
+                 max_semantic_patches_per_call=8192,
                  **kwargs,
                  ):
         super().__init__()
@@ -45,6 +47,8 @@ class DualVisionTower(BaseModalityEncoder):
 
         self.min_pixels = min_pixels
         self.max_pixels = max_pixels
+        # the sdpa and eager attention of the semantic encoder build a dense [patches, patches] mask per call
+        self.max_semantic_patches_per_call = max_semantic_patches_per_call
 
         self.scaling_layer = ScalingLayerForQwen2ViT()
 
@@ -101,31 +105,52 @@ class DualVisionTower(BaseModalityEncoder):
         else:
             images = [image.to(device=self.device, dtype=self.dtype) for image in images]
 
-        image_feature_shape_pixels, image_feature_shape_semantics = [], []
         if isinstance(images, list):  # anyres setting
-            h_pixels = []
-            for image in images:
-                if image.ndim==3:
-                    image = image.unsqueeze(0)
-                h_pixel = self.pixel_encoder(image)
+            images = [image.unsqueeze(0) if image.ndim == 3 else image for image in images]
+
+            # images of the same size are encoded as one batch
+            size_groups = defaultdict(list)
+            for i, image in enumerate(images):
+                size_groups[tuple(image.shape[-2:])].append(i)
+
+            h_pixels = [None] * len(images)
+            image_feature_shape_pixels = [None] * len(images)
+            semantic_inputs = [None] * len(images)
+            semantic_grid_thw = [None] * len(images)
+            for indices in size_groups.values():
+                group_images = torch.cat([images[i] for i in indices], dim=0)
+
+                h_pixel = self.pixel_encoder(group_images)
                 b, c, h, w = h_pixel.shape
-                image_feature_shape_pixels.append((h, w))
                 h_pixel = rearrange(h_pixel, 'b c h w -> b (h w) c')
-                h_pixels.append(h_pixel)
-            h_pixels = torch.cat(h_pixels, dim=1)
 
-            h_semantics = []
-            for image in images:
-                if image.ndim==3:
-                    image = image.unsqueeze(0)
-                image = image.unsqueeze(dim=1)
-                scale_output = self.scaling_layer(image.clone())
+                scale_output = self.scaling_layer(group_images.unsqueeze(dim=1).clone())
                 image_2, image_grid_thw = scale_output['image'], scale_output['image_grid_thw']
-                image_feature_shape_semantics.append((int(image_grid_thw[0][1]) // 2, int(image_grid_thw[0][2] // 2)))
-                h_semantic = self.semantic_encoder(image_2, image_grid_thw)
-                h_semantics.append(h_semantic)
-            h_semantics = torch.cat(h_semantics, dim=0)
-            h_semantics = h_semantics.unsqueeze(dim=0)
+                # the patches of every image are contiguous
+                image_2 = image_2.split(len(image_2) // len(indices), dim=0)
+
+                for j, i in enumerate(indices):
+                    h_pixels[i] = h_pixel[j:j + 1]
+                    image_feature_shape_pixels[i] = (h, w)
+                    semantic_inputs[i] = image_2[j]
+                    semantic_grid_thw[i] = image_grid_thw[j:j + 1]
+            h_pixels = torch.cat(h_pixels, dim=1)
+
+            # consecutive images share one call, every attention implementation keeps each image to itself with
+            # the cu_seqlens of grid_thw (block-diagonal masks for sdpa and eager).
+            h_semantics, call_inputs, call_grid_thw, call_patches = [], [], [], 0
+            for image_2, image_grid_thw in zip(semantic_inputs, semantic_grid_thw):
+                if call_inputs and call_patches + len(image_2) > self.max_semantic_patches_per_call:
+                    h_semantics.append(self.semantic_encoder(torch.cat(call_inputs, dim=0),
+                                                             torch.cat(call_grid_thw, dim=0)))
+                    call_inputs, call_grid_thw, call_patches = [], [], 0
+                call_inputs.append(image_2)
+                call_grid_thw.append(image_grid_thw)
+                call_patches += len(image_2)
+            h_semantics.append(self.semantic_encoder(torch.cat(call_inputs, dim=0), torch.cat(call_grid_thw, dim=0)))
+            h_semantics = torch.cat(h_semantics, dim=0).unsqueeze(dim=0)
+            image_feature_shape_semantics = [(int(image_grid_thw[0][1]) // 2, int(image_grid_thw[0][2]) // 2)
+                                             for image_grid_thw in semantic_grid_thw]
 
             image_feature_shapes = [[shape_semantic, shape_pixel] for shape_semantic, shape_pixel in zip(image_feature_shape_semantics, image_feature_shape_pixels)]
 
@@ -343,9 +343,32 @@ class ILLUMETrainer(Trainer):
                 lengths=lengths,
                 group_by_modality=True,
             )
+        elif self.args.group_by_length and hasattr(self.train_dataset, "lengths"):
+            # the cached token lengths of the dataset, instead of tokenizing every sample in the HF sampler
+            return LengthGroupedSampler(
+                self.args.train_batch_size,
+                world_size=self.args.world_size * self.args.gradient_accumulation_steps,
+                lengths=self.train_dataset.lengths,
+            )
         else:
             return super()._get_train_sampler()
 
+    def compute_loss(self, model, inputs, return_outputs=False):
+        # set by DataCollatorForPackedDataset, not an input of the model
+        packing_efficiency = inputs.pop("packing_efficiency", None)
+        if packing_efficiency is not None:
+            if not hasattr(self, "_packing_efficiencies"):
+                self._packing_efficiencies = []
+            self._packing_efficiencies.append(packing_efficiency)
+        return super().compute_loss(model, inputs, return_outputs=return_outputs)
+
+    def log(self, logs: Dict[str, float]) -> None:
+        # mean packing efficiency of the steps since the last log
+        if getattr(self, "_packing_efficiencies", None) and "loss" in logs:
+            logs["packing_efficiency"] = round(float(np.mean(self._packing_efficiencies)), 4)
+            self._packing_efficiencies = []
+        super().log(logs)
+
     def create_optimizer(self):
         """
         Setup the optimizer.
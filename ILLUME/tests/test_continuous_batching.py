@@ -0,0 +1,103 @@
+"""
+CPU checks of `ContinuousBatchingEngine` with a tiny random Qwen2 model.
+
+Admitting requests between decode steps and retiring them as they finish must not change what a request
+generates: with greedy decoding every request has to match its own run through `BatchedCFGGenerator`.
+
+Run from `ILLUME/` with `PYTHONPATH` set as in the README: `python -m pytest tests`.
+"""
+import pytest
+import torch
+from transformers import LogitsProcessorList, Qwen2Config, Qwen2ForCausalLM
+
+from generation_eval.models.continuous_batching import ContinuousBatchingEngine, ImageGenerationRequest
+from generation_eval.models.guided_generation import BatchedCFGGenerator
+from generation_eval.models.inference_utils import InterleavedLogitsProcessor
+
+SPECIAL_TOKENS = {"start_of_image": 5, "end_of_image": 6, "start_of_level0": 8, "end_of_level0": 9,
+                  "start_of_level1": 10, "end_of_level1": 11, "end_of_line": 7, "end_of_text": 3}
+LEVEL0_RANGE, LEVEL1_RANGE = (20, 40), (40, 80)
+PAD_TOKEN_ID = 0
+
+# (prompt, (h1, w1, h2, w2), unconditional prompt, guidance scale), of different lengths, layouts and CFG
+REQUESTS = [
+    ([1, 2, 15, 16], (2, 2, 2, 3), [12, 13], 3.0),
+    ([17, 18, 19], (1, 3, 2, 2), None, 1.0),
+    ([21, 22, 23, 24, 25, 26, 27], (2, 1, 1, 2), [12, 13, 14], 2.0),
+    ([30], (1, 1, 1, 1), [12], 5.0),
+]
+
+
+class StartImageProcessor:
+    """The engine starts every request with `<start_of_image>`, force it in the reference run too."""
+
+    def __call__(self, input_ids, scores):
+        if input_ids.shape[1] == 0:
+            scores = scores.clone()
+            scores[:, SPECIAL_TOKENS["start_of_image"]] += 1000
+        return scores
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=100, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, eos_token_id=3, attn_implementation="sdpa")
+    return Qwen2ForCausalLM(config).eval()
+
+
+def reference_output(model, input_ids, layout, uncond_input_ids, guidance_scale):
+    processor = InterleavedLogitsProcessor(1.0, None, model, LEVEL0_RANGE, LEVEL1_RANGE, *layout, SPECIAL_TOKENS,
+                                           default_top_k=0, level0_top_k=0, level1_top_k=0,
+                                           default_top_p=1.0, level0_top_p=1.0, level1_top_p=1.0,
+                                           level1_temp=1.0)
+    generator = BatchedCFGGenerator(model, guidance_scale, SPECIAL_TOKENS, PAD_TOKEN_ID, eos_token_id=3)
+    h1, w1, h2, w2 = layout
+    output_ids = generator.generate(
+        torch.tensor([input_ids]),
+        None if uncond_input_ids is None or guidance_scale == 1 else torch.tensor([uncond_input_ids]),
+        do_sample=False,
+        max_new_tokens=h1 * (w1 + 1) + h2 * (w2 + 1) + 6,
+        logits_processor=LogitsProcessorList([StartImageProcessor(), processor]))
+    return output_ids[0].tolist()
+
+
+def build_request(input_ids, layout, uncond_input_ids, guidance_scale):
+    return ImageGenerationRequest(
+        input_ids=torch.tensor(input_ids),
+        image_token_layout=layout,
+        uncond_input_ids=None if uncond_input_ids is None else torch.tensor(uncond_input_ids),
+        guidance_scale=guidance_scale,
+        do_sample=False)
+
+
+def test_admit_and_retire_match_single_request_generation(model):
+    expected = [reference_output(model, *request) for request in REQUESTS]
+
+    engine = ContinuousBatchingEngine(model, SPECIAL_TOKENS, LEVEL0_RANGE, LEVEL1_RANGE, PAD_TOKEN_ID,
+                                      max_batch_rows=4)
+    # the second request joins a running batch, the last two wait for rows to be retired
+    futures = [engine.submit(build_request(*REQUESTS[0]))]
+    engine.step()
+    engine.step()
+    futures.append(engine.submit(build_request(*REQUESTS[1])))
+    engine.step()
+    futures += [engine.submit(build_request(*request)) for request in REQUESTS[2:]]
+
+    max_rows = 0
+    while engine.step():
+        max_rows = max(max_rows, engine.num_rows)
+
+    assert max_rows <= 4
+    assert [future.result(timeout=0) for future in futures] == expected
+
+
+def test_background_thread_serves_concurrent_requests(model):
+    expected = [reference_output(model, *request) for request in REQUESTS]
+
+    engine = ContinuousBatchingEngine(model, SPECIAL_TOKENS, LEVEL0_RANGE, LEVEL1_RANGE, PAD_TOKEN_ID).start()
+    try:
+        futures = [engine.submit(build_request(*request)) for request in REQUESTS]
+        assert [future.result(timeout=60) for future in futures] == expected
+    finally:
+        engine.stop()
@@ -0,0 +1,88 @@
+"""
+CPU check of sample packing with a tiny random ILLUME Qwen2 model and a stand-in for the DualViTok encoder.
+
+Two samples packed into one row by `DataCollatorForPackedDataset` must give the same logits and loss as the same
+samples padded into two rows by `DataCollatorForSupervisedDataset`: the packed row has to be detected, the
+segments and position ids recomputed after the image features are spliced in, and the samples must not attend to
+each other.
+
+Run from `ILLUME/` with `PYTHONPATH` set as in the README: `python -m pytest tests`.
+"""
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from illume.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from illume.data.dataset import DataCollatorForPackedDataset, DataCollatorForSupervisedDataset
+from illume.model.language_model.illume_qwen2 import ILLUMEQwen2Config, IllumeQwen2ForCausalLM
+
+IMAGE_ASPECT_RATIO = "anyres_dualvitok"
+PAD_TOKEN_ID = 0
+
+
+class TinyVisionTower(nn.Module):
+    """Stands in for DualViTok: average pooled 4x4 patches as semantic features and 2x2 patches as pixel features."""
+
+    def forward(self, images):
+        semantic = [F.avg_pool2d(image, 4).flatten(2).transpose(1, 2) for image in images]
+        pixel = [F.avg_pool2d(image, 2).flatten(2).transpose(1, 2) for image in images]
+        shapes = [((h // 4, w // 4), (h // 2, w // 2)) for h, w in (image.shape[-2:] for image in images)]
+        return torch.cat(semantic + pixel, dim=1), shapes
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = ILLUMEQwen2Config(vocab_size=100, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                               num_attention_heads=4, num_key_value_heads=2, attn_implementation="sdpa")
+    config.image_aspect_ratio = IMAGE_ASPECT_RATIO
+    config.special_tokens_ids = [90, 91, 92, 93, 94, 95, 96]
+    model = IllumeQwen2ForCausalLM(config).eval()
+    model.get_model().vision_tower = TinyVisionTower()
+    model.get_model().mm_projector = nn.Linear(3, config.hidden_size)
+    return model
+
+
+def build_sample(prompt_ids, answer_ids, image=None):
+    input_ids = torch.tensor(([IMAGE_TOKEN_INDEX] if image is not None else []) + prompt_ids + answer_ids)
+    labels = input_ids.clone()
+    labels[:len(input_ids) - len(answer_ids)] = IGNORE_INDEX
+    # text-only samples come with a dummy image, like in the datasets
+    image = image if image is not None else torch.zeros(3, 8, 8)
+    return dict(input_ids=input_ids, labels=labels, image=[image], image_size=[image.shape[-2:]],
+                dataset_name="test")
+
+
+def forward(model, batch):
+    _, position_ids, attention_mask, _, inputs_embeds, labels = model.prepare_inputs_labels_for_multimodal(
+        batch["input_ids"], batch.get("position_ids"), batch.get("attention_mask"), None, batch["labels"],
+        batch["images"], batch["image_sizes"])
+    with torch.no_grad():
+        out = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids,
+                    labels=labels)
+    return out, attention_mask
+
+
+def test_packed_batch_matches_padded_batch(model):
+    torch.manual_seed(1)
+    instances = [build_sample([11, 12, 13], [14, 15, 16, 17], image=torch.rand(3, 8, 12)),
+                 build_sample([21, 22], [23, 24, 25])]
+    tokenizer = SimpleNamespace(pad_token_id=PAD_TOKEN_ID, model_max_length=512)
+
+    packed_batch = DataCollatorForPackedDataset(tokenizer, IMAGE_ASPECT_RATIO)(instances)
+    assert packed_batch["input_ids"].shape[0] == 1
+    assert model.is_packed_batch(packed_batch["position_ids"], packed_batch.get("attention_mask"))
+    padded_batch = DataCollatorForSupervisedDataset(tokenizer, IMAGE_ASPECT_RATIO)(instances)
+    assert not model.is_packed_batch(padded_batch.get("position_ids"), padded_batch["attention_mask"])
+
+    packed_out, packed_mask = forward(model, packed_batch)
+    padded_out, padded_mask = forward(model, padded_batch)
+
+    # the attention mask keeps the samples of the packed row apart
+    assert packed_mask.dim() == 4
+    padded_logits = torch.cat([logits[mask.bool()] for logits, mask in zip(padded_out.logits, padded_mask)])
+    torch.testing.assert_close(packed_out.logits[0, :len(padded_logits)], padded_logits, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(packed_out.loss, padded_out.loss, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,69 @@
+"""
+CPU checks of the prefill through `PrefixKVCache` with a tiny random Qwen2 model.
+
+Taking rows from the cache and extending the shared prefix must give the same logits and key/value states as
+prefilling the whole batch, and only the recurring prompts and prefixes may end up in the cache.
+
+Run from `ILLUME/` with `PYTHONPATH` set as in the README: `python -m pytest tests`.
+"""
+import pytest
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+from generation_eval.models.guided_generation import BatchedCFGGenerator
+from generation_eval.models.prefix_cache import PrefixKVCache
+
+SPECIAL_TOKENS = {"start_of_image": 5, "end_of_image": 6}
+PAD_TOKEN_ID = 0
+TEMPLATE = list(range(20, 40))
+UNCOND_PROMPT = TEMPLATE + [41, 42, 43]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=100, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, attn_implementation="sdpa")
+    return Qwen2ForCausalLM(config).eval()
+
+
+def check_prefill(model, prefix_cache, captions):
+    generator = BatchedCFGGenerator(model, 3.0, SPECIAL_TOKENS, PAD_TOKEN_ID, eos_token_id=3)
+    cached_generator = BatchedCFGGenerator(model, 3.0, SPECIAL_TOKENS, PAD_TOKEN_ID, eos_token_id=3,
+                                           prefix_cache=prefix_cache)
+    prompts = [TEMPLATE + caption for caption in captions]
+    max_length = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor([[PAD_TOKEN_ID] * (max_length - len(prompt)) + prompt for prompt in prompts])
+    attention_mask = torch.tensor([[0] * (max_length - len(prompt)) + [1] * len(prompt) for prompt in prompts])
+    input_ids, attention_mask = generator.stack_branches(input_ids, attention_mask,
+                                                         torch.tensor([UNCOND_PROMPT] * len(prompts)))
+
+    with torch.no_grad():
+        logits, past_key_values, mask = generator.prefill(input_ids, attention_mask)
+        cached_logits, cached_past_key_values, cached_mask = cached_generator.prefill(input_ids, attention_mask)
+
+    torch.testing.assert_close(cached_logits, logits, atol=1e-5, rtol=1e-5)
+    assert torch.equal(cached_mask, mask)
+    for (k, v), (cached_k, cached_v) in zip(past_key_values.to_legacy_cache(),
+                                            cached_past_key_values.to_legacy_cache()):
+        keep = mask.bool()
+        torch.testing.assert_close(cached_k.transpose(1, 2)[keep], k.transpose(1, 2)[keep], atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(cached_v.transpose(1, 2)[keep], v.transpose(1, 2)[keep], atol=1e-5, rtol=1e-5)
+
+
+def test_cached_prefill_matches_prefill(model):
+    prefix_cache = PrefixKVCache()
+    for step in range(3):
+        captions = [[50 + step, 60 + step, 61], [70 + step], [80 + step, 81, 82, 83]]
+        check_prefill(model, prefix_cache, captions)
+
+    # the unconditional prompt and the template, the captioned prompts are never cached
+    assert set(prefix_cache.entries) == {tuple(UNCOND_PROMPT), tuple(TEMPLATE)}
+
+
+def test_cached_prefill_of_single_requests(model):
+    prefix_cache = PrefixKVCache()
+    for step in range(4):
+        check_prefill(model, prefix_cache, [[50 + step, 60]])
+    assert tuple(UNCOND_PROMPT) in prefix_cache.entries
+    assert not any(key[len(TEMPLATE):len(TEMPLATE) + 1] == (50,) for key in prefix_cache.entries)
@@ -17,6 +17,7 @@ vq_model = dict(
             codebook_size=32768,
             channel_first=True,
             rotation_trick=False,
+            search='tiled',  # nearest code search in codebook tiles, see SimVQ
         ),
         semantic_decoder=dict(
             z_channels=32,
@@ -47,6 +48,7 @@ vq_model = dict(
             codebook_size=32768 * 3,
             channel_first=True,
             rotation_trick=False,
+            search='tiled',  # nearest code search in codebook tiles, see SimVQ
         ),
         pixel_decoder=dict(
             ch=384,
@@ -127,7 +129,7 @@ data_args = dict(
         dataset='codebook_inference',
         data_path='',
         augment=dict(type='dualvitok_anyres_inference'),
-        batch_size_for_inference=1,
+        batch_size_for_inference=16,  # images of the same matched ratio are encoded together
     ),
 
     per_proc_batch_size=2,
@@ -17,6 +17,7 @@ vq_model = dict(
             codebook_size=32768,
             channel_first=True,
             rotation_trick=False,
+            search='tiled',  # nearest code search in codebook tiles, see SimVQ
         ),
         semantic_decoder=dict(
             z_channels=32,
@@ -47,6 +48,7 @@ vq_model = dict(
             codebook_size=32768 * 3,
             channel_first=True,
             rotation_trick=False,
+            search='tiled',  # nearest code search in codebook tiles, see SimVQ
         ),
         pixel_decoder=dict(
             ch=384,
@@ -38,6 +38,7 @@ data_args = dict(
         ),
     ],
     lazy_preprocess=True,
+    packing=False,  # pack samples into rows of model_max_length, best with attn_implementation="flash_attention_2"
     is_multimodal=False,
     base_resolution=256,
     cfg_text_dropout_probability=0.1,
@@ -122,13 +122,17 @@ class ScalingLayerForQwen2ViT:
         images = images.clamp(0, 1)  # rescale to [0, 1.]
         images = ((images - self.image_mean.to(images)) / self.image_std.to(images))
 
-        images = rearrange(images, '(b t) c h w -> b t c h w', b=batch_size, t=temporal)
+        grid_h, grid_w = resized_height // self.patch_size, resized_width // self.patch_size
         if temporal == 1:
-            images = images.repeat_interleave(self.temporal_patch_size, dim=1)
-            temporal = self.temporal_patch_size
+            # still images are not repeated `temporal_patch_size` times, the patch embed sums the temporal slices of
+            # its kernel instead. Patches of (c s1 s2) in the order of the video path below.
+            images = images.view(batch_size, channel, grid_h // self.merge_size, self.merge_size, self.patch_size,
+                                 grid_w // self.merge_size, self.merge_size, self.patch_size)
+            images = images.permute(0, 2, 5, 3, 6, 1, 4, 7).reshape(-1, channel * self.patch_size ** 2)
+            return dict(image=images, image_grid_thw=torch.as_tensor([[1, grid_h, grid_w] for _ in range(batch_size)]))
 
+        images = rearrange(images, '(b t) c h w -> b t c h w', b=batch_size, t=temporal)
         grid_t = temporal // self.temporal_patch_size
-        grid_h, grid_w = resized_height // self.patch_size, resized_width // self.patch_size
 
         images = images.reshape(
             batch_size * grid_t,
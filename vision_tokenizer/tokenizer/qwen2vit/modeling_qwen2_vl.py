@@ -274,6 +274,11 @@ class PatchEmbed(nn.Module):
 
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
         target_dtype = self.proj.weight.dtype
+        if hidden_states.shape[-1] == self.in_channels * self.patch_size * self.patch_size:
+            # patches of still images without the temporal repeat, see `ScalingLayerForQwen2ViT`: every temporal
+            # slice of the kernel sees the same frame
+            weight = self.proj.weight.sum(dim=2).view(self.embed_dim, -1)
+            return F.linear(hidden_states.to(dtype=target_dtype), weight)
         if is_torch_npu_available():
             # if True:
             hidden_states = F.linear(hidden_states, self.proj.weight.view(self.embed_dim, -1))
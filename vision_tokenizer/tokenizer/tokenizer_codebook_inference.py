@@ -4,6 +4,7 @@ import time
 import datetime
 
 from tokenizer.builder import build_vq_model
+from tokenizer.vector_quantize_pytorch import SimVQ
 from utils.registry_utils import read_config
 
 from vision_tokenizer.dataset.build import make_transform
@@ -26,6 +27,7 @@ import torch
 from torch.utils.data import Dataset
 from illume.data.aspect_ratio_utils import RATIOS, AspectRatioCrop
 from illume.data.data_utils import write_to_jsonl, count_lines_in_jsonl_file
+from illume.data.token_store import TokenStoreWriter, get_token_store_path
 
 
 try:
@@ -95,7 +97,7 @@ class CodebookInfereneDataset(Dataset):
         if isinstance(info, bytes):
             info = orjson.loads(info)
 
-        # added keys: images, image_sizes, need_to_skip_data
+        # added keys: images, image_sizes, data_index, need_to_skip_data
         need_to_skip_data = False
         image_paths = info["images"]
         if isinstance(image_paths, str):
@@ -130,6 +132,7 @@ class CodebookInfereneDataset(Dataset):
             images_data.append(image)
             matched_ratios.append(target_size)  # (h, w)
 
+        info["data_index"] = idx
         info["need_to_skip_data"] = need_to_skip_data
         info["images_data"] = images_data
         info["image_sizes"] = image_sizes
@@ -145,13 +148,15 @@ def build_codebook_inference_dataset(args, transform):
 
 
 class InferenceSampler(torch.utils.data.sampler.Sampler):
-    def __init__(self, size):
+    def __init__(self, size, skip_indices=None):
         self._size = int(size)
         assert size > 0
         self._rank = dist.get_rank()
         self._world_size = dist.get_world_size()
         self._local_indices = self._get_local_indices(size, self._world_size,
                                                       self._rank)
+        if skip_indices:
+            self._local_indices = [i for i in self._local_indices if i not in skip_indices]
 
     @staticmethod
     def _get_local_indices(total_size, world_size, rank):
@@ -175,6 +180,201 @@ class InferenceSampler(torch.utils.data.sampler.Sampler):
         return len(self._local_indices)
 
 
+class BucketedCodebookEncoder:
+    """
+    Encodes the images of the codebook inference dataset in batches of images of the same resolution.
+
+    Images are added record by record and queued in a bucket per (matched ratio, image shape). A bucket is
+    encoded as one batch once it holds `batch_size` images, and the codes are copied to host asynchronously while
+    the next bucket is encoded. `add` and `flush` return the records whose images are all encoded, as
+    `(record_index, record)` with `record["image_embed_inds"]` filled in.
+    """
+
+    def __init__(self, vq_model, device, batch_size):
+        self.vq_model = vq_model
+        self.device = device
+        self.batch_size = max(1, batch_size)
+        self.buckets = defaultdict(list)
+        self.pending_records = {}  # record_index -> [record, num_images_left]
+        self.pending_copy = None
+
+    def add(self, record_index, record, images_data, matched_ratios):
+        self.pending_records[record_index] = [record, len(images_data)]
+        completed = []
+        for img_idx, (image_data, matched_ratio) in enumerate(zip(images_data, matched_ratios)):
+            key = (tuple(matched_ratio), tuple(image_data.shape))
+            self.buckets[key].append((record_index, img_idx, image_data))
+            if len(self.buckets[key]) >= self.batch_size:
+                completed.extend(self._encode_bucket(self.buckets.pop(key)))
+        return completed
+
+    def flush(self):
+        completed = []
+        for key in list(self.buckets):
+            completed.extend(self._encode_bucket(self.buckets.pop(key)))
+        completed.extend(self._finish_pending_copy())
+        return completed
+
+    @torch.no_grad()
+    def _encode_bucket(self, items):
+        images = torch.cat([image_data for _, _, image_data in items], dim=0)
+        images = images.to(device=self.device, dtype=self.vq_model.dtype, non_blocking=True)
+        out = self.vq_model.encode(images)
+        semantic_code, texture_code = out[0][2], out[1][2]
+        copy_done = None
+        if images.is_cuda:
+            # copy the codes into pinned memory while the next bucket is encoded
+            semantic_code = self._copy_to_host(semantic_code)
+            texture_code = self._copy_to_host(texture_code)
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        completed = self._finish_pending_copy()
+        self.pending_copy = (items, semantic_code, texture_code, copy_done)
+        return completed
+
+    @staticmethod
+    def _copy_to_host(tensor):
+        host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host_tensor.copy_(tensor, non_blocking=True)
+        return host_tensor
+
+    def _finish_pending_copy(self):
+        if self.pending_copy is None:
+            return []
+        items, semantic_code, texture_code, copy_done = self.pending_copy
+        self.pending_copy = None
+        if copy_done is not None:
+            copy_done.synchronize()
+        semantic_code = semantic_code.tolist()
+        texture_code = texture_code.tolist()
+
+        completed = []
+        for j, (record_index, img_idx, _) in enumerate(items):
+            pending = self.pending_records[record_index]
+            pending[0]["image_embed_inds"][img_idx] = [semantic_code[j], texture_code[j]]
+            pending[1] -= 1
+            if pending[1] == 0:
+                completed.append((record_index, self.pending_records.pop(record_index)[0]))
+        return completed
+
+
+class JsonlShardWriter:
+    """
+    Appends the records of one rank to its shard file as soon as they are inferred.
+
+    Every line is `{"data_index": ..., "ratio_type": ..., "record": ...}`, where `data_index` is the line of the
+    record in the input file. Records that are filtered out are written with `record=None`, so that a resumed
+    run does not load them again. A line cut by a crash is dropped when the shard is reopened.
+    """
+
+    def __init__(self, shard_file):
+        os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+        truncate_incomplete_line(shard_file)
+        self.f_w = open(shard_file, 'ab')
+
+    def write(self, data_index, record, ratio_type=None):
+        line = {"data_index": data_index, "ratio_type": ratio_type, "record": record}
+        self.f_w.write(orjson.dumps(line) + b'\n')
+        self.f_w.flush()
+
+    def close(self):
+        self.f_w.close()
+
+
+def truncate_incomplete_line(shard_file):
+    if not os.path.exists(shard_file):
+        return
+    with open(shard_file, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def list_jsonl_shards(shard_prefix):
+    shard_dir, stem = os.path.dirname(shard_prefix), os.path.basename(shard_prefix)
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(os.path.join(shard_dir, file) for file in os.listdir(shard_dir)
+                  if file.startswith(f"{stem}.shard") and file.endswith(".jsonl"))
+
+
+def remove_jsonl_shards(shard_prefix):
+    for shard_file in list_jsonl_shards(shard_prefix):
+        os.remove(shard_file)
+
+
+def iter_jsonl_shard(shard_file):
+    with open(shard_file, 'rb') as f:
+        offset = f.tell()
+        for line in iter(f.readline, b''):
+            if line.endswith(b'\n'):
+                yield offset, orjson.loads(line)
+            offset = f.tell()
+
+
+def read_finished_indices(shard_prefix):
+    """Returns the input lines that are already written to the shards of any rank."""
+    finished_indices = set()
+    for shard_file in list_jsonl_shards(shard_prefix):
+        for _, line in iter_jsonl_shard(shard_file):
+            finished_indices.add(line["data_index"])
+    return finished_indices
+
+
+def merge_jsonl_shards(shard_prefix, out_file, save_token_store=False):
+    """
+    Merges the shards of all ranks into `out_file` and removes them, returns the record count per ratio type.
+
+    Like the single process output, the records are grouped by ratio type and follow the input order inside a
+    group. Only the line offsets are kept in memory, the records are copied one at a time.
+
+    With `save_token_store`, the codes are moved from `image_embed_inds` into the binary token store of
+    `out_file` and the records keep their `token_store_index` instead.
+    """
+    shard_files = list_jsonl_shards(shard_prefix)
+    locations = defaultdict(list)  # ratio_type -> [(data_index, shard_id, offset)]
+    for shard_id, shard_file in enumerate(shard_files):
+        for offset, line in iter_jsonl_shard(shard_file):
+            if line["record"] is not None:
+                locations[line["ratio_type"]].append((line["data_index"], shard_id, offset))
+
+    # ratio types in the order they first appear in the input file
+    ratio_types = sorted(locations, key=lambda ratio_type: min(locations[ratio_type])[0])
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    shard_readers = [open(shard_file, 'rb') for shard_file in shard_files]
+    token_store_writer = TokenStoreWriter(get_token_store_path(out_file)) if save_token_store else None
+    statistic = {}
+    with open(out_file, 'w+', encoding='utf-8') as f_w:
+        for ratio_type in ratio_types:
+            for _, shard_id, offset in sorted(locations[ratio_type]):
+                shard_readers[shard_id].seek(offset)
+                record = orjson.loads(shard_readers[shard_id].readline())["record"]
+                if token_store_writer is not None:
+                    record["token_store_index"] = token_store_writer.add(record.pop("image_embed_inds"))
+                f_w.write(json.dumps(record, ensure_ascii=False) + '\n')
+            statistic[ratio_type] = len(locations[ratio_type])
+    for reader in shard_readers:
+        reader.close()
+    if token_store_writer is not None:
+        token_store_writer.close()
+
+    remove_jsonl_shards(shard_prefix)
+    return statistic
+
+
+def setup_approximate_search(vq_model, args):
+    """
+    Switches the SimVQ quantizers of `vq_model` to the approximate (IVF) nearest code search, the first
+    `approx_search_calibration_steps` encodes of every quantizer also run the exact search for `search_report`.
+    """
+    quantizers = {name: module for name, module in vq_model.named_modules() if isinstance(module, SimVQ)}
+    for quantizer in quantizers.values():
+        quantizer.use_approximate_search(num_lists=args.approx_search_lists, num_probes=args.approx_search_probes,
+                                         calibration_steps=args.approx_search_calibration_steps)
+    return quantizers
+
+
 def inference_one_dataset(vq_model, args):
     transform = make_transform(n_px=args.data_args.inference.resolution,
                                augment=args.data_args.inference.augment)
@@ -183,10 +383,27 @@ def inference_one_dataset(vq_model, args):
     if len(dataset) == 0:
         return
 
+    filename = os.path.basename(args.data_args.inference.input_file)
+    filename = filename if filename.endswith('.jsonl') else filename.replace('.json', '.jsonl')
+    out_file = os.path.join(args.data_args.inference.output_dir, filename)
+    shard_prefix = os.path.join(args.data_args.inference.output_dir, ".shards", filename[:-len('.jsonl')])
+    rank = dist.get_rank() if is_distributed() else 0
+
+    # records written by a previous run of any rank are not inferred again.
+    if not args.resume and rank == 0:
+        remove_jsonl_shards(shard_prefix)
+    if is_distributed():
+        dist.barrier()
+    finished_indices = read_finished_indices(shard_prefix)
+    if finished_indices:
+        rank0_print(f"resume {len(finished_indices)} finished records of {filename}")
+
     kwargs = {}
     if is_distributed():
-        sampler = InferenceSampler(len(dataset))
+        sampler = InferenceSampler(len(dataset), skip_indices=finished_indices)
         kwargs["sampler"] = sampler
+    elif finished_indices:
+        kwargs["sampler"] = [i for i in range(len(dataset)) if i not in finished_indices]
     data_loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=args.data_args.inference.batch_size_for_inference,
@@ -200,10 +417,22 @@ def inference_one_dataset(vq_model, args):
 
     start_time = time.time()
 
-    assert args.data_args.inference.batch_size_for_inference == 1, "only support batch size=1 now"
+    encoder = BucketedCodebookEncoder(vq_model, args.device, args.data_args.inference.batch_size_for_inference)
+    writer = JsonlShardWriter(f"{shard_prefix}.shard{rank:05d}.jsonl")
+
+    def add_records(records):
+        for data_index, tmp in records:
+            matched_ratios = tmp["matched_ratios"]
+            # split into different ratios and save in different files
+            if all(ratio == matched_ratios[0] for ratio in matched_ratios):
+                ratio_type = f"ratio_h{matched_ratios[0][0]}_w{matched_ratios[0][1]}"
+            else:
+                ratio_type = "ratio_mixed"
+
+            writer.write(data_index, tmp, ratio_type)
 
-    outputs = defaultdict(list)
     for batch in data_loader:
+        batch_data_index = batch.pop("data_index")
         batch_image_sizes = batch.pop("image_sizes")
         batch_matched_ratios = batch.pop("matched_ratios")
         batch_need_to_skip_data = batch.pop("need_to_skip_data")
@@ -211,6 +440,7 @@ def inference_one_dataset(vq_model, args):
 
         for i, need_to_skip_data in enumerate(batch_need_to_skip_data):
             if need_to_skip_data:  # filter data
+                writer.write(batch_data_index[i], None)
                 continue
             image_sizes = batch_image_sizes[i]
             matched_ratios = batch_matched_ratios[i]
@@ -218,59 +448,24 @@ def inference_one_dataset(vq_model, args):
 
             if len(images_data) == 0:
                 print("no images! skip")
+                writer.write(batch_data_index[i], None)
                 continue
 
-            image_embed_inds = []
-            with torch.no_grad():
-                for image_data in images_data:
-                    image_data = image_data.to(device=args.device, dtype=vq_model.dtype, non_blocking=True)
-                    out = vq_model.encode(image_data)
-                    semantic_code, texture_code = out[0][2], out[1][2]
-                    # rank0_print(f"texture_code, {semantic_code.shape}")
-                    # rank0_print(f"semantic_code, {texture_code.shape}")
-                    semantic_code = semantic_code.cpu().tolist()
-                    texture_code = texture_code.cpu().tolist()
-                    image_embed_inds.append([semantic_code[0], texture_code[0]])
-
             tmp = {}
             for k, v in batch.items():
                 tmp[k] = v[i]
-            dataset.add_image_info_into_data(tmp, image_sizes, image_embed_inds, matched_ratios)
+            dataset.add_image_info_into_data(tmp, image_sizes, [None] * len(images_data), matched_ratios)
 
-            # split into different ratios and save in different files
-            if all(ratio == matched_ratios[0] for ratio in matched_ratios):
-                ratio_type = f"ratio_h{matched_ratios[0][0]}_w{matched_ratios[0][1]}"
-            else:
-                ratio_type = "ratio_mixed"
+            add_records(encoder.add(batch_data_index[i], tmp, images_data, matched_ratios))
 
-            outputs[ratio_type].append(tmp)
+    add_records(encoder.flush())
+    writer.close()
 
     if is_distributed():
-        world_size = dist.get_world_size()
-        outputs_merged = [None for _ in range(world_size)]
-        dist.all_gather_object(outputs_merged, outputs)
-
-        if dist.get_rank() == 0:
-            final_outputs = defaultdict(list)
-            for d in outputs_merged:
-                for key, value_list in d.items():
-                    final_outputs[key].extend(value_list)
-
         dist.barrier()
-    else:
-        final_outputs = outputs
-
-    if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
-        results = []
-        statistic = {}
-        for ratio_type, output in final_outputs.items():
-            results.extend(output)
-            statistic[ratio_type] = len(output)
 
-        filename = os.path.basename(args.data_args.inference.input_file)
-        filename = filename if filename.endswith('.jsonl') else filename.replace('.json', '.jsonl')
-        out_file = os.path.join(args.data_args.inference.output_dir, filename)
-        write_to_jsonl(results, out_file)
+    if rank == 0:
+        statistic = merge_jsonl_shards(shard_prefix, out_file, save_token_store=args.save_token_store)
 
         rank0_print(f"statistic: {statistic}")
         with open(args.data_args.inference.statistic_file, 'w', encoding='utf-8') as f_w:
@@ -280,7 +475,8 @@ def inference_one_dataset(vq_model, args):
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     rank0_print(f'inference time {total_time_str}')
 
-    dist.barrier()
+    if is_distributed():
+        dist.barrier()
 
 
 def main(args):
@@ -324,6 +520,10 @@ def main(args):
         print(msg)
         del checkpoint
 
+    approx_search_quantizers = {}
+    if args.approx_search_probes > 0:
+        approx_search_quantizers = setup_approximate_search(vq_model, args)
+
     if is_distributed():
         dist.barrier()
 
@@ -351,7 +551,7 @@ def main(args):
         for i, input_file in enumerate(filelist):
             filename, file_dir = os.path.basename(input_file), os.path.dirname(input_file)
 
-            # skip existed files
+            # skip existed files, unfinished files are resumed from their shards in inference_one_dataset
             if args.resume and any(os.path.exists(os.path.join(output_dir, dir, os.path.basename(filename))) for dir in
                                    os.listdir(output_dir)):
                 continue
@@ -364,6 +564,8 @@ def main(args):
             args.data_args.inference.ratios = ratios
             args.data_args.inference.crop_percent_thresh = args.crop_percent_thresh
             inference_one_dataset(vq_model, args)
+            for name, quantizer in approx_search_quantizers.items():
+                rank0_print(f"approximate search of {name}: {quantizer.search_report()}")
 
 
 if __name__ == "__main__":
@@ -381,6 +583,12 @@ if __name__ == "__main__":
     parser.add_argument("--torch_dtype", type=str, default='fp32')
     parser.add_argument("--use-ema", action='store_true')
     parser.add_argument("--resume", action='store_true')
+    parser.add_argument("--save_token_store", action='store_true')  # save the codes in a binary token store
+    # approximate nearest code search with this many probed lists of an IVF index of the codebooks, 0 for exact search
+    parser.add_argument("--approx_search_probes", type=int, default=0)
+    parser.add_argument("--approx_search_lists", type=int, default=None)  # default 4 * sqrt(codebook size)
+    # encodes whose codes are compared with the exact search, reported after every file
+    parser.add_argument("--approx_search_calibration_steps", type=int, default=16)
     parser.add_argument("--local_rank", type=int, default=0)
     args = parser.parse_args()
 
@@ -394,5 +602,9 @@ if __name__ == "__main__":
     config.torch_dtype = args.torch_dtype
     config.use_ema = args.use_ema
     config.resume = args.resume
+    config.save_token_store = args.save_token_store
     config.crop_percent_thresh = args.crop_percent_thresh
+    config.approx_search_probes = args.approx_search_probes
+    config.approx_search_lists = args.approx_search_lists
+    config.approx_search_calibration_steps = args.approx_search_calibration_steps
     main(config)
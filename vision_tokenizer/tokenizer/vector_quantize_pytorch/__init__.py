@@ -8,5 +8,6 @@ from .residual_fsq import ResidualFSQ, GroupedResidualFSQ
 from .latent_quantization import LatentQuantize
 
 from .sim_vq import SimVQ, GroupSimVQ
+from .ivf_index import IVFCodebookIndex
 from .residual_sim_vq import ResidualSimVQ
 from .utils import Sequential
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import torch
+from torch.amp import autocast
+
+from einops import rearrange
+
+from .vector_quantize_pytorch import kmeans
+from .sim_vq import tiled_nearest_codes
+
+# helper functions
+
+def exists(v):
+    return v is not None
+
+def default(v, d):
+    return v if exists(v) else d
+
+# inverted file index
+
+class IVFCodebookIndex:
+    """
+    approximate nearest code search over a fixed codebook
+
+    the codes are clustered into `num_lists` inverted lists with kmeans, a query is only compared with the codes
+    of the `num_probes` lists with the nearest centroids. the lists are padded to the longest one, padding never
+    wins as its squared norm is infinite
+
+    the index is built on cpu from a generator seeded with `seed`, so every rank builds the same index whatever
+    its global seed is, and then moved to the device of the codebook
+    """
+
+    def __init__(
+        self,
+        codebook,
+        num_lists = None,
+        num_probes = 16,
+        kmeans_iters = 10,
+        max_candidates_per_chunk = 2 ** 24,
+        seed = 0
+    ):
+        device = codebook.device
+        codebook = codebook.detach().float().cpu()
+        codebook_size = codebook.shape[0]
+        num_lists = min(default(num_lists, int(4 * codebook_size ** 0.5)), codebook_size)
+
+        generator = torch.Generator().manual_seed(seed)
+
+        def seeded_sample_vectors(samples, num):
+            return torch.stack([sample[torch.randperm(sample.shape[0], generator = generator)[:num]] for sample in samples.unbind(dim = 0)])
+
+        means, _ = kmeans(rearrange(codebook, 'c d -> 1 c d'), num_lists, num_iters = kmeans_iters, sample_fn = seeded_sample_vectors)
+        centroids = rearrange(means, '1 l d -> l d')
+        assignments = tiled_nearest_codes(codebook, centroids)
+
+        # drop the lists that no code is assigned to
+
+        list_sizes = torch.bincount(assignments, minlength = num_lists)
+        non_empty = list_sizes > 0
+        centroids, list_sizes = centroids[non_empty], list_sizes[non_empty]
+        assignments = (non_empty.cumsum(dim = 0) - 1)[assignments]
+        num_lists, max_list_size = centroids.shape[0], int(list_sizes.max())
+
+        # codes sorted by list, padded to (num_lists, max_list_size)
+
+        order = torch.argsort(assignments, stable = True)
+        list_starts = list_sizes.cumsum(dim = 0) - list_sizes
+        slots = torch.arange(codebook_size) - list_starts[assignments[order]]
+
+        list_codes = torch.zeros(num_lists, max_list_size, dtype = torch.long)
+        list_sq_norms = torch.full((num_lists, max_list_size), float('inf'))
+        list_codes[assignments[order], slots] = order
+        list_sq_norms[assignments[order], slots] = codebook[order].pow(2).sum(dim = -1)
+
+        self.codebook_size = codebook_size
+        self.num_lists = num_lists
+        self.num_probes = min(num_probes, num_lists)
+        self.max_candidates_per_chunk = max_candidates_per_chunk
+
+        self.codebook = codebook.to(device)
+        self.centroids = centroids.to(device)
+        self.list_codes = list_codes.to(device)
+        self.list_sq_norms = list_sq_norms.to(device)
+
+    @property
+    def searched_fraction(self):
+        # codes compared per query, relative to the exact search
+        return (self.num_lists + self.num_probes * self.list_codes.shape[1]) / self.codebook_size
+
+    @torch.no_grad()
+    @autocast('cuda', enabled = False)
+    def search(self, x):
+        shape = x.shape[:-1]
+        x = rearrange(x.float(), '... d -> (...) d')
+
+        # lists of the nearest centroids
+
+        centroid_dist = torch.addmm(self.centroids.pow(2).sum(dim = -1)[None], x, self.centroids.t(), alpha = -2.)
+        probes = centroid_dist.topk(self.num_probes, dim = -1, largest = False).indices
+
+        # nearest code among the codes of the probed lists, in chunks of queries to bound the gathered codes
+
+        num_candidates = self.num_probes * self.list_codes.shape[1]
+        chunk_size = max(1, self.max_candidates_per_chunk // (num_candidates * x.shape[-1]))
+
+        indices = []
+        for chunk, chunk_probes in zip(x.split(chunk_size), probes.split(chunk_size)):
+            candidates = rearrange(self.list_codes[chunk_probes], 'n p m -> n (p m)')
+            candidate_sq_norms = rearrange(self.list_sq_norms[chunk_probes], 'n p m -> n (p m)')
+
+            dist = candidate_sq_norms - 2. * torch.einsum('n d, n k d -> n k', chunk, self.codebook[candidates])
+            indices.append(candidates.gather(-1, dist.argmin(dim = -1, keepdim = True)).squeeze(-1))
+
+        return torch.cat(indices).reshape(shape)
@@ -6,6 +6,8 @@ from torch import nn
 from torch.nn import Module
 import torch.nn.functional as F
 
+from torch.amp import autocast
+
 from einx import get_at
 from einops import rearrange, pack, unpack
 
@@ -32,6 +34,32 @@ def pack_one(t, pattern):
 
     return packed, inverse
 
+@autocast('cuda', enabled = False)
+def tiled_nearest_codes(x, codebook, codebook_sq_norm = None, tile_size = 4096):
+    """
+    index of the nearest code of every row of x (..., d), comparing |c|^2 - 2 x.c tile by tile over the codebook
+    with a running argmin, so that only a (..., tile_size) distance matrix exists at a time
+    """
+    x, inverse_pack = pack_one(x.float(), '* d')
+    codebook = codebook.float()
+    if not exists(codebook_sq_norm):
+        codebook_sq_norm = codebook.pow(2).sum(dim = -1)
+
+    best_dist = x.new_full(x.shape[:-1], float('inf'))
+    best_indices = torch.zeros(x.shape[:-1], dtype = torch.long, device = x.device)
+
+    for start in range(0, codebook.shape[0], tile_size):
+        tile = codebook[start:start + tile_size]
+        dist = torch.addmm(codebook_sq_norm[None, start:start + tile_size].float(), x, tile.t(), alpha = -2.)
+        tile_dist, tile_indices = dist.min(dim = -1)
+
+        # strictly smaller, the first of equally near codes wins like in argmin
+        better = tile_dist < best_dist
+        best_dist = torch.where(better, tile_dist, best_dist)
+        best_indices = torch.where(better, tile_indices + start, best_indices)
+
+    return inverse_pack(best_indices, '*')
+
 # class
 
 class SimVQ(Module):
@@ -45,9 +73,14 @@ class SimVQ(Module):
         rotation_trick = True,  # works even better with rotation trick turned on, with no straight through and the commit loss from input to quantize
         input_to_quantize_commit_loss_weight = 0.25,
         commitment_weight = 1.,
-        frozen_codebook_dim = None # frozen codebook dim could have different dimensions than projection
+        frozen_codebook_dim = None, # frozen codebook dim could have different dimensions than projection
+        search = 'cdist', # nearest code search, 'cdist', 'tiled' for `tiled_nearest_codes` or 'ivf' for `IVFCodebookIndex` at inference
+        search_tile_size = 4096,
+        search_num_lists = None,
+        search_num_probes = 16
     ):
         super().__init__()
+        assert search in ('cdist', 'tiled', 'ivf'), f'unknown nearest code search {search}'
         self.codebook_size = codebook_size
         self.channel_first = channel_first
 
@@ -79,10 +112,129 @@ class SimVQ(Module):
 
         self.commitment_weight = commitment_weight
 
+        # nearest code search
+
+        self.search = search
+        self.search_tile_size = search_tile_size
+        self.search_num_lists = search_num_lists
+        self.search_num_probes = search_num_probes
+
+        # number of inference calls whose approximate search is compared with the exact one, see `search_report`
+
+        self.search_calibration_steps = 0
+        self._search_stats = dict(num_codes = 0, num_agree = 0, approx_dist = 0., exact_dist = 0.)
+
+        # transformed codebook and its squared norms at inference, and its approximate search index,
+        # not part of the state dict
+
+        self._cached_codebook = None
+        self._cached_codebook_key = None
+        self._search_index = None
+
     @property
     def codebook(self):
         return self.code_transform(self.frozen_codebook)
 
+    def _codebook_key(self):
+        # in-place updates (optimizer steps, loading a state dict) bump the versions, moving the module to another
+        # device or dtype changes the storages
+        tensors = [self.frozen_codebook, *self.code_transform.parameters()]
+        return tuple((t.data_ptr(), t._version, t.dtype) for t in tensors)
+
+    def get_inference_codebook(self):
+        """
+        the transformed codebook and its squared norms, cached until the weights change
+        """
+        key = self._codebook_key()
+        if self._cached_codebook_key != key:
+            with torch.no_grad():
+                codebook = self.codebook
+                self._cached_codebook = (codebook, codebook.float().pow(2).sum(dim = -1))
+            self._cached_codebook_key = key
+            self._search_index = None
+        return self._cached_codebook
+
+    def use_approximate_search(self, num_lists = None, num_probes = 16, calibration_steps = 0):
+        """
+        switches the inference to the 'ivf' search, comparing it with the exact search on the next
+        `calibration_steps` calls
+        """
+        self.search = 'ivf'
+        self.search_num_lists = num_lists
+        self.search_num_probes = num_probes
+        self.search_calibration_steps = calibration_steps
+        self._search_stats = dict(num_codes = 0, num_agree = 0, approx_dist = 0., exact_dist = 0.)
+        self._search_index = None
+
+    def get_search_index(self):
+        from .ivf_index import IVFCodebookIndex
+
+        implicit_codebook, _ = self.get_inference_codebook()
+        if not exists(self._search_index):
+            self._search_index = IVFCodebookIndex(
+                implicit_codebook,
+                num_lists = self.search_num_lists,
+                num_probes = self.search_num_probes
+            )
+        return self._search_index
+
+    def search_report(self):
+        """
+        agreement of the approximate search with the exact search over the calibration calls, and the ratio of
+        the squared distances to the codes they found
+        """
+        stats = self._search_stats
+        report = dict(num_codes = stats['num_codes'])
+        if exists(self._search_index):
+            report.update(num_lists = self._search_index.num_lists, num_probes = self._search_index.num_probes,
+                          searched_fraction = self._search_index.searched_fraction)
+        if stats['num_codes'] > 0:
+            report.update(agreement = stats['num_agree'] / stats['num_codes'],
+                          dist_ratio = stats['approx_dist'] / max(stats['exact_dist'], 1e-12))
+        return report
+
+    def approximate_nearest_codes(self, x, implicit_codebook, codebook_sq_norm):
+        indices = self.get_search_index().search(x)
+
+        if self.search_calibration_steps > 0:
+            self.search_calibration_steps -= 1
+            exact_indices = tiled_nearest_codes(x, implicit_codebook, codebook_sq_norm, tile_size = self.search_tile_size)
+
+            codebook = implicit_codebook.float()
+            stats = self._search_stats
+            stats['num_codes'] += indices.numel()
+            stats['num_agree'] += (indices == exact_indices).sum().item()
+            stats['approx_dist'] += (x.float() - codebook[indices]).pow(2).sum().item()
+            stats['exact_dist'] += (x.float() - codebook[exact_indices]).pow(2).sum().item()
+
+        return indices
+
+    def nearest_codes(self, x, implicit_codebook, codebook_sq_norm = None):
+        # the 'ivf' search needs the cached inference codebook, it is exact otherwise
+        if self.search in ('tiled', 'ivf'):
+            return tiled_nearest_codes(x, implicit_codebook, codebook_sq_norm, tile_size = self.search_tile_size)
+
+        block_size = 32768
+        num_codes = implicit_codebook.size(0)
+        if num_codes > block_size:
+            all_min_dists = []
+            all_block_indices = []
+            for i in range(0, num_codes, block_size):
+                codebook_block = implicit_codebook[i:i + block_size]
+                dist = torch.cdist(x, codebook_block)
+                min_dists, block_indices = dist.min(dim=-1)
+                all_min_dists.append(min_dists)
+                all_block_indices.append(block_indices + i)
+            all_min_dists = torch.stack(all_min_dists, dim=-1)
+            all_block_indices = torch.stack(all_block_indices, dim=-1)
+
+            final_min_dists, best_block_idx = all_min_dists.min(dim=-1)
+            indices = all_block_indices.gather(-1, best_block_idx.unsqueeze(-1)).squeeze(-1)
+        else:
+            dist = torch.cdist(x, implicit_codebook)
+            indices = dist.argmin(dim = -1)
+        return indices
+
     def indices_to_codes(
         self,
         indices
@@ -105,31 +257,19 @@ class SimVQ(Module):
 
         x, inverse_pack = pack_one(x, 'b * d')
 
-        if transformed_codebook:
+        codebook_sq_norm = None
+        if exists(transformed_codebook):
             implicit_codebook = transformed_codebook
+        elif not self.training and not torch.is_grad_enabled():
+            implicit_codebook, codebook_sq_norm = self.get_inference_codebook()
         else:
             implicit_codebook = self.codebook
 
         with torch.no_grad():
-            block_size = 32768
-            num_codes = implicit_codebook.size(0)
-            if num_codes > block_size:
-                all_min_dists = []
-                all_block_indices = []
-                for i in range(0, num_codes, block_size):
-                    codebook_block = implicit_codebook[i:i + block_size]
-                    dist = torch.cdist(x, codebook_block)
-                    min_dists, block_indices = dist.min(dim=-1)
-                    all_min_dists.append(min_dists)
-                    all_block_indices.append(block_indices + i)
-                all_min_dists = torch.stack(all_min_dists, dim=-1)
-                all_block_indices = torch.stack(all_block_indices, dim=-1)
-
-                final_min_dists, best_block_idx = all_min_dists.min(dim=-1)
-                indices = all_block_indices.gather(-1, best_block_idx.unsqueeze(-1)).squeeze(-1)
+            if self.search == 'ivf' and exists(codebook_sq_norm):
+                indices = self.approximate_nearest_codes(x, implicit_codebook, codebook_sq_norm)
             else:
-                dist = torch.cdist(x, implicit_codebook)
-                indices = dist.argmin(dim = -1)
+                indices = self.nearest_codes(x, implicit_codebook, codebook_sq_norm)
 
         # select codes
 